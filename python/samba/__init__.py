@@ -23,6 +23,7 @@
 __docformat__ = "restructuredText"
 
 import os
+import re
 import sys
 import time
 import ldb
@@ -240,22 +241,55 @@ class Ldb(_Ldb):
                 self.modify(msg, controls)
 
 
-def substitute_var(text, values):
-    """Substitute strings of the form ${NAME} in str, replacing
-    with substitutions from values.
+_template_var_re = re.compile(r"\$\{([^}]*)\}")
 
-    :param text: Text in which to subsitute.
-    :param values: Dictionary with keys and values.
+
+def parse_template(text):
+    """Split a text with ${NAME} substitution variables into a list
+    that can be rendered with render_template().
+
+    The literal parts of the text are at the even indices of the list,
+    and the names of the variables between them at the odd indices.
     """
+    return _template_var_re.split(text)
+
+
+def render_template(template, values, check=False):
+    """Substitute values into a template from parse_template() in a
+    single pass.
 
+    :param template: List from parse_template().
+    :param values: Dictionary with keys and values.
+    :param check: Raise an exception if not all variables are
+        substituted, as check_all_substituted() would.
+    """
     for (name, value) in values.items():
         assert isinstance(name, str), "%r is not a string" % name
         assert isinstance(value, str), "Value %r for %s is not a string" % (value, name)
-        text = text.replace("${%s}" % name, value)
 
+    out = template[:]
+    for i in range(1, len(out), 2):
+        name = out[i]
+        if name in values:
+            out[i] = values[name]
+        else:
+            out[i] = "${%s}" % name
+    text = "".join(out)
+    if check:
+        check_all_substituted(text)
     return text
 
 
+def substitute_var(text, values):
+    """Substitute strings of the form ${NAME} in str, replacing
+    with substitutions from values.
+
+    :param text: Text in which to subsitute.
+    :param values: Dictionary with keys and values.
+    """
+    return render_template(parse_template(text), values)
+
+
 def check_all_substituted(text):
     """Check that all substitution variables in a string have been replaced.
 
@@ -273,17 +307,25 @@ def check_all_substituted(text):
         text[var_start:var_end+1])
 
 
+# parse_template() results of the files read by read_and_sub_file()
+_template_cache = {}
+
+
 def read_and_sub_file(file_name, subst_vars):
     """Read a file and sub in variables found in it
 
     :param file_name: File to be read (typically from setup directory)
      param subst_vars: Optional variables to subsitute in the file.
     """
-    data = open(file_name, 'r').read()
-    if subst_vars is not None:
-        data = substitute_var(data, subst_vars)
-        check_all_substituted(data)
-    return data
+    if subst_vars is None:
+        return open(file_name, 'r').read()
+
+    st = os.stat(file_name)
+    (stamp, template) = _template_cache.get(file_name, (None, None))
+    if stamp != (st.st_mtime, st.st_size):
+        template = parse_template(open(file_name, 'r').read())
+        _template_cache[file_name] = ((st.st_mtime, st.st_size), template)
+    return render_template(template, subst_vars, check=True)
 
 
 def setup_file(template, fname, subst_vars=None):
@@ -19,7 +19,14 @@
 
 import ldb
 import samba
+import tdb
 import time
+import os
+import sys
+import shutil
+import pickle
+import tempfile
+import traceback
 from base64 import b64decode
 from samba import dsdb
 from samba import common
@@ -35,6 +42,211 @@ from samba.netcmd import CommandError
 from samba.netcmd.fsmo import get_fsmo_roleowner
 
 
+class dbcheck_schema_index(object):
+    """An in-memory index of the schema and naming context lookups
+    dbcheck makes for each object and attribute.
+
+    It is filled from the schema NC when dbcheck starts, so that
+    checking an object does not go back to the schema or the database
+    for these. Anything not found in the index is looked up in the
+    usual way and remembered. Hits and misses are counted for
+    --profile.
+    """
+
+    def __init__(self, samdb, samdb_schema, schema_dn, nc_dns):
+        self.samdb = samdb
+        self.samdb_schema = samdb_schema
+        self.nc_dns = nc_dns
+        self.counters = {}
+        self.linkID = {}
+        self.syntax_oid = {}
+        self.systemFlags = {}
+        self.attid = {}
+        self.attid_name = {}
+        self.class_schemaIDGUID = {}
+        self.wellknown_dn = {}
+
+        start = time.time()
+        res = self.samdb_schema.search(base=schema_dn,
+                                       scope=ldb.SCOPE_ONELEVEL,
+                                       expression="(objectClass=attributeSchema)",
+                                       attrs=["lDAPDisplayName", "linkID"])
+        links = {}
+        for msg in res:
+            name = str(msg["lDAPDisplayName"][0])
+            key = name.lower()
+            try:
+                self.syntax_oid[key] = \
+                    samdb_schema.get_syntax_oid_from_lDAPDisplayName(name)
+                self.systemFlags[key] = \
+                    samdb_schema.get_systemFlags_from_lDAPDisplayName(name)
+                for is_schema_nc in (False, True):
+                    attid = samdb_schema.get_attid_from_lDAPDisplayName(
+                        name, is_schema_nc=is_schema_nc)
+                    self.attid[(key, is_schema_nc)] = attid
+                    self.attid_name[attid] = name
+            except Exception:
+                # not in the loaded schema; leave it to the fallback
+                continue
+            if "linkID" in msg:
+                links[int(msg["linkID"][0])] = name
+            else:
+                self.linkID[key] = (0, None)
+
+        for (linkID, name) in links.items():
+            if linkID & 1:
+                revname = links.get(linkID - 1)
+            else:
+                revname = links.get(linkID + 1)
+            self.linkID[name.lower()] = (linkID, revname)
+
+        res = self.samdb_schema.search(base=schema_dn,
+                                       scope=ldb.SCOPE_ONELEVEL,
+                                       expression="(objectClass=classSchema)",
+                                       attrs=["lDAPDisplayName",
+                                              "schemaIDGUID"])
+        for msg in res:
+            guid = str(ndr_unpack(misc.GUID, msg["schemaIDGUID"][0]))
+            self.class_schemaIDGUID[str(msg["lDAPDisplayName"][0])] = guid
+
+        self.build_time = time.time() - start
+
+    def count(self, kind, hit):
+        counter = self.counters.setdefault(kind, [0, 0])
+        if hit:
+            counter[0] += 1
+        else:
+            counter[1] += 1
+
+    def merge_counters(self, counters):
+        """add counters from another index (e.g. in a worker process)"""
+        for (kind, (hits, misses)) in counters.items():
+            counter = self.counters.setdefault(kind, [0, 0])
+            counter[0] += hits
+            counter[1] += misses
+
+    def get_linkID_and_reverse_name(self, attrname):
+        key = attrname.lower()
+        if key in self.linkID:
+            self.count('linkID', True)
+            return self.linkID[key]
+        self.count('linkID', False)
+        linkID = self.samdb_schema.get_linkId_from_lDAPDisplayName(attrname)
+        if linkID:
+            revname = self.samdb_schema.get_backlink_from_lDAPDisplayName(attrname)
+        else:
+            revname = None
+        self.linkID[key] = (linkID, revname)
+        return linkID, revname
+
+    def get_syntax_oid(self, attrname):
+        key = attrname.lower()
+        if key in self.syntax_oid:
+            self.count('syntax OID', True)
+            return self.syntax_oid[key]
+        self.count('syntax OID', False)
+        # unknown attributes raise an exception, which the caller
+        # wants to see every time.
+        oid = self.samdb_schema.get_syntax_oid_from_lDAPDisplayName(attrname)
+        self.syntax_oid[key] = oid
+        return oid
+
+    def get_systemFlags(self, attrname):
+        key = attrname.lower()
+        if key in self.systemFlags:
+            self.count('systemFlags', True)
+            return self.systemFlags[key]
+        self.count('systemFlags', False)
+        flags = self.samdb_schema.get_systemFlags_from_lDAPDisplayName(attrname)
+        self.systemFlags[key] = flags
+        return flags
+
+    def get_attid(self, attrname, is_schema_nc=False):
+        key = (attrname.lower(), is_schema_nc)
+        if key in self.attid:
+            self.count('attid', True)
+            return self.attid[key]
+        self.count('attid', False)
+        attid = self.samdb_schema.get_attid_from_lDAPDisplayName(attrname,
+                                                                 is_schema_nc=is_schema_nc)
+        self.attid[key] = attid
+        return attid
+
+    def get_lDAPDisplayName_by_attid(self, attid):
+        if attid in self.attid_name:
+            self.count('attid name', True)
+            return self.attid_name[attid]
+        self.count('attid name', False)
+        # raises KeyError for unknown attids, which is not cached
+        name = self.samdb_schema.get_lDAPDisplayName_by_attid(attid)
+        self.attid_name[attid] = name
+        return name
+
+    def get_class_schemaIDGUID(self, cls, schema_dn):
+        if cls in self.class_schemaIDGUID:
+            self.count('class schemaIDGUID', True)
+            return self.class_schemaIDGUID[cls]
+        self.count('class schemaIDGUID', False)
+        flt = "(&(ldapDisplayName=%s)(objectClass=classSchema))" % cls
+        res = self.samdb.search(base=schema_dn,
+                                expression=flt,
+                                attrs=["schemaIDGUID"])
+        t = str(ndr_unpack(misc.GUID, res[0]["schemaIDGUID"][0]))
+        self.class_schemaIDGUID[cls] = t
+        return t
+
+    def get_nc_root(self, dn):
+        """find the NC root of dn, preferring the naming contexts we
+        already know about."""
+        best = None
+        for nc_dn in self.nc_dns:
+            if dn == nc_dn or dn.is_child_of(nc_dn):
+                if best is None or len(nc_dn) > len(best):
+                    best = nc_dn
+        if best is not None:
+            self.count('NC root', True)
+            return best
+        self.count('NC root', False)
+        return self.samdb.get_nc_root(dn)
+
+    def get_wellknown_dn(self, nc_dn, wkguid):
+        """like samdb.get_wellknown_dn(), raising KeyError if there is
+        no such object in the NC"""
+        key = (str(nc_dn).lower(), wkguid)
+        if key in self.wellknown_dn:
+            self.count('well-known DN', True)
+            dn = self.wellknown_dn[key]
+        else:
+            self.count('well-known DN', False)
+            try:
+                dn = self.samdb.get_wellknown_dn(nc_dn, wkguid)
+            except KeyError:
+                dn = None
+            self.wellknown_dn[key] = dn
+        if dn is None:
+            raise KeyError(wkguid)
+        return dn
+
+    def forget_wellknown_dn(self, nc_dn, wkguid):
+        self.wellknown_dn.pop((str(nc_dn).lower(), wkguid), None)
+
+    def profile_summary(self):
+        """return a list of lines describing the hits and misses"""
+        lines = ["Schema index built in %.3fs (%d attributes, %d classes)" %
+                 (self.build_time, len(self.syntax_oid),
+                  len(self.class_schemaIDGUID)),
+                 "%-20s %10s %10s" % ("lookup", "hits", "misses")]
+        hits = 0
+        misses = 0
+        for kind in sorted(self.counters):
+            (h, m) = self.counters[kind]
+            lines.append("%-20s %10d %10d" % (kind, h, m))
+            hits += h
+            misses += m
+        lines.append("%-20s %10d %10d" % ("total", hits, misses))
+        return lines
+
+
 class dbcheck(object):
     """check a SAM database for errors"""
 
@@ -93,7 +305,6 @@ class dbcheck(object):
         self.schema_dn = samdb.get_schema_basedn()
         self.rid_dn = ldb.Dn(samdb, "CN=RID Manager$,CN=System," + samdb.domain_dn())
         self.ntds_dsa = ldb.Dn(samdb, samdb.get_dsServiceName())
-        self.class_schemaIDGUID = {}
         self.wellknown_sds = get_wellknown_sds(self.samdb)
         self.fix_all_missing_objectclass = False
         self.fix_missing_deleted_objects = False
@@ -101,7 +312,8 @@ class dbcheck(object):
         self.fix_missing_rid_set_master = False
 
         self.dn_set = set()
-        self.link_id_cache = {}
+        self.report_buffer = None
+        self.write_count = 0
         self.name_map = {}
         try:
             res = samdb.search(base="CN=DnsAdmins,CN=Users,%s" % samdb.domain_dn(), scope=ldb.SCOPE_BASE,
@@ -148,6 +360,9 @@ class dbcheck(object):
                 self.deleted_objects_containers.append(dn)
             except KeyError:
                 self.ncs_lacking_deleted_containers.append(ldb.Dn(self.samdb, nc))
+        self.nc_dns = [ldb.Dn(self.samdb, str(nc)) for nc in self.ncs]
+        self.schema_index = dbcheck_schema_index(self.samdb, self.samdb_schema,
+                                                 self.schema_dn, self.nc_dns)
 
         domaindns_zone = 'DC=DomainDnsZones,%s' % self.samdb.get_default_basedn()
         forestdns_zone = 'DC=ForestDnsZones,%s' % self.samdb.get_root_basedn()
@@ -205,8 +420,14 @@ class dbcheck(object):
                 raise
             pass
 
-    def check_database(self, DN=None, scope=ldb.SCOPE_SUBTREE, controls=[], attrs=['*']):
-        '''perform a database check, returning the number of errors found'''
+    def check_database(self, DN=None, scope=ldb.SCOPE_SUBTREE, controls=[],
+                       attrs=['*'], batch_size=0):
+        '''perform a database check, returning the number of errors found.
+
+        If batch_size is non-zero, objects are loaded batch_size at a
+        time (see load_objects()) rather than with one search each.'''
+        if batch_size:
+            controls = controls + ["extended_dn:1:1"]
         res = self.samdb.search(base=DN, scope=scope, attrs=['dn'], controls=controls)
         self.report('Checking %u objects' % len(res))
         error_count = 0
@@ -215,9 +436,80 @@ class dbcheck(object):
 
         self.attribute_or_class_ids = set()
 
+        for (dn, obj) in self.load_objects([o.dn for o in res], attrs,
+                                           batch_size):
+            self.dn_set.add(str(dn))
+            error_count += self.check_object(dn, attrs=attrs, obj=obj)
+
+        if DN is None:
+            error_count += self.check_rootdse()
+
+        if error_count != 0 and not self.fix:
+            self.report("Please use --fix to fix these errors")
+
+        self.report('Checked %u objects (%u errors)' % (len(res), error_count))
+        return error_count
+
+    def check_database_parallel(self, samdb_factory, jobs, DN=None,
+                                scope=ldb.SCOPE_SUBTREE, controls=[],
+                                attrs=['*'], batch_size=0,
+                                transaction=False):
+        '''perform a database check using several worker processes,
+        returning the number of errors found.
+
+        The objects are partitioned by naming context and DN range (see
+        partition_dns()), and each partition is checked in a forked
+        worker with its own database handle, returned by calling
+        samdb_factory() as (samdb, samdb_schema). The workers never
+        write: in --fix mode any object they report an error on is
+        checked again here, in the original order, so that all changes
+        go through this (single) connection and transaction.
+
+        Output is merged in the order the objects were found, so it
+        does not depend on the number of workers or their timing.
+
+        The workers share the database file with this process, so no
+        transaction may be open while they run. With transaction=True
+        one is started here once they have all exited, covering the
+        checks and fixes made from this process (the caller commits or
+        cancels it, as self.in_transaction says).
+        '''
+        if self.in_transaction:
+            raise CommandError("check_database_parallel() can't run "
+                               "inside a transaction")
+        if batch_size:
+            controls = controls + ["extended_dn:1:1"]
+        res = self.samdb.search(base=DN, scope=scope, attrs=['dn'], controls=controls)
+        self.report('Checking %u objects' % len(res))
+        error_count = 0
+
+        self.attribute_or_class_ids = set()
+
+        dns = []
         for object in res:
             self.dn_set.add(str(object.dn))
-            error_count += self.check_object(object.dn, attrs=attrs)
+            dns.append(object.dn.extended_str())
+
+        partitions = self.partition_dns(dns, jobs)
+        results = self.run_check_workers(samdb_factory, partitions, attrs,
+                                         batch_size)
+
+        if transaction:
+            self.samdb.transaction_start()
+            self.in_transaction = True
+
+        error_count += self.check_deleted_objects_containers()
+
+        for i, dn in enumerate(dns):
+            count, messages = results[i]
+            if count != 0 and self.fix:
+                # check it again, this time allowing fixes
+                dn = ldb.Dn(self.samdb, str(ldb.Dn(self.samdb, dn)))
+                error_count += self.check_object(dn, attrs=attrs)
+                continue
+            for msg in messages:
+                self.report(msg)
+            error_count += count
 
         if DN is None:
             error_count += self.check_rootdse()
@@ -228,6 +520,255 @@ class dbcheck(object):
         self.report('Checked %u objects (%u errors)' % (len(res), error_count))
         return error_count
 
+    def load_objects(self, dns, attrs, batch_size=0):
+        '''generate (dn, obj) pairs for check_object(), in the order of
+        dns.
+
+        With a batch_size, the objects are loaded with one search per
+        batch_size DNs, matching on the objectGUID extended component
+        of each DN. This saves a round trip per object, which matters
+        most over LDAP. obj is None (meaning check_object() should do
+        its own search) for objects without a GUID, for objects the
+        batch search did not return, for any object in a batch loaded
+        before a change was written to the database (it may now be
+        stale), and for every object unless attrs is just ['*'] (other
+        attribute lists can vary with the RDN of each object).
+        '''
+        if not batch_size or list(attrs) != ['*']:
+            for dn in dns:
+                yield dn, None
+            return
+
+        search_attrs = self.get_check_object_attrs(None, attrs)
+        for start in range(0, len(dns), batch_size):
+            batch = dns[start:start + batch_size]
+            guids = []
+            for dn in batch:
+                guid = dn.get_extended_component("GUID")
+                if guid is not None:
+                    guids.append(str(misc.GUID(guid)))
+            objects = {}
+            if guids:
+                expression = "(|%s)" % ''.join("(objectGUID=%s)" % g
+                                               for g in guids)
+                res = self.samdb.search(base="", scope=ldb.SCOPE_SUBTREE,
+                                        expression=expression,
+                                        attrs=search_attrs,
+                                        controls=self.get_check_object_controls() +
+                                        ["search_options:1:2"])
+                for msg in res:
+                    guid = msg.dn.get_extended_component("GUID")
+                    objects[guid] = msg
+
+            write_count = self.write_count
+            for dn in batch:
+                plain_dn = ldb.Dn(self.samdb, str(dn))
+                if self.write_count != write_count:
+                    yield plain_dn, None
+                    continue
+                guid = dn.get_extended_component("GUID")
+                yield plain_dn, objects.get(guid)
+
+    def check_database_incremental(self, usn_db, attrs=['*'], batch_size=0):
+        '''check the objects changed since the last incremental check,
+        returning the number of errors found.
+
+        usn_db is the path of a tdb recording the highest uSNChanged
+        checked in each naming context. NCs not yet recorded there are
+        checked in full. Along with the changed objects we check the
+        objects they are linked to, or from, as the other end of those
+        links may now be wrong. The new high-water marks are only
+        saved if no errors were found, so that anything found wrong is
+        checked again next time.
+        '''
+        if os.path.isfile(usn_db):
+            db = tdb.open(usn_db)
+        else:
+            db = tdb.Tdb(usn_db, 0, tdb.DEFAULT, os.O_CREAT | os.O_RDWR)
+
+        try:
+            # Take the new marks before looking for changes, so that
+            # anything changed while we check will be found next time.
+            # uSNs are allocated across the whole database, so the
+            # highest sequence number is the mark for every NC.
+            highest_usn = self.samdb.sequence_number(ldb.SEQ_HIGHEST_SEQ)
+            new_marks = {}
+            for nc in self.nc_dns:
+                new_marks[str(nc)] = highest_usn
+
+            error_count = self.check_deleted_objects_containers()
+
+            self.attribute_or_class_ids = set()
+
+            controls = ["extended_dn:1:1", "show_deleted:1",
+                        "show_recycled:1"]
+            dns = {}
+            linked = {}
+            for nc in self.nc_dns:
+                mark = db.get(str(nc))
+                if mark is None:
+                    self.report("Checking all of %s" % nc)
+                    res = self.samdb.search(base=nc, scope=ldb.SCOPE_SUBTREE,
+                                            attrs=['dn'], controls=controls)
+                    for msg in res:
+                        dns[str(msg.dn)] = msg.dn
+                    continue
+
+                expression = "(uSNChanged>=%d)" % (int(mark) + 1)
+                res = self.samdb.search(base=nc, scope=ldb.SCOPE_SUBTREE,
+                                        expression=expression,
+                                        attrs=['*'], controls=controls)
+                self.report("%u objects changed in %s since uSN %s" %
+                            (len(res), nc, mark))
+                for msg in res:
+                    dns[str(msg.dn)] = msg.dn
+                    for attrname in msg:
+                        if attrname == 'dn':
+                            continue
+                        linkID, _ = self.get_attr_linkID_and_reverse_name(attrname)
+                        if not linkID:
+                            continue
+                        for val in msg[attrname]:
+                            target = dsdb_Dn(self.samdb, val).dn
+                            linked[str(target)] = target
+
+            for (key, dn) in linked.items():
+                if key not in dns:
+                    dns[key] = dn
+
+            self.report('Checking %u objects' % len(dns))
+            for (dn, obj) in self.load_objects([dns[k] for k in sorted(dns)],
+                                               attrs, batch_size):
+                self.dn_set.add(str(dn))
+                error_count += self.check_object(dn, attrs=attrs, obj=obj)
+
+            error_count += self.check_rootdse()
+
+            if error_count != 0:
+                if not self.fix:
+                    self.report("Please use --fix to fix these errors")
+            else:
+                db.transaction_start()
+                try:
+                    for (nc, usn) in new_marks.items():
+                        db.store(nc, str(usn))
+                except:
+                    db.transaction_cancel()
+                    raise
+                db.transaction_commit()
+        finally:
+            db.close()
+
+        self.report('Checked %u objects (%u errors)' % (len(dns), error_count))
+        return error_count
+
+    def partition_dns(self, dns, jobs):
+        '''split a list of DN strings into at most jobs lists of
+        (index, DN) pairs for check_database_parallel().
+
+        Each naming context is cut into contiguous DN ranges, one for
+        each worker. The schema NC is kept whole, because the
+        attributeID/governsID uniqueness check has to see all of it.
+        '''
+        by_nc = {}
+        nc_order = []
+        for i, dn in enumerate(dns):
+            nc = self.schema_index.get_nc_root(ldb.Dn(self.samdb, dn))
+            key = str(nc)
+            if key not in by_nc:
+                by_nc[key] = []
+                nc_order.append(key)
+            by_nc[key].append((i, dn))
+
+        partitions = [[] for i in range(jobs)]
+        for key in nc_order:
+            objects = by_nc[key]
+            if key == str(self.schema_dn):
+                smallest = min(partitions, key=len)
+                smallest.extend(objects)
+                continue
+            size = (len(objects) + jobs - 1) // jobs
+            for j in range(jobs):
+                partitions[j].extend(objects[j * size:(j + 1) * size])
+
+        return [p for p in partitions if p]
+
+    def run_check_workers(self, samdb_factory, partitions, attrs,
+                          batch_size=0):
+        '''fork a worker for each partition, wait for them all, and
+        return a dictionary mapping object index to a tuple of (error
+        count, report messages).'''
+        tmpdir = tempfile.mkdtemp(prefix='samba-dbcheck')
+        pids = {}
+        try:
+            for n, partition in enumerate(partitions):
+                filename = os.path.join(tmpdir, 'worker-%d' % n)
+                sys.stdout.flush()
+                pid = os.fork()
+                if pid == 0:
+                    self._check_worker(samdb_factory, partition, attrs,
+                                       batch_size, filename)
+                pids[pid] = filename
+
+            results = {}
+            failed = []
+            for pid, filename in pids.items():
+                (pid, status) = os.waitpid(pid, 0)
+                if not (os.WIFEXITED(status) and
+                        os.WEXITSTATUS(status) == 0):
+                    failed.append(pid)
+                    continue
+                f = open(filename, 'rb')
+                try:
+                    (worker_results, counters) = pickle.load(f)
+                finally:
+                    f.close()
+                for (i, count, messages) in worker_results:
+                    results[i] = (count, messages)
+                self.schema_index.merge_counters(counters)
+            if failed:
+                raise CommandError("dbcheck worker process(es) %s failed" %
+                                   ', '.join(str(x) for x in sorted(failed)))
+        finally:
+            shutil.rmtree(tmpdir)
+
+        return results
+
+    def _check_worker(self, samdb_factory, partition, attrs, batch_size,
+                      filename):
+        '''check the objects in one partition in a forked worker. This
+        never returns.'''
+        status = 1
+        try:
+            samdb, samdb_schema = samdb_factory()
+            chk = dbcheck(samdb, samdb_schema=samdb_schema,
+                          verbose=self.verbose, fix=False, yes=self.yes,
+                          quiet=self.quiet,
+                          reset_well_known_acls=self.reset_well_known_acls)
+            chk.dn_set = self.dn_set
+            chk.attribute_or_class_ids = set()
+            results = []
+            dns = [ldb.Dn(samdb, dn) for (i, dn) in partition]
+            objects = chk.load_objects(dns, attrs, batch_size)
+            for ((i, _), (dn, obj)) in zip(partition, objects):
+                chk.report_buffer = []
+                count = chk.check_object(dn, attrs=attrs, obj=obj)
+                results.append((i, count, chk.report_buffer))
+            f = open(filename, 'wb')
+            try:
+                pickle.dump((results, chk.schema_index.counters), f, 2)
+            finally:
+                f.close()
+            status = 0
+        except Exception:
+            sys.stderr.write("EXCEPTION in dbcheck worker PID %d\n" %
+                             os.getpid())
+            traceback.print_exc(file=sys.stderr)
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(status)
+
     def check_deleted_objects_containers(self):
         """This function only fixes conflicts on the Deleted Objects
         containers, not the attributes"""
@@ -325,12 +866,17 @@ systemFlags: -1946157056%s""" % (dn, guid_suffix),
                 self.report("Added %s well known guid link" % dn)
 
             self.deleted_objects_containers.append(dn)
+            self.schema_index.forget_wellknown_dn(nc, dsdb.DS_GUID_DELETED_OBJECTS_CONTAINER)
 
         return error_count
 
     def report(self, msg):
         '''print a message unless quiet is set'''
-        if not self.quiet:
+        if self.quiet:
+            return
+        if self.report_buffer is not None:
+            self.report_buffer.append(msg)
+        else:
             print(msg)
 
     def confirm(self, msg, allow_all=False, forced=False):
@@ -372,6 +918,7 @@ systemFlags: -1946157056%s""" % (dn, guid_suffix),
             self.report("delete DN %s" % dn)
         try:
             controls = controls + ["local_oid:%s:0" % dsdb.DSDB_CONTROL_DBCHECK]
+            self.write_count += 1
             self.samdb.delete(dn, controls=controls)
         except Exception as err:
             if self.in_transaction:
@@ -386,6 +933,7 @@ systemFlags: -1946157056%s""" % (dn, guid_suffix),
             self.report(self.samdb.write_ldif(m, ldb.CHANGETYPE_MODIFY))
         try:
             controls = controls + ["local_oid:%s:0" % dsdb.DSDB_CONTROL_DBCHECK]
+            self.write_count += 1
             self.samdb.modify(m, controls=controls, validate=validate)
         except Exception as err:
             if self.in_transaction:
@@ -405,6 +953,7 @@ newSuperior: %s""" % (str(from_dn), str(to_rdn), str(to_base)))
         try:
             to_dn = to_rdn + to_base
             controls = controls + ["local_oid:%s:0" % dsdb.DSDB_CONTROL_DBCHECK]
+            self.write_count += 1
             self.samdb.rename(from_dn, to_dn, controls=controls)
         except Exception as err:
             if self.in_transaction:
@@ -414,15 +963,7 @@ newSuperior: %s""" % (str(from_dn), str(to_rdn), str(to_base)))
         return True
 
     def get_attr_linkID_and_reverse_name(self, attrname):
-        if attrname in self.link_id_cache:
-            return self.link_id_cache[attrname]
-        linkID = self.samdb_schema.get_linkId_from_lDAPDisplayName(attrname)
-        if linkID:
-            revname = self.samdb_schema.get_backlink_from_lDAPDisplayName(attrname)
-        else:
-            revname = None
-        self.link_id_cache[attrname] = (linkID, revname)
-        return linkID, revname
+        return self.schema_index.get_linkID_and_reverse_name(attrname)
 
     def err_empty_attribute(self, dn, attrname):
         '''fix empty attributes'''
@@ -560,8 +1101,8 @@ newSuperior: %s""" % (str(from_dn), str(to_rdn), str(to_base)))
                 self.report("Not removing dangling forward link")
                 return 0
 
-            nc_root = self.samdb.get_nc_root(dn)
-            target_nc_root = self.samdb.get_nc_root(dsdb_dn.dn)
+            nc_root = self.schema_index.get_nc_root(dn)
+            target_nc_root = self.schema_index.get_nc_root(dsdb_dn.dn)
             if nc_root != target_nc_root:
                 # We don't bump the error count as Samba produces these
                 # in normal operation
@@ -798,8 +1339,8 @@ newSuperior: %s""" % (str(from_dn), str(to_rdn), str(to_base)))
         keep_transaction = False
         self.samdb.transaction_start()
         try:
-            nc_root = self.samdb.get_nc_root(obj.dn);
-            lost_and_found = self.samdb.get_wellknown_dn(nc_root, dsdb.DS_GUID_LOSTANDFOUND_CONTAINER)
+            nc_root = self.schema_index.get_nc_root(obj.dn)
+            lost_and_found = self.schema_index.get_wellknown_dn(nc_root, dsdb.DS_GUID_LOSTANDFOUND_CONTAINER)
             new_dn = ldb.Dn(self.samdb, str(obj.dn))
             new_dn.remove_base_components(len(new_dn) - 1)
             if self.do_rename(obj.dn, new_dn, lost_and_found, ["show_deleted:0", "relax:0"],
@@ -914,7 +1455,7 @@ newSuperior: %s""" % (str(from_dn), str(to_rdn), str(to_base)))
         '''return a revealed link in an object'''
         res = self.samdb.search(base=dn, scope=ldb.SCOPE_BASE, attrs=[attrname],
                                 controls=["show_deleted:0", "extended_dn:0", "reveal_internals:0"])
-        syntax_oid = self.samdb_schema.get_syntax_oid_from_lDAPDisplayName(attrname)
+        syntax_oid = self.schema_index.get_syntax_oid(attrname)
         for val in res[0][attrname]:
             dsdb_dn = dsdb_Dn(self.samdb, val, syntax_oid)
             guid2 = dsdb_dn.dn.get_extended_component("GUID")
@@ -1129,7 +1670,7 @@ newSuperior: %s""" % (str(from_dn), str(to_rdn), str(to_base)))
 
         linkID, reverse_link_name = self.get_attr_linkID_and_reverse_name(attrname)
         if reverse_link_name is not None:
-            reverse_syntax_oid = self.samdb_schema.get_syntax_oid_from_lDAPDisplayName(reverse_link_name)
+            reverse_syntax_oid = self.schema_index.get_syntax_oid(reverse_link_name)
         else:
             reverse_syntax_oid = None
 
@@ -1429,11 +1970,11 @@ newSuperior: %s""" % (str(from_dn), str(to_rdn), str(to_base)))
         obj = repl.ctr
 
         for o in repl.ctr.array:
-            att = self.samdb_schema.get_lDAPDisplayName_by_attid(o.attid)
+            att = self.schema_index.get_lDAPDisplayName_by_attid(o.attid)
             set_att.add(att.lower())
             list_attid.append(o.attid)
-            correct_attid = self.samdb_schema.get_attid_from_lDAPDisplayName(att,
-                                                                             is_schema_nc=in_schema_nc)
+            correct_attid = self.schema_index.get_attid(att,
+                                                        is_schema_nc=in_schema_nc)
             if correct_attid != o.attid:
                 wrong_attids.add(o.attid)
 
@@ -1479,17 +2020,7 @@ newSuperior: %s""" % (str(from_dn), str(to_rdn), str(to_base)))
         return str(ace.object.inherited_type)
 
     def lookup_class_schemaIDGUID(self, cls):
-        if cls in self.class_schemaIDGUID:
-            return self.class_schemaIDGUID[cls]
-
-        flt = "(&(ldapDisplayName=%s)(objectClass=classSchema))" % cls
-        res = self.samdb.search(base=self.schema_dn,
-                                expression=flt,
-                                attrs=["schemaIDGUID"])
-        t = str(ndr_unpack(misc.GUID, res[0]["schemaIDGUID"][0]))
-
-        self.class_schemaIDGUID[cls] = t
-        return t
+        return self.schema_index.get_class_schemaIDGUID(cls, self.schema_dn)
 
     def process_sd(self, dn, obj):
         sd_attr = "nTSecurityDescriptor"
@@ -1927,7 +2458,7 @@ newSuperior: %s""" % (str(from_dn), str(to_rdn), str(to_base)))
 
     def calculate_instancetype(self, dn):
         instancetype = 0
-        nc_root = self.samdb.get_nc_root(dn)
+        nc_root = self.schema_index.get_nc_root(dn)
         if dn == nc_root:
             instancetype |= dsdb.INSTANCE_TYPE_IS_NC_HEAD
             try:
@@ -1954,11 +2485,10 @@ newSuperior: %s""" % (str(from_dn), str(to_rdn), str(to_base)))
 
         raise KeyError
 
-    def check_object(self, dn, attrs=['*']):
-        '''check one object'''
-        if self.verbose:
-            self.report("Checking object %s" % dn)
-
+    def get_check_object_attrs(self, dn, attrs):
+        '''return the list of attributes check_object() needs to load
+        for dn, given the attributes requested. dn may be None if attrs
+        is just ['*'], as the list is then the same for every object.'''
         # If we modify the pass-by-reference attrs variable, then we get a
         # replPropertyMetadata for every object that we check.
         attrs = list(attrs)
@@ -1966,7 +2496,7 @@ newSuperior: %s""" % (str(from_dn), str(to_rdn), str(to_base)))
             attrs.append("name")
         if "distinguishedname" in map(str.lower, attrs):
             attrs.append("name")
-        if str(dn.get_rdn_name()).lower() in map(str.lower, attrs):
+        if dn is not None and str(dn.get_rdn_name()).lower() in map(str.lower, attrs):
             attrs.append("name")
         if 'name' in map(str.lower, attrs):
             attrs.append(dn.get_rdn_name())
@@ -1987,45 +2517,59 @@ newSuperior: %s""" % (str(from_dn), str(to_rdn), str(to_base)))
         if need_replPropertyMetaData:
             attrs.append("replPropertyMetaData")
         attrs.append("objectGUID")
+        return attrs
+
+    def get_check_object_controls(self):
+        '''return the search controls used to load an object to check'''
+        sd_flags = 0
+        sd_flags |= security.SECINFO_OWNER
+        sd_flags |= security.SECINFO_GROUP
+        sd_flags |= security.SECINFO_DACL
+        sd_flags |= security.SECINFO_SACL
+
+        return ["extended_dn:1:1",
+                "show_recycled:1",
+                "show_deleted:1",
+                "sd_flags:1:%d" % sd_flags,
+                "reveal_internals:0"]
+
+    def check_object(self, dn, attrs=['*'], obj=None):
+        '''check one object.
+
+        obj is the object as already loaded by load_objects(), or None
+        to load it here.'''
+        if self.verbose:
+            self.report("Checking object %s" % dn)
 
-        try:
-            sd_flags = 0
-            sd_flags |= security.SECINFO_OWNER
-            sd_flags |= security.SECINFO_GROUP
-            sd_flags |= security.SECINFO_DACL
-            sd_flags |= security.SECINFO_SACL
+        attrs = self.get_check_object_attrs(dn, attrs)
 
-            res = self.samdb.search(base=dn, scope=ldb.SCOPE_BASE,
-                                    controls=[
-                                        "extended_dn:1:1",
-                                        "show_recycled:1",
-                                        "show_deleted:1",
-                                        "sd_flags:1:%d" % sd_flags,
-                                        "reveal_internals:0",
-                                    ],
-                                    attrs=attrs)
-        except ldb.LdbError as e10:
-            (enum, estr) = e10.args
-            if enum == ldb.ERR_NO_SUCH_OBJECT:
-                if self.in_transaction:
-                    self.report("ERROR: Object %s disappeared during check" % dn)
-                    return 1
-                return 0
-            raise
-        if len(res) != 1:
-            self.report("ERROR: Object %s failed to load during check" % dn)
-            return 1
-        obj = res[0]
+        if obj is None:
+            try:
+                res = self.samdb.search(base=dn, scope=ldb.SCOPE_BASE,
+                                        controls=self.get_check_object_controls(),
+                                        attrs=attrs)
+            except ldb.LdbError as e10:
+                (enum, estr) = e10.args
+                if enum == ldb.ERR_NO_SUCH_OBJECT:
+                    if self.in_transaction:
+                        self.report("ERROR: Object %s disappeared during check" % dn)
+                        return 1
+                    return 0
+                raise
+            if len(res) != 1:
+                self.report("ERROR: Object %s failed to load during check" % dn)
+                return 1
+            obj = res[0]
         error_count = 0
         set_attrs_from_md = set()
         set_attrs_seen = set()
         got_repl_property_meta_data = False
         got_objectclass = False
 
-        nc_dn = self.samdb.get_nc_root(obj.dn)
+        nc_dn = self.schema_index.get_nc_root(obj.dn)
         try:
-            deleted_objects_dn = self.samdb.get_wellknown_dn(nc_dn,
-                                                             samba.dsdb.DS_GUID_DELETED_OBJECTS_CONTAINER)
+            deleted_objects_dn = self.schema_index.get_wellknown_dn(nc_dn,
+                                                                    samba.dsdb.DS_GUID_DELETED_OBJECTS_CONTAINER)
         except KeyError:
             # We have no deleted objects DN for schema, and we check for this above for the other
             # NCs
@@ -2200,7 +2744,7 @@ newSuperior: %s""" % (str(from_dn), str(to_rdn), str(to_base)))
             # get the syntax oid for the attribute, so we can can have
             # special handling for some specific attribute types
             try:
-                syntax_oid = self.samdb_schema.get_syntax_oid_from_lDAPDisplayName(attrname)
+                syntax_oid = self.schema_index.get_syntax_oid(attrname)
             except Exception as msg:
                 self.err_unknown_attribute(obj, attrname)
                 error_count += 1
@@ -2208,7 +2752,7 @@ newSuperior: %s""" % (str(from_dn), str(to_rdn), str(to_base)))
 
             linkID, reverse_link_name = self.get_attr_linkID_and_reverse_name(attrname)
 
-            flag = self.samdb_schema.get_systemFlags_from_lDAPDisplayName(attrname)
+            flag = self.schema_index.get_systemFlags(attrname)
             if (not flag & dsdb.DS_FLAG_ATTR_NOT_REPLICATED
                 and not flag & dsdb.DS_FLAG_ATTR_IS_CONSTRUCTED
                 and not linkID):
@@ -2288,6 +2832,7 @@ newSuperior: %s""" % (str(from_dn), str(to_rdn), str(to_base)))
                         nmsg.dn = dn
                         nmsg["isDeleted"] = ldb.MessageElement("TRUE", ldb.FLAG_MOD_REPLACE, "isDeleted")
                         error_count += 1
+                        self.write_count += 1
                         self.samdb.modify(nmsg, controls=["provision:0"])
 
                     else:
@@ -2365,6 +2910,7 @@ newSuperior: %s""" % (str(from_dn), str(to_rdn), str(to_base)))
                             # here.
 
                             self.samdb.transaction_start()
+                            self.write_count += 1
 
                             try:
                                 self.samdb.create_own_rid_set()
@@ -2439,6 +2985,7 @@ newSuperior: %s""" % (str(from_dn), str(to_rdn), str(to_base)))
                             # look at the next pool to avoid burning
                             # all RIDs in one go in some strange
                             # failure case.
+                            self.write_count += 1
                             try:
                                 while True:
                                     allocated_rid = self.samdb.allocate_rid()
@@ -19,11 +19,18 @@
 
 from samba.dcerpc import drsuapi, misc, drsblobs
 from samba.net import Net
-from samba.ndr import ndr_unpack
+from samba.ndr import ndr_pack, ndr_unpack
 from samba import dsdb
 from samba import werror
 from samba import WERRORError
 import samba, ldb
+import os
+import sys
+import time
+import signal
+import shutil
+import tempfile
+import traceback
 
 
 class drsException(Exception):
@@ -186,10 +193,206 @@ def drs_get_rodc_partial_attribute_set(samdb):
     return partial_attribute_set
 
 
+class drs_ChunkSizer(object):
+    '''Choose how many objects to ask for in each DsGetNCChanges call.
+
+    The chunk grows while the server fills it quickly, and shrinks when
+    a chunk takes longer than target_time seconds, so a fast server is
+    asked for fewer, larger chunks and a slow one does not stall the
+    pipeline on any single chunk.'''
+
+    DEFAULT_OBJECTS = 402
+    DEFAULT_NDR_SIZE = 402116
+    MIN_OBJECTS = 100
+    MAX_OBJECTS = 402 * 8
+
+    def __init__(self, target_time=2.0):
+        self.target_time = target_time
+        self.max_object_count = self.DEFAULT_OBJECTS
+
+    def set_request(self, req):
+        req.max_object_count = self.max_object_count
+        req.max_ndr_size = (self.DEFAULT_NDR_SIZE * self.max_object_count //
+                            self.DEFAULT_OBJECTS)
+
+    def update(self, elapsed, object_count):
+        '''Adjust the size after a chunk of object_count objects took
+        elapsed seconds to arrive.'''
+        if elapsed > self.target_time:
+            self.max_object_count = max(self.MIN_OBJECTS,
+                                        self.max_object_count // 2)
+        elif (elapsed < self.target_time / 2 and
+              object_count >= self.max_object_count):
+            self.max_object_count = min(self.MAX_OBJECTS,
+                                        self.max_object_count * 2)
+
+
+class drs_Prefetcher(object):
+    '''Fetch the chunks of one replication ahead of their being applied.
+
+    A child process makes the DsGetNCChanges calls over its own DRS
+    connection and spools each chunk to a temporary file, while the
+    parent applies the previous chunks. At most window chunks are
+    fetched ahead of those read by next_chunk() (None means no limit).
+
+    Secret attributes are encrypted with the session key of the
+    connection that fetched them, so the connection is made here, in
+    the parent, and the replication state used to apply the chunks
+    (replication_state) is initialised from it before the fork.
+    '''
+
+    def __init__(self, repl, req_level, req, window=4):
+        self.req_level = req_level
+        self.req = req
+        self.drs = drsuapi.drsuapi(repl.binding_string, repl.lp, repl.creds)
+        (self.drs_handle, self.supported_extensions) = drs_DsBind(self.drs)
+        self.replication_state = repl.net.replicate_init(repl.samdb, repl.lp,
+                                                         self.drs,
+                                                         repl.invocation_id)
+        sizer = None
+        if repl.adaptive_chunks:
+            sizer = drs_ChunkSizer()
+        self.tempdir = tempfile.mkdtemp(prefix='drs_prefetch')
+        (records_r, records_w) = os.pipe()
+        (acks_r, acks_w) = os.pipe()
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+        self.pid = os.fork()
+        if self.pid == 0:
+            status = 1
+            try:
+                os.close(records_r)
+                os.close(acks_w)
+                self._fetch(os.fdopen(records_w, 'w'), acks_r, window, sizer)
+                status = 0
+            except Exception:
+                sys.stderr.write("EXCEPTION in DRS prefetch PID %d\n" %
+                                 os.getpid())
+                traceback.print_exc(file=sys.stderr)
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(status)
+
+        os.close(records_w)
+        os.close(acks_r)
+        self.records = os.fdopen(records_r)
+        self.acks = acks_w
+        self.finished = False
+
+    def _fetch(self, records, acks, window, sizer):
+        '''Run in the child: fetch the chunks, reporting each on records'''
+        req = self.req
+        n = 0
+        acked = 0
+        while True:
+            if sizer is not None:
+                sizer.set_request(req)
+            start = time.time()
+            try:
+                (level, ctr) = self.drs.DsGetNCChanges(self.drs_handle,
+                                                       self.req_level, req)
+            except WERRORError as e:
+                records.write("werror %d %s\n" %
+                              (e.args[0], str(e.args[1]).replace('\n', ' ')))
+                records.flush()
+                return
+            elapsed = time.time() - start
+            if level not in (1, 6):
+                records.write("error unexpected DsGetNCChanges level %d\n" %
+                              level)
+                records.flush()
+                return
+
+            f = open(os.path.join(self.tempdir, str(n)), 'wb')
+            f.write(ndr_pack(ctr))
+            f.close()
+            records.write("chunk %d %d\n" % (n, level))
+            records.flush()
+            n += 1
+
+            if ctr.more_data == 0:
+                return
+            req.highwatermark = ctr.new_highwatermark
+            if sizer is not None:
+                sizer.update(elapsed, ctr.object_count)
+
+            while window is not None and n - acked >= window:
+                data = os.read(acks, 64)
+                if not data:
+                    # the parent has given up on us
+                    return
+                acked += len(data)
+
+    def next_chunk(self):
+        '''Return the (level, ctr) of the next chunk, waiting for it to
+        be fetched if necessary.'''
+        line = self.records.readline()
+        if not line:
+            raise drsException("DRS prefetch process %d exited without "
+                               "fetching all the chunks" % self.pid)
+        kind, detail = line.rstrip('\n').split(' ', 1)
+        if kind == 'werror':
+            (code, msg) = detail.split(' ', 1)
+            raise WERRORError(int(code), msg)
+        if kind != 'chunk':
+            raise drsException("DRS prefetch failed: %s" % detail)
+
+        (n, level) = [int(x) for x in detail.split()]
+        filename = os.path.join(self.tempdir, str(n))
+        f = open(filename, 'rb')
+        data = f.read()
+        f.close()
+        os.unlink(filename)
+
+        if level == 6:
+            ctr = ndr_unpack(drsuapi.DsGetNCChangesCtr6, data)
+        else:
+            ctr = ndr_unpack(drsuapi.DsGetNCChangesCtr1, data)
+        if ctr.more_data == 0:
+            self.finished = True
+        else:
+            try:
+                os.write(self.acks, 'x')
+            except OSError:
+                # the child has gone; the next read will say why
+                pass
+        return (level, ctr)
+
+    def close(self):
+        '''Stop the child, if it is still fetching, and clean up.'''
+        if self.pid is None:
+            return
+        if not self.finished:
+            try:
+                os.kill(self.pid, signal.SIGTERM)
+            except OSError:
+                pass
+        os.waitpid(self.pid, 0)
+        self.pid = None
+        self.records.close()
+        os.close(self.acks)
+        shutil.rmtree(self.tempdir, True)
+
+
 class drs_Replicate(object):
     '''DRS replication calls'''
 
-    def __init__(self, binding_string, lp, creds, samdb, invocation_id):
+    def __init__(self, binding_string, lp, creds, samdb, invocation_id,
+                 pipeline=False, adaptive_chunks=False):
+        """
+        :param pipeline: fetch the chunks of each replication in a
+            separate process, ahead of applying them (see drs_Prefetcher).
+            Schema replication and extended operations are not pipelined.
+        :param adaptive_chunks: adapt the number of objects asked for in
+            each chunk to the server's response time (see drs_ChunkSizer).
+        """
+        self.binding_string = binding_string
+        self.lp = lp
+        self.creds = creds
+        self.pipeline = pipeline
+        self.adaptive_chunks = adaptive_chunks
         self.drs = drsuapi.drsuapi(binding_string, lp, creds)
         (self.drs_handle, self.supported_extensions) = drs_DsBind(self.drs)
         self.net = Net(creds=creds, lp=lp)
@@ -198,6 +401,7 @@ class drs_Replicate(object):
             raise RuntimeError("Must supply GUID for invocation_id")
         if invocation_id == misc.GUID("00000000-0000-0000-0000-000000000000"):
             raise RuntimeError("Must not set GUID 00000000-0000-0000-0000-000000000000 as invocation_id")
+        self.invocation_id = invocation_id
         self.replication_state = self.net.replicate_init(self.samdb, lp, self.drs, invocation_id)
 
     def _should_retry_with_get_tgt(self, error_code, req):
@@ -213,10 +417,13 @@ class drs_Replicate(object):
                 (req.more_flags & drsuapi.DRSUAPI_DRS_GET_TGT) == 0 and
                 self.supported_extensions & drsuapi.DRSUAPI_SUPPORTED_EXTENSION_GETCHGREQ_V10)
 
-    def replicate(self, dn, source_dsa_invocation_id, destination_dsa_guid,
-                  schema=False, exop=drsuapi.DRSUAPI_EXOP_NONE, rodc=False,
-                  replica_flags=None, full_sync=True, sync_forced=False, more_flags=0):
-        '''replicate a single DN'''
+    def _build_request(self, dn, source_dsa_invocation_id,
+                       destination_dsa_guid, schema=False,
+                       exop=drsuapi.DRSUAPI_EXOP_NONE, rodc=False,
+                       replica_flags=None, full_sync=True, sync_forced=False,
+                       more_flags=0, highwatermark=None):
+        '''build the first GetNCChanges request for a replication,
+        returning (req_level, req)'''
 
         # setup for a GetNCChanges call
         if self.supported_extensions & drsuapi.DRSUAPI_SUPPORTED_EXTENSION_GETCHGREQ_V10:
@@ -265,6 +472,11 @@ class drs_Replicate(object):
             udv.cursors = cursors_v1
             udv.count = len(cursors_v1)
 
+        if highwatermark is not None:
+            # continue an interrupted replication from its last
+            # applied chunk
+            hwm = highwatermark
+
         req.highwatermark = hwm
         req.uptodateness_vector = udv
 
@@ -287,8 +499,8 @@ class drs_Replicate(object):
         if sync_forced:
             req.replica_flags |= drsuapi.DRSUAPI_DRS_SYNC_FORCED
 
-        req.max_object_count = 402
-        req.max_ndr_size = 402116
+        req.max_object_count = drs_ChunkSizer.DEFAULT_OBJECTS
+        req.max_ndr_size = drs_ChunkSizer.DEFAULT_NDR_SIZE
         req.extended_op = exop
         req.fsmo_info = 0
         req.partial_attribute_set = None
@@ -307,38 +519,103 @@ class drs_Replicate(object):
                     setattr(req5, a, getattr(req, a))
             req = req5
 
-        num_objects = 0
-        num_links = 0
-        while True:
-            (level, ctr) = self.drs.DsGetNCChanges(self.drs_handle, req_level, req)
-            if ctr.first_object is None and ctr.object_count != 0:
-                raise RuntimeError("DsGetNCChanges: NULL first_object with object_count=%u" % (ctr.object_count))
+        return (req_level, req)
 
-            try:
-                self.net.replicate_chunk(self.replication_state, level, ctr,
-                    schema=schema, req_level=req_level, req=req)
-            except WERRORError as e:
-                # Check if retrying with the GET_TGT flag set might resolve this error
-                if self._should_retry_with_get_tgt(e[0], req):
+    def prefetch(self, dn, source_dsa_invocation_id, destination_dsa_guid,
+                 window=None, **kwargs):
+        '''start fetching the chunks of a replication now, over a
+        separate DRS connection, so that independent NCs can be fetched
+        concurrently. Pass the result to replicate() as fetcher.'''
+        (req_level, req) = self._build_request(dn, source_dsa_invocation_id,
+                                               destination_dsa_guid, **kwargs)
+        return drs_Prefetcher(self, req_level, req, window=window)
 
-                    print("Missing target object - retrying with DRS_GET_TGT")
-                    req.more_flags |= drsuapi.DRSUAPI_DRS_GET_TGT
+    def replicate(self, dn, source_dsa_invocation_id, destination_dsa_guid,
+                  schema=False, exop=drsuapi.DRSUAPI_EXOP_NONE, rodc=False,
+                  replica_flags=None, full_sync=True, sync_forced=False, more_flags=0,
+                  fetcher=None, highwatermark=None, checkpoint=None):
+        '''replicate a single DN
+
+        If checkpoint is given, it is called with the highwatermark to
+        continue from after each chunk that is applied (except the last
+        one, and except for the schema, which is only applied at the
+        end). Passing that highwatermark back in as highwatermark
+        restarts the replication from there.'''
+
+        if fetcher is not None:
+            req_level = fetcher.req_level
+            req = fetcher.req
+        else:
+            (req_level, req) = self._build_request(
+                dn, source_dsa_invocation_id, destination_dsa_guid,
+                schema=schema, exop=exop, rodc=rodc,
+                replica_flags=replica_flags, full_sync=full_sync,
+                sync_forced=sync_forced, more_flags=more_flags,
+                highwatermark=highwatermark)
+
+        pipeline = (fetcher is not None or
+                    (self.pipeline and not schema and
+                     exop == drsuapi.DRSUAPI_EXOP_NONE))
+        sizer = None
+        if self.adaptive_chunks and not pipeline:
+            sizer = drs_ChunkSizer()
 
-                    # try sending the request again
-                    continue
+        num_objects = 0
+        num_links = 0
+        try:
+            while True:
+                if pipeline:
+                    if fetcher is None:
+                        fetcher = drs_Prefetcher(self, req_level, req)
+                    (level, ctr) = fetcher.next_chunk()
+                    replication_state = fetcher.replication_state
                 else:
-                    raise e
-
-            num_objects += ctr.object_count
-
-            # Cope with servers that do not return level 6, so do not return any links
-            try:
-                num_links += ctr.linked_attributes_count
-            except AttributeError:
-                pass
-
-            if ctr.more_data == 0:
-                break
-            req.highwatermark = ctr.new_highwatermark
+                    if sizer is not None:
+                        sizer.set_request(req)
+                    start = time.time()
+                    (level, ctr) = self.drs.DsGetNCChanges(self.drs_handle, req_level, req)
+                    elapsed = time.time() - start
+                    replication_state = self.replication_state
+                if ctr.first_object is None and ctr.object_count != 0:
+                    raise RuntimeError("DsGetNCChanges: NULL first_object with object_count=%u" % (ctr.object_count))
+
+                try:
+                    self.net.replicate_chunk(replication_state, level, ctr,
+                        schema=schema, req_level=req_level, req=req)
+                except WERRORError as e:
+                    # Check if retrying with the GET_TGT flag set might resolve this error
+                    if self._should_retry_with_get_tgt(e[0], req):
+
+                        print("Missing target object - retrying with DRS_GET_TGT")
+                        req.more_flags |= drsuapi.DRSUAPI_DRS_GET_TGT
+
+                        # try sending the request again. The chunks
+                        # already prefetched were fetched without
+                        # GET_TGT, so start fetching again from here.
+                        if fetcher is not None:
+                            fetcher.close()
+                            fetcher = None
+                        continue
+                    else:
+                        raise e
+
+                num_objects += ctr.object_count
+
+                # Cope with servers that do not return level 6, so do not return any links
+                try:
+                    num_links += ctr.linked_attributes_count
+                except AttributeError:
+                    pass
+
+                if ctr.more_data == 0:
+                    break
+                req.highwatermark = ctr.new_highwatermark
+                if sizer is not None:
+                    sizer.update(elapsed, ctr.object_count)
+                if checkpoint is not None and not schema:
+                    checkpoint(req.highwatermark)
+        finally:
+            if fetcher is not None:
+                fetcher.close()
 
         return (num_objects, num_links)
@@ -24,8 +24,15 @@ import math
 import sys
 import signal
 import itertools
-
-from collections import OrderedDict, Counter, defaultdict
+import heapq
+import copy
+import gzip
+import tempfile
+import shutil
+from array import array
+from bisect import bisect_right
+
+from collections import OrderedDict, Counter, defaultdict, deque
 from samba.emulate import traffic_packets
 from samba.samdb import SamDB
 import ldb
@@ -44,12 +51,17 @@ from samba.dsdb import UF_WORKSTATION_TRUST_ACCOUNT, UF_PASSWD_NOTREQD
 from samba.dsdb import UF_NORMAL_ACCOUNT
 from samba.dcerpc.misc import SEC_CHAN_WKSTA
 from samba import gensec
+from samba.param import LoadParm
 
 SLEEP_OVERHEAD = 3e-4
 
 # we don't use None, because it complicates [de]serialisation
 NON_PACKET = '-'
 
+# Version 1 models have no version key; version 2 adds it. Both store
+# the same counts, so both load.
+MODEL_VERSION = 2
+
 CLIENT_CLUES = {
     ('dns', '0'): 1.0,      # query
     ('smb', '0x72'): 1.0,   # Negotiate protocol
@@ -294,17 +306,12 @@ class ReplayContext(object):
                  ou=None,
                  base_dn=None,
                  domain=None,
-                 domain_sid=None):
+                 domain_sid=None,
+                 pool_size=None,
+                 pool_idle_timeout=None):
 
         self.server                   = server
-        self.ldap_connections         = []
-        self.dcerpc_connections       = []
-        self.lsarpc_connections       = []
-        self.lsarpc_connections_named = []
-        self.drsuapi_connections      = []
-        self.srvsvc_connections       = []
-        self.samr_contexts            = []
-        self.netlogon_connection      = None
+        self.reset_connections()
         self.creds                    = creds
         self.lp                       = lp
         self.prefer_kerberos          = prefer_kerberos
@@ -329,6 +336,66 @@ class ReplayContext(object):
         self.generate_ldap_search_tables()
         self.next_conversation_id = itertools.count().next
 
+        # Shared by the copies made for each conversation, so that
+        # connections can be handed from one conversation to the next.
+        self.connection_pool = None
+        if pool_size:
+            self.connection_pool = ConnectionPool(pool_size,
+                                                  pool_idle_timeout)
+
+    def reset_connections(self):
+        """Forget any connections made for a conversation."""
+        self.ldap_connections         = []
+        self.dcerpc_connections       = []
+        self.lsarpc_connections       = []
+        self.lsarpc_connections_named = []
+        self.drsuapi_connections      = []
+        self.srvsvc_connections       = []
+        self.samr_contexts            = []
+        self.netlogon_connection      = None
+
+    def take_connections(self):
+        """Return the connections made for this conversation, and forget
+        them.
+
+        The machine credentials go with a netlogon connection, because
+        the netlogon credential chain lives in them.
+        """
+        connections = {}
+        for name in ConnectionPool.CONNECTION_ATTRIBUTES:
+            connections[name] = getattr(self, name)
+        if self.netlogon_connection is not None:
+            connections['machine_creds'] = self.machine_creds
+        self.reset_connections()
+        return connections
+
+    def adopt_connections(self, connections):
+        """Use connections taken from another conversation's context."""
+        for name, value in connections.items():
+            setattr(self, name, value)
+
+    def copy_for_conversation(self):
+        """Return a copy of the context, without any connections, for
+        replaying another conversation in the same process.
+
+        The LDAP search tables and other shared state are not copied,
+        but the copy gets its own LoadParm, as
+        generate_process_local_config() points it at the conversation's
+        private directory.
+        """
+        context = copy.copy(self)
+        context.reset_connections()
+        context.lp = LoadParm()
+        if self.lp.configfile is not None:
+            context.lp.load(self.lp.configfile)
+        else:
+            context.lp.load_default()
+        for name in ("realm", "workgroup"):
+            value = self.lp.get(name)
+            if value:
+                context.lp.set(name, value)
+        return context
+
     def generate_ldap_search_tables(self):
         session = system_session()
 
@@ -698,6 +765,97 @@ class ReplayContext(object):
         return (current, subsequent)
 
 
+class ConnectionPool(object):
+    """Authenticated connections kept between conversations.
+
+    When a conversation finishes, the connections it made are kept,
+    keyed by its account, and handed to the next conversation using
+    that account, which then skips the bind and authentication. At most
+    max_size sets of connections are kept (the least recently used are
+    dropped first), and sets idle for longer than idle_timeout seconds
+    are dropped.
+    """
+    CONNECTION_ATTRIBUTES = ('ldap_connections',
+                             'dcerpc_connections',
+                             'lsarpc_connections',
+                             'lsarpc_connections_named',
+                             'drsuapi_connections',
+                             'srvsvc_connections',
+                             'samr_contexts',
+                             'netlogon_connection')
+
+    def __init__(self, max_size, idle_timeout=None):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        # serial -> (account key, release time, connections), oldest first
+        self.idle = OrderedDict()
+        self.by_account = defaultdict(list)
+        self.next_serial = itertools.count().next
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def account_key(self, account):
+        return (account.netbios_name, account.username)
+
+    def evict(self, serial):
+        key, released, connections = self.idle.pop(serial)
+        self.by_account[key].remove(serial)
+        if not self.by_account[key]:
+            del self.by_account[key]
+        self.evictions += 1
+
+    def expire(self, now):
+        if self.idle_timeout is None:
+            return
+        cutoff = now - self.idle_timeout
+        while self.idle:
+            serial, (key, released, connections) = next(self.idle.iteritems())
+            if released >= cutoff:
+                break
+            self.evict(serial)
+
+    def acquire(self, account, context):
+        """Give the context pooled connections for the account, if there
+        are any. Returns True on a hit."""
+        if account is None:
+            return False
+        self.expire(time.time())
+        serials = self.by_account.get(self.account_key(account))
+        if not serials:
+            self.misses += 1
+            return False
+        serial = serials.pop()
+        if not serials:
+            del self.by_account[self.account_key(account)]
+        key, released, connections = self.idle.pop(serial)
+        context.adopt_connections(connections)
+        self.hits += 1
+        return True
+
+    def release(self, account, context):
+        """Keep the connections of a finished conversation for reuse."""
+        if account is None:
+            return
+        connections = context.take_connections()
+        if not any(connections[name]
+                   for name in self.CONNECTION_ATTRIBUTES):
+            return
+        now = time.time()
+        key = self.account_key(account)
+        serial = self.next_serial()
+        self.idle[serial] = (key, now, connections)
+        self.by_account[key].append(serial)
+        self.expire(now)
+        while len(self.idle) > self.max_size:
+            self.evict(next(iter(self.idle)))
+
+    def report(self):
+        return ("connection pool: %d hits, %d misses, %d evictions, "
+                "%d idle" % (self.hits, self.misses, self.evictions,
+                             len(self.idle)))
+
+
 class SamrContext(object):
     """State/Context associated with a samr connection.
     """
@@ -864,7 +1022,8 @@ class Conversation(object):
             filename = os.path.join(context.statsdir, 'stats-conversation-%d' %
                                     self.conversation_id)
             sys.stdout.close()
-            sys.stdout = open(filename, 'w')
+            # line buffered, for StatsFollower
+            sys.stdout = open(filename, 'w', 1)
 
             sleep_time = gap - SLEEP_OVERHEAD
             if sleep_time > 0:
@@ -995,57 +1154,216 @@ class DnsHammer(Conversation):
                 print("%f\tDNS\tdns\t0\t%f\tFalse\t%s" % (end, duration, e))
 
 
+GZIP_MAGIC = '\x1f\x8b'
+XZ_MAGIC = '\xfd7zXZ\x00'
+
+
+def open_summary(f):
+    """Open a traffic summary for reading.
+
+    f can be an open file, '-' for stdin, or a filename. Files that
+    are compressed with gzip or xz are decompressed as they are read.
+    """
+    if not isinstance(f, str):
+        return f
+    if f == '-':
+        return sys.stdin
+
+    with open(f, 'rb') as raw:
+        magic = raw.read(len(XZ_MAGIC))
+
+    if magic.startswith(GZIP_MAGIC):
+        return gzip.open(f, 'rb')
+
+    if magic == XZ_MAGIC:
+        try:
+            import lzma
+        except ImportError:
+            try:
+                from backports import lzma
+            except ImportError:
+                raise ValueError("%s is xz compressed, but no lzma module "
+                                 "is available to read it" % f)
+        xz = lzma.LZMAFile(f, 'rb')
+        xz.name = f
+        return xz
+
+    return open(f)
+
+
+class SummaryReader(object):
+    """Group the packets in traffic summaries into conversations while
+    the summaries are being read.
+
+    Without an idle_timeout every conversation stays open until the
+    summaries have all been read, which gives the same conversations as
+    reading all the packets first. With an idle_timeout, a conversation
+    that has seen no packets for that many seconds is closed and handed
+    on, so the memory used is bounded by the traffic in that window
+    rather than by the size of the summaries. A later packet between
+    the same endpoints then starts a new conversation.
+
+    Packet timestamps are taken relative to the first packet read, and
+    the earliest and latest timestamps are kept in start_time and
+    last_packet.
+    """
+    def __init__(self, dns_mode='count', idle_timeout=None):
+        self.dns_mode = dns_mode
+        self.idle_timeout = idle_timeout
+        self.dns_counts = defaultdict(int)
+        self.base_time = None
+        self.start_time = None
+        self.last_packet = None
+        self.n_conversations = 0
+
+    def conversations(self, files):
+        """Yield the non-empty conversations in the files as they close."""
+        conversations = OrderedDict()
+        last_seen = {}
+        next_sweep = None
+
+        for f in files:
+            f = open_summary(f)
+            print >>sys.stderr, "Ingesting %s" % (f.name,)
+            for line in f:
+                p = Packet(line)
+                if p.protocol == 'dns' and self.dns_mode != 'include':
+                    self.dns_counts[p.opcode] += 1
+                    continue
+
+                if self.base_time is None:
+                    self.base_time = p.timestamp
+                    self.start_time = p.timestamp
+                    self.last_packet = p.timestamp
+                elif p.timestamp < self.start_time:
+                    self.start_time = p.timestamp
+                elif p.timestamp > self.last_packet:
+                    self.last_packet = p.timestamp
+
+                p.timestamp -= self.base_time
+                c = conversations.get(p.endpoints)
+                if c is None:
+                    c = Conversation()
+                    conversations[p.endpoints] = c
+                    self.n_conversations += 1
+                c.add_packet(p)
+
+                if self.idle_timeout is None:
+                    continue
+
+                now = p.timestamp
+                last_seen[p.endpoints] = now
+                if next_sweep is None:
+                    next_sweep = now + self.idle_timeout
+                elif now >= next_sweep:
+                    cutoff = now - self.idle_timeout
+                    for endpoints, c in conversations.items():
+                        if last_seen[endpoints] < cutoff:
+                            del conversations[endpoints]
+                            del last_seen[endpoints]
+                            if len(c) != 0:
+                                yield c
+                    next_sweep = now + self.idle_timeout
+            f.close()
+
+        # We only care about conversations with actual traffic, so we
+        # filter out conversations with nothing to say. We do that here,
+        # rather than earlier, because those empty packets contain useful
+        # hints as to which end of the conversation was the client.
+        for c in conversations.values():
+            if len(c) != 0:
+                yield c
+
+
 def ingest_summaries(files, dns_mode='count'):
     """Load a summary traffic summary file and generated Converations from it.
     """
+    reader = SummaryReader(dns_mode)
+    conversation_list = list(reader.conversations(files))
 
-    dns_counts = defaultdict(int)
-    packets = []
-    for f in files:
-        if isinstance(f, str):
-            f = open(f)
-        print >>sys.stderr, "Ingesting %s" % (f.name,)
-        for line in f:
-            p = Packet(line)
-            if p.protocol == 'dns' and dns_mode != 'include':
-                dns_counts[p.opcode] += 1
-            else:
-                packets.append(p)
-
-        f.close()
-
-    if not packets:
-        return [], 0
-
-    start_time = min(p.timestamp for p in packets)
-    last_packet = max(p.timestamp for p in packets)
-
-    print >>sys.stderr, "gathering packets into conversations"
-    conversations = OrderedDict()
-    for p in packets:
-        p.timestamp -= start_time
-        c = conversations.get(p.endpoints)
-        if c is None:
-            c = Conversation()
-            conversations[p.endpoints] = c
-        c.add_packet(p)
-
-    # We only care about conversations with actual traffic, so we
-    # filter out conversations with nothing to say. We do that here,
-    # rather than earlier, because those empty packets contain useful
-    # hints as to which end of the conversation was the client.
-    conversation_list = []
-    for c in conversations.values():
-        if len(c) != 0:
-            conversation_list.append(c)
+    if reader.base_time is None:
+        return [], 0, 0, reader.dns_counts
+
+    # Conversation start times are relative to the first packet, which
+    # is not necessarily the earliest one.
+    if reader.start_time < reader.base_time:
+        shift = reader.base_time - reader.start_time
+        for c in conversation_list:
+            c.start_time += shift
 
     # This is obviously not correct, as many conversations will appear
     # to start roughly simultaneously at the beginning of the snapshot.
     # To which we say: oh well, so be it.
-    duration = float(last_packet - start_time)
-    mean_interval = len(conversations) / duration
+    duration = float(reader.last_packet - reader.start_time)
+    mean_interval = reader.n_conversations / duration
+
+    return conversation_list, mean_interval, duration, reader.dns_counts
+
 
-    return conversation_list, mean_interval, duration, dns_counts
+def learn_summaries(files, dns_mode='count', idle_timeout=None, jobs=1):
+    """Learn a TrafficModel from traffic summaries without holding all
+    their packets in memory.
+
+    :param files: summary filenames or open files
+    :param dns_mode: 'count' to model DNS as opcode counts, 'include' to
+                     model it like other traffic, or 'inline' to ignore it
+    :param idle_timeout: close conversations idle for this many seconds
+                         (see SummaryReader)
+    :param jobs: learn from the files in this many worker processes and
+                 merge the resulting models. Each worker treats its files
+                 as a separate capture.
+    """
+    if jobs <= 1 or len(files) <= 1:
+        reader = SummaryReader(dns_mode, idle_timeout)
+        model = TrafficModel()
+        model.learn_conversations(reader.conversations(files))
+        if dns_mode == 'count':
+            for k, v in reader.dns_counts.items():
+                model.dns_opcounts[k] += v
+        return model
+
+    jobs = min(jobs, len(files))
+    tempdir = tempfile.mkdtemp(prefix='traffic_learner')
+    try:
+        pids = []
+        for n in range(jobs):
+            sys.stdout.flush()
+            sys.stderr.flush()
+            pid = os.fork()
+            if pid == 0:
+                status = 1
+                try:
+                    model = learn_summaries(files[n::jobs], dns_mode,
+                                            idle_timeout)
+                    model.save(os.path.join(tempdir, '%d.json' % n))
+                    status = 0
+                except Exception:
+                    sys.stderr.write("EXCEPTION in learner worker PID %d\n" %
+                                     os.getpid())
+                    traceback.print_exc(file=sys.stderr)
+                finally:
+                    sys.stdout.flush()
+                    sys.stderr.flush()
+                    os._exit(status)
+            pids.append(pid)
+
+        failed = []
+        for pid in pids:
+            (pid, status) = os.waitpid(pid, 0)
+            if not (os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0):
+                failed.append(pid)
+        if failed:
+            raise RuntimeError("Learning failed in worker process(es) %s" %
+                               ', '.join([str(x) for x in failed]))
+
+        model = TrafficModel()
+        for n in range(jobs):
+            partial = TrafficModel()
+            partial.load(os.path.join(tempdir, '%d.json' % n))
+            model.merge(partial)
+        return model
+    finally:
+        shutil.rmtree(tempdir)
 
 
 def guess_server_address(conversations):
@@ -1073,6 +1391,63 @@ def unstringify_keys(x):
     return y
 
 
+class WeightedChoice(object):
+    """A multiset of values, stored as counts, that can be sampled from.
+
+    The values are kept in insertion order alongside their counts, and
+    the cumulative counts are built the first time the table is sampled.
+    choice() maps random.random() onto the counts exactly as
+    random.choice() would map it onto the expanded list, so a model
+    stored this way generates the same traffic as one holding lists.
+    """
+    __slots__ = ('values', 'counts', 'cumulative', 'index')
+
+    def __init__(self, items=()):
+        self.values = []
+        self.counts = array('l')
+        self.cumulative = None
+        self.index = None
+        for value, count in items:
+            self.values.append(value)
+            self.counts.append(count)
+
+    def add(self, value, count=1):
+        if self.index is None:
+            self.index = {v: i for i, v in enumerate(self.values)}
+        i = self.index.get(value)
+        if i is None:
+            self.index[value] = len(self.values)
+            self.values.append(value)
+            self.counts.append(count)
+        else:
+            self.counts[i] += count
+        self.cumulative = None
+
+    def items(self):
+        return zip(self.values, self.counts)
+
+    def choice(self):
+        cumulative = self.cumulative
+        if cumulative is None:
+            cumulative = array('l')
+            total = 0
+            for count in self.counts:
+                total += count
+                cumulative.append(total)
+            self.cumulative = cumulative
+        i = int(random.random() * cumulative[-1])
+        return self.values[bisect_right(cumulative, i)]
+
+    def __len__(self):
+        return sum(self.counts)
+
+    def __iter__(self):
+        """Iterate over the expanded values (for debugging and tests)."""
+        for value, count in zip(self.values, self.counts):
+            for i in range(count):
+                yield value
+
+
 class TrafficModel(object):
     def __init__(self, n=3):
         self.ngrams = {}
@@ -1083,22 +1458,33 @@ class TrafficModel(object):
         self.conversation_rate = [0, 1]
 
     def learn(self, conversations, dns_opcounts={}):
-        prev = 0.0
-        cum_duration = 0.0
-        key = (NON_PACKET,) * (self.n - 1)
-
         server = guess_server_address(conversations)
 
         for k, v in dns_opcounts.items():
             self.dns_opcounts[k] += v
 
-        if len(conversations) > 1:
-            elapsed =\
-                conversations[-1].start_time - conversations[0].start_time
-            self.conversation_rate[0] = len(conversations)
-            self.conversation_rate[1] = elapsed
+        self.learn_conversations(conversations, server)
+
+    def learn_conversations(self, conversations, server=None):
+        """Learn from an iterable of conversations, one at a time, so the
+        conversations can come from SummaryReader.conversations()."""
+        prev = 0.0
+        cum_duration = 0.0
+        key = (NON_PACKET,) * (self.n - 1)
+        n_conversations = 0
+        first_start = None
+        last_start = None
 
         for c in conversations:
+            n_conversations += 1
+            # SummaryReader.conversations() yields the conversations as
+            # they are closed, which is not always in start time order.
+            if first_start is None:
+                first_start = c.start_time
+                last_start = c.start_time
+            else:
+                first_start = min(first_start, c.start_time)
+                last_start = max(last_start, c.start_time)
             client, server = c.guess_client_server(server)
             cum_duration += c.get_duration()
             key = (NON_PACKET,) * (self.n - 1)
@@ -1112,31 +1498,69 @@ class TrafficModel(object):
                     # add the wait as an extra state
                     wait = 'wait:%d' % (math.log(max(1.0,
                                                      elapsed * WAIT_SCALE)))
-                    self.ngrams.setdefault(key, []).append(wait)
+                    wait = intern(wait)
+                    self._add_ngram(key, wait)
                     key = key[1:] + (wait,)
 
-                short_p = p.as_packet_type()
-                self.query_details.setdefault(short_p,
-                                              []).append(tuple(p.extra))
-                self.ngrams.setdefault(key, []).append(short_p)
+                short_p = intern(p.as_packet_type())
+                extra = tuple(intern(x) for x in p.extra)
+                details = self.query_details.get(short_p)
+                if details is None:
+                    details = self.query_details[short_p] = WeightedChoice()
+                details.add(extra)
+                self._add_ngram(key, short_p)
                 key = key[1:] + (short_p,)
 
+        if n_conversations > 1:
+            self.conversation_rate[0] = n_conversations
+            self.conversation_rate[1] = last_start - first_start
+
         self.cumulative_duration += cum_duration
         # add in the end
-        self.ngrams.setdefault(key, []).append(NON_PACKET)
+        self._add_ngram(key, NON_PACKET)
+
+    def _add_ngram(self, key, p):
+        choices = self.ngrams.get(key)
+        if choices is None:
+            choices = self.ngrams[key] = WeightedChoice()
+        choices.add(p)
+
+    def merge(self, other):
+        """Add the counts learnt by another model to this one."""
+        for table, other_table in ((self.ngrams, other.ngrams),
+                                   (self.query_details, other.query_details)):
+            for k, v in other_table.iteritems():
+                choices = table.get(k)
+                if choices is None:
+                    table[k] = WeightedChoice(v.items())
+                else:
+                    for p, count in v.items():
+                        choices.add(p, count)
+
+        for k, v in other.dns_opcounts.items():
+            self.dns_opcounts[k] += v
+
+        self.cumulative_duration += other.cumulative_duration
+        if self.conversation_rate[0] == 0:
+            self.conversation_rate = list(other.conversation_rate)
+        elif other.conversation_rate[0] != 0:
+            self.conversation_rate = [
+                self.conversation_rate[0] + other.conversation_rate[0],
+                self.conversation_rate[1] + other.conversation_rate[1]]
 
     def save(self, f):
         ngrams = {}
         for k, v in self.ngrams.iteritems():
             k = '\t'.join(k)
-            ngrams[k] = dict(Counter(v))
+            ngrams[k] = dict(v.items())
 
         query_details = {}
         for k, v in self.query_details.iteritems():
-            query_details[k] = dict(Counter('\t'.join(x) if x else '-'
-                                            for x in v))
+            query_details[k] = dict(('\t'.join(x) if x else '-', count)
+                                    for x, count in v.items())
 
         d = {
+            'version': MODEL_VERSION,
             'ngrams': ngrams,
             'query_details': query_details,
             'cumulative_duration': self.cumulative_duration,
@@ -1155,19 +1579,33 @@ class TrafficModel(object):
 
         d = json.load(f)
 
+        version = d.get('version', 1)
+        if version > MODEL_VERSION:
+            raise ValueError("traffic model version %d is newer than the "
+                             "supported version %d" % (version, MODEL_VERSION))
+
+        def load_choices(table, k, items):
+            if k in table:
+                for p, count in items:
+                    table[k].add(p, count)
+            else:
+                table[k] = WeightedChoice(items)
+
         for k, v in d['ngrams'].iteritems():
-            k = tuple(str(k).split('\t'))
-            values = self.ngrams.setdefault(k, [])
-            for p, count in v.iteritems():
-                values.extend([str(p)] * count)
+            k = tuple(intern(str(x)) for x in k.split('\t'))
+            load_choices(self.ngrams, k,
+                         [(intern(str(p)), count)
+                          for p, count in v.iteritems()])
 
         for k, v in d['query_details'].iteritems():
-            values = self.query_details.setdefault(str(k), [])
+            items = []
             for p, count in v.iteritems():
                 if p == '-':
-                    values.extend([()] * count)
+                    items.append(((), count))
                 else:
-                    values.extend([tuple(str(p).split('\t'))] * count)
+                    items.append((tuple(intern(str(x))
+                                        for x in p.split('\t')), count))
+            load_choices(self.query_details, intern(str(k)), items)
 
         if 'dns' in d:
             for k, v in d['dns'].items():
@@ -1185,11 +1623,11 @@ class TrafficModel(object):
         key = (NON_PACKET,) * (self.n - 1)
 
         while key in self.ngrams:
-            p = random.choice(self.ngrams.get(key, NON_PACKET))
+            p = self.ngrams[key].choice()
             if p == NON_PACKET:
                 break
             if p in self.query_details:
-                extra = random.choice(self.query_details[p])
+                extra = self.query_details[p].choice()
             else:
                 extra = []
 
@@ -1381,7 +1819,24 @@ def replay(conversations,
            accounts=None,
            dns_rate=0,
            duration=None,
+           workers=None,
+           stats_interval=None,
            **kwargs):
+    """Replay the conversations against the host.
+
+    By default each conversation is replayed in its own forked
+    process. If workers is given, the conversations are instead shared
+    between that many worker processes (see replay_in_worker()), which
+    allows many more simultaneous conversations from one machine.
+
+    If stats_interval is given, throughput and latency percentiles
+    for the preceding interval are printed every stats_interval
+    seconds.
+
+    A pool_size keyword argument gives each worker a ConnectionPool,
+    so that conversations with the same account reuse connections
+    rather than binding again. It has no effect without workers.
+    """
 
     context = ReplayContext(server=host,
                             creds=creds,
@@ -1415,6 +1870,29 @@ def replay(conversations,
           % (len(conversations), duration))
 
     children = {}
+    follower = None
+    if stats_interval:
+        follower = StatsFollower(context.statsdir)
+
+    if workers:
+        # hand the accounts out round-robin in the start time order of
+        # their first conversation, so each worker has a similar load
+        # throughout. All the conversations of an account go to the
+        # same worker, which runs them one at a time (see
+        # replay_cooperatively()).
+        batches = [[] for i in range(workers)]
+        account_workers = {}
+        for c, account in reversed(cstack):
+            i = account_workers.setdefault(id(account),
+                                           len(account_workers) % workers)
+            batches[i].append((c, account))
+        for i, batch in enumerate(batches):
+            if not batch:
+                continue
+            pid = replay_in_worker(batch, start, end, context, i)
+            children[pid] = "worker %d" % i
+        cstack = []
+
     if dns_rate:
         dns_hammer = DnsHammer(dns_rate, duration)
         cstack.append((dns_hammer, None))
@@ -1450,6 +1928,9 @@ def replay(conversations,
 
             while time.time() < batch_end - 1.0:
                 time.sleep(0.01)
+                if (follower is not None and
+                    time.time() >= follower.last_report + stats_interval):
+                    follower.report()
                 try:
                     pid, status = os.waitpid(-1, os.WNOHANG)
                 except OSError as e:
@@ -1513,6 +1994,168 @@ def replay(conversations,
             print >>sys.stderr, "ignoring fake ^C"
 
 
+def replay_in_worker(conversations, start, end, context, worker_id):
+    """Fork a worker process to replay a list of conversations.
+
+    Rather than forking a process per conversation, the worker runs
+    all of its conversations itself, sending each packet in timestamp
+    order (relative to start) using replay_cooperatively().
+
+    :param conversations: a list of (conversation, account) tuples.
+    :return: the pid of the worker
+    """
+    for c, account in conversations:
+        c.conversation_id = context.next_conversation_id()
+
+    pid = os.fork()
+    if pid != 0:
+        return pid
+
+    def signal_handler(signal, frame):
+        # workers are normally stopped this way, so this is where the
+        # pool is reported.
+        if context.connection_pool is not None:
+            print >>sys.stderr, ("worker %d: %s" %
+                                 (worker_id, context.connection_pool.report()))
+        sys.stderr.close()
+        sys.stdout.close()
+        os._exit(0)
+
+    pid = os.getpid()
+    signal.signal(signal.SIGTERM, signal_handler)
+    # as with Conversation.replay_in_fork_with_delay(), we must never
+    # return from here.
+    try:
+        sys.stdin.close()
+        os.close(0)
+        filename = os.path.join(context.statsdir,
+                                'stats-worker-%d' % worker_id)
+        sys.stdout.close()
+        # line buffered, for StatsFollower
+        sys.stdout = open(filename, 'w', 1)
+        print >>sys.stderr, ("worker %d (pid %d) replaying %d conversations" %
+                             (worker_id, pid, len(conversations)))
+        replay_cooperatively(conversations, start, end, context)
+    except Exception:
+        print >>sys.stderr, ("EXCEPTION in worker %d, PID %d" %
+                             (worker_id, pid))
+        traceback.print_exc(sys.stderr)
+    finally:
+        sys.stderr.close()
+        sys.stdout.close()
+        os._exit(0)
+
+
+def replay_cooperatively(conversations, start, end, context):
+    """Replay many conversations in this process.
+
+    The next packet of every conversation is kept in a heap ordered by
+    the time it is due (the conversation's start time plus the packet's
+    timestamp). We sleep until the earliest is due, play it, and queue
+    the next packet of that conversation. A slow operation delays the
+    packets behind it, but every packet is sent as close as it can be
+    to its timestamp, and there is no per-conversation process.
+
+    :param conversations: a list of (conversation, account) tuples.
+    :param start: the time.time() the replay began, which conversation
+                  start times are relative to.
+    :param end: the time.time() to stop at.
+    :param context: a ReplayContext, which is copied for each
+                    conversation. If it has a connection pool, the
+                    connections of finished conversations are reused.
+
+    Conversations with the same account are run one at a time, in
+    order: a conversation due to start while another with its account
+    is running waits for that one to finish. Otherwise both would
+    authenticate, and reset each other's netlogon credential chain.
+    """
+    queue = []
+    for i, (c, account) in enumerate(conversations):
+        if c.packets:
+            queue.append((c.start_time + c.packets[0].timestamp, i, 0))
+    heapq.heapify(queue)
+
+    pool = context.connection_pool
+    contexts = {}
+    failed = 0
+    # account -> (index of the conversation using it, deque of the
+    # (t, index) of the conversations waiting for it)
+    busy_accounts = {}
+    while queue:
+        t, i, n = heapq.heappop(queue)
+        c, account = conversations[i]
+        if n == 0 and account is not None:
+            busy = busy_accounts.get(id(account))
+            if busy is None:
+                busy_accounts[id(account)] = (i, deque())
+            elif busy[0] != i:
+                busy[1].append((t, i))
+                continue
+
+        gap = start + t - time.time()
+        sleep_time = gap - SLEEP_OVERHEAD
+        if sleep_time > 0:
+            time.sleep(sleep_time)
+        if time.time() >= end:
+            break
+
+        if n == 0:
+            conversation_context = context.copy_for_conversation()
+            try:
+                conversation_context.generate_process_local_config(account,
+                                                                   c)
+            except Exception:
+                print >>sys.stderr, ("EXCEPTION starting conversation %s" %
+                                     c)
+                traceback.print_exc(sys.stderr)
+                failed += 1
+                # record it in the stats as a failed operation, as a
+                # worker is usually killed before it gets to report
+                # anything at the end.
+                print("%f\t%s\tconversation\tsetup\t%f\tFalse\t%s" %
+                      (time.time(), c.conversation_id, 0.0,
+                       "conversation setup failed"))
+                release_account(busy_accounts, account, queue)
+                continue
+            if pool is not None:
+                pool.acquire(account, conversation_context)
+            contexts[i] = conversation_context
+            miss = start + t - time.time()
+            debug(2, "starting %s [miss %.3f]" % (c, miss))
+
+        c.packets[n].play(c, contexts[i])
+
+        n += 1
+        if n < len(c.packets):
+            heapq.heappush(queue, (c.start_time + c.packets[n].timestamp,
+                                   i, n))
+        else:
+            # let the connections go, or keep them for the next
+            # conversation with this account.
+            conversation_context = contexts.pop(i)
+            if pool is not None:
+                pool.release(account, conversation_context)
+            release_account(busy_accounts, account, queue)
+
+    if failed:
+        print >>sys.stderr, "%d conversations failed to start" % failed
+    if pool is not None:
+        print >>sys.stderr, pool.report()
+
+
+def release_account(busy_accounts, account, queue):
+    """Start the next conversation waiting for an account, if any, in
+    replay_cooperatively(). It is late, so it is queued at the time it
+    was due."""
+    if account is None:
+        return
+    owner, waiting = busy_accounts.pop(id(account))
+    if waiting:
+        t, i = waiting.popleft()
+        busy_accounts[id(account)] = (i, waiting)
+        heapq.heappush(queue, (t, i, 0))
+
+
 def openLdb(host, creds, lp):
     session = system_session()
     ldb = SamDB(url="ldap://%s" % host,
@@ -1854,16 +2497,258 @@ def add_users_to_groups(db, instance_id, assignments):
         print("%f\t0\tadd\tuser\t%f\tTrue\t" % (end, duration))
 
 
-def generate_stats(statsdir, timing_file):
-    """Generate and print the summary stats for a run."""
-    first      = sys.float_info.max
-    last       = 0
-    successful = 0
-    failed     = 0
-    latencies  = {}
-    failures   = {}
-    unique_converations = set()
-    conversations = 0
+class LatencyHistogram(object):
+    """A mergeable histogram of latencies, for estimating percentiles
+    in constant memory.
+
+    Values are counted in logarithmic buckets, each PRECISION wider
+    than the last (in the style of an HDR histogram), so a percentile
+    is within about PRECISION / 2 of the true value. The count, sum,
+    minimum and maximum are exact.
+    """
+    PRECISION = 0.01
+    MIN_VALUE = 1e-6
+    LOG_BASE = math.log(1.0 + PRECISION)
+
+    def __init__(self):
+        self.buckets = defaultdict(int)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        if value > self.MIN_VALUE:
+            i = int(math.log(value / self.MIN_VALUE) / self.LOG_BASE)
+        else:
+            i = 0
+        self.buckets[i] += 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for i, n in other.buckets.items():
+            self.buckets[i] += n
+        self.count += other.count
+        self.sum += other.sum
+        if other.min is not None and (self.min is None or
+                                      other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or
+                                      other.max > self.max):
+            self.max = other.max
+
+    def mean(self):
+        if self.count == 0:
+            return 0
+        return self.sum / self.count
+
+    def percentile(self, percentile):
+        """Estimate the percentile (0.0 to 1.0), in the manner of
+        calc_percentile()"""
+        if self.count == 0:
+            return 0
+        k = (self.count - 1) * percentile
+        seen = 0
+        for i in sorted(self.buckets):
+            seen += self.buckets[i]
+            if seen > k:
+                value = self.MIN_VALUE * math.exp((i + 0.5) * self.LOG_BASE)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def as_dict(self):
+        return {
+            'buckets': dict((str(k), v) for k, v in self.buckets.items()),
+            'count': self.count,
+            'sum': self.sum,
+            'min': self.min,
+            'max': self.max,
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        h = cls()
+        for k, v in d['buckets'].items():
+            h.buckets[int(k)] = v
+        h.count = d['count']
+        h.sum = d['sum']
+        h.min = d['min']
+        h.max = d['max']
+        return h
+
+
+class TrafficStats(object):
+    """Summary statistics for a replay, built one stats line at a time.
+
+    Memory use depends on the number of distinct operations, not the
+    number of packets. Stats from several processes, runs or hosts
+    can be combined with merge(), and saved and loaded as JSON.
+    """
+    def __init__(self):
+        self.first = sys.float_info.max
+        self.last = 0
+        self.successful = 0
+        self.failed = 0
+        self.latencies = {}
+        self.failures = defaultdict(int)
+        self.conversation_ids = set()
+        # conversations counted in merged stats, whose ids may clash
+        # with our own.
+        self.other_conversations = 0
+
+    def add_line(self, line):
+        """Add a line from a stats file, returning False if it could
+        not be parsed."""
+        try:
+            fields       = line.rstrip('\n').split('\t')
+            conversation = fields[1]
+            protocol     = fields[2]
+            packet_type  = fields[3]
+            latency      = float(fields[4])
+            first        = float(fields[0]) - latency
+            last         = float(fields[0])
+            successful   = fields[5] == 'True'
+        except (ValueError, IndexError):
+            return False
+
+        self.first = min(first, self.first)
+        self.last = max(last, self.last)
+        key = (protocol, packet_type)
+        h = self.latencies.get(key)
+        if h is None:
+            h = LatencyHistogram()
+            self.latencies[key] = h
+        h.add(latency)
+
+        if successful:
+            self.successful += 1
+        else:
+            self.failed += 1
+            self.failures[key] += 1
+
+        self.conversation_ids.add(conversation)
+        return True
+
+    def conversations(self):
+        return len(self.conversation_ids) + self.other_conversations
+
+    def duration(self):
+        return max(self.last - self.first, 0)
+
+    def merge(self, other):
+        self.first = min(self.first, other.first)
+        self.last = max(self.last, other.last)
+        self.successful += other.successful
+        self.failed += other.failed
+        for key, h in other.latencies.items():
+            if key in self.latencies:
+                self.latencies[key].merge(h)
+            else:
+                self.latencies[key] = LatencyHistogram.from_dict(h.as_dict())
+        for key, n in other.failures.items():
+            self.failures[key] += n
+        self.other_conversations += other.conversations()
+
+    def save(self, f):
+        d = {
+            'first': self.first,
+            'last': self.last,
+            'successful': self.successful,
+            'failed': self.failed,
+            'conversations': self.conversations(),
+            'latencies': dict(('\t'.join(k), h.as_dict())
+                              for k, h in self.latencies.items()),
+            'failures': dict(('\t'.join(k), n)
+                             for k, n in self.failures.items()),
+        }
+        if isinstance(f, str):
+            with open(f, 'w') as out:
+                json.dump(d, out, indent=2)
+        else:
+            json.dump(d, f, indent=2)
+
+    def load(self, f):
+        if isinstance(f, str):
+            with open(f) as inp:
+                d = json.load(inp)
+        else:
+            d = json.load(f)
+        other = TrafficStats()
+        other.first = d['first']
+        other.last = d['last']
+        other.successful = d['successful']
+        other.failed = d['failed']
+        other.other_conversations = d['conversations']
+        for k, v in d['latencies'].items():
+            key = tuple(str(k).split('\t'))
+            other.latencies[key] = LatencyHistogram.from_dict(v)
+        for k, v in d['failures'].items():
+            other.failures[tuple(str(k).split('\t'))] = v
+        self.merge(other)
+
+
+class StatsFollower(object):
+    """Read the stats files in a directory as they are written, for
+    interim reports during a replay."""
+    def __init__(self, statsdir):
+        self.statsdir = statsdir
+        self.offsets = {}
+        self.partial = {}
+        self.last_report = time.time()
+
+    def read_new_lines(self, stats):
+        """Add any complete lines written since last time to stats"""
+        for filename in os.listdir(self.statsdir):
+            path = os.path.join(self.statsdir, filename)
+            try:
+                f = open(path, 'r')
+            except IOError:
+                continue
+            with f:
+                f.seek(self.offsets.get(filename, 0))
+                data = self.partial.pop(filename, '') + f.read()
+                self.offsets[filename] = f.tell()
+            lines = data.split('\n')
+            if lines[-1]:
+                self.partial[filename] = lines[-1]
+            for line in lines[:-1]:
+                stats.add_line(line)
+
+    def report(self, out=sys.stderr):
+        """Print throughput and latency percentiles for each operation
+        since the last report."""
+        stats = TrafficStats()
+        self.read_new_lines(stats)
+        now = time.time()
+        elapsed = now - self.last_report
+        self.last_report = now
+        if elapsed <= 0:
+            return
+        print >>out, ("interim: %d ok, %d failed in %.1fs (%.1f ops/s)" %
+                      (stats.successful, stats.failed, elapsed,
+                       (stats.successful + stats.failed) / elapsed))
+        for key in sorted(stats.latencies):
+            h = stats.latencies[key]
+            print >>out, ("  %-12s %4s %8.1f/s  p50 %.6f  p95 %.6f  "
+                          "p99 %.6f" %
+                          (key[0], key[1], h.count / elapsed,
+                           h.percentile(0.50), h.percentile(0.95),
+                           h.percentile(0.99)))
+
+
+def generate_stats(statsdir, timing_file, stats_file=None):
+    """Generate and print the summary stats for a run.
+
+    The stats files are read a line at a time into a TrafficStats. If
+    stats_file is given, the stats are also saved there as JSON, to
+    be merged with those of other runs using print_merged_stats().
+    """
+    stats = TrafficStats()
 
     if timing_file is not None:
         tw = timing_file.write
@@ -1877,43 +2762,33 @@ def generate_stats(statsdir, timing_file):
         path = os.path.join(statsdir, filename)
         with open(path, 'r') as f:
             for line in f:
-                try:
-                    fields       = line.rstrip('\n').split('\t')
-                    conversation = fields[1]
-                    protocol     = fields[2]
-                    packet_type  = fields[3]
-                    latency      = float(fields[4])
-                    first        = min(float(fields[0]) - latency, first)
-                    last         = max(float(fields[0]), last)
-
-                    if protocol not in latencies:
-                        latencies[protocol] = {}
-                    if packet_type not in latencies[protocol]:
-                        latencies[protocol][packet_type] = []
-
-                    latencies[protocol][packet_type].append(latency)
-
-                    if protocol not in failures:
-                        failures[protocol] = {}
-                    if packet_type not in failures[protocol]:
-                        failures[protocol][packet_type] = 0
-
-                    if fields[5] == 'True':
-                        successful += 1
-                    else:
-                        failed += 1
-                        failures[protocol][packet_type] += 1
-
-                    if conversation not in unique_converations:
-                        unique_converations.add(conversation)
-                        conversations += 1
-
+                if stats.add_line(line):
                     tw(line)
-                except (ValueError, IndexError):
+                else:
                     # not a valid line print and ignore
                     print >>sys.stderr, line
-                    pass
-    duration = last - first
+
+    if stats_file is not None:
+        stats.save(stats_file)
+
+    print_stats(stats)
+
+
+def print_merged_stats(stats_files):
+    """Print the summary of several saved TrafficStats files (e.g. from
+    different hosts replaying at the same time)."""
+    stats = TrafficStats()
+    for f in stats_files:
+        stats.load(f)
+    print_stats(stats)
+
+
+def print_stats(stats):
+    """Print the summary stats"""
+    conversations = stats.conversations()
+    successful = stats.successful
+    failed = stats.failed
+    duration = stats.duration()
     if successful == 0:
         success_rate = 0
     else:
@@ -1942,19 +2817,19 @@ def generate_stats(statsdir, timing_file):
     else:
         print("proto\top_code\tdesc\tcount\tfailed\tmean\tmedian\t95%\trange"
               "\tmax")
-    protocols = sorted(latencies.keys())
+    protocols = sorted(set(k[0] for k in stats.latencies))
     for protocol in protocols:
-        packet_types = sorted(latencies[protocol], key=opcode_key)
+        packet_types = sorted((k[1] for k in stats.latencies
+                               if k[0] == protocol), key=opcode_key)
         for packet_type in packet_types:
-            values     = latencies[protocol][packet_type]
-            values     = sorted(values)
-            count      = len(values)
-            failed     = failures[protocol][packet_type]
-            mean       = sum(values) / count
-            median     = calc_percentile(values, 0.50)
-            percentile = calc_percentile(values, 0.95)
-            rng        = values[-1] - values[0]
-            maxv       = values[-1]
+            h          = stats.latencies[(protocol, packet_type)]
+            count      = h.count
+            failed     = stats.failures[(protocol, packet_type)]
+            mean       = h.mean()
+            median     = h.percentile(0.50)
+            percentile = h.percentile(0.95)
+            rng        = h.max - h.min
+            maxv       = h.max
             desc       = OP_DESCRIPTIONS.get((protocol, packet_type), '')
             if sys.stdout.isatty:
                 print("%-12s   %4s  %-35s %12d %12d %12.6f "
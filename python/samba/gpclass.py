@@ -135,6 +135,17 @@ class gp_log:
             item.attrib['count'] = '%d' % (len(apply_log)-1)
             item.attrib['value'] = guid
 
+    def is_applied(self, guid):
+        ''' Whether a GPO guid is in the applylog
+        param guid          - guid value of the GPO
+        return              - True if the GPO has been applied and not since
+                              unapplied
+        '''
+        user_obj = self.gpdb.find('user[@name="%s"]' % self.user)
+        apply_log = user_obj.find('applylog')
+        return apply_log is not None and \
+            apply_log.find('guid[@value="%s"]' % guid) is not None
+
     def apply_log_pop(self):
         ''' Pop a GPO guid from the applylog
         return              - last applied GPO guid
@@ -294,8 +305,20 @@ class gp_ext(object):
     def apply_map(self):
         pass
 
+    def load(self, afile, conn):
+        ''' Read the file the extension applies from a GPO
+        param afile         - the path returned by list()
+        param conn          - SMB connection to the sysvol share
+        return              - the file contents, or None if the GPO does not
+                              have one
+        '''
+        try:
+            return conn.loadfile(afile.replace('/', '\\'))
+        except NTSTATUSError:
+            return None
+
     @abstractmethod
-    def parse(self, afile, ldb, conn, gp_db, lp):
+    def parse(self, afile, ldb, conn, gp_db, lp, policy=None):
         pass
 
     @abstractmethod
@@ -465,11 +488,10 @@ class gp_sec_ext(gp_ext):
                                    }
                }
 
-    def read_inf(self, path, conn):
+    def read_inf(self, policy):
         ret = False
         inftable = self.apply_map()
 
-        policy = conn.loadfile(path.replace('/', '\\'))
         current_section = None
 
         # So here we would declare a boolean,
@@ -496,14 +518,11 @@ class gp_sec_ext(gp_ext):
                     ret = True
                     setter(self.logger, self.ldb, self.gp_db, self.lp, att,
                            value).update_samba()
-                    self.gp_db.commit()
+        if ret:
+            self.gp_db.commit()
         return ret
 
-    def parse(self, afile, ldb, conn, gp_db, lp):
-        self.ldb = ldb
-        self.gp_db = gp_db
-        self.lp = lp
-
+    def load(self, afile, conn):
         # Fixing the bug where only some Linux Boxes capitalize MACHINE
         if afile.endswith('inf'):
             try:
@@ -514,12 +533,28 @@ class gp_sec_ext(gp_ext):
                     bfile = '/'.join(blist[:idx]) + '/' + case + '/' + \
                             '/'.join(blist[idx+1:])
                     try:
-                        return self.read_inf(bfile, conn)
+                        return conn.loadfile(bfile.replace('/', '\\'))
                     except NTSTATUSError:
                         continue
             except ValueError:
                 try:
-                    return self.read_inf(afile, conn)
+                    return conn.loadfile(afile.replace('/', '\\'))
                 except:
                     return None
+        return None
+
+    def parse(self, afile, ldb, conn, gp_db, lp, policy=None):
+        ''' Apply the GptTmpl.inf of a GPO
+        param policy        - (optional) the contents of the file, if it has
+                              already been read with load()
+        '''
+        self.ldb = ldb
+        self.gp_db = gp_db
+        self.lp = lp
+
+        if policy is None:
+            policy = self.load(afile, conn)
+            if policy is None:
+                return None
+        return self.read_inf(policy)
 
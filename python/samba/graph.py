@@ -448,43 +448,36 @@ def find_transitive_distance(vertices, edges):
               (all_vertices - set(vertices)),
               file=sys.stderr)
 
-    # with n vertices, we are always less than n hops away from
-    # anywhere else.
-    inf = len(all_vertices)
-    distances = {}
+    neighbours = {}
     for v in all_vertices:
-        distances[v] = {v: 0}
-
+        neighbours[v] = set()
     for src, dest in edges:
-        distances[src][dest] = distances[src].get(dest, 1)
-
-    # This algorithm (and implementation) seems very suboptimal.
-    # potentially O(n^4), though n is smallish.
-    for i in range(inf):
-        changed = False
-        new_distances = {}
-        for v, d in distances.iteritems():
-            new_d = d.copy()
-            new_distances[v] = new_d
-            for dest, cost in d.iteritems():
-                for leaf, cost2 in distances[dest].iteritems():
-                    new_cost = cost + cost2
-                    old_cost = d.get(leaf, inf)
-                    if new_cost < old_cost:
-                        new_d[leaf] = new_cost
-                        changed = True
-
-        distances = new_distances
-        if not changed:
-            break
-
-    # filter out unwanted vertices and infinite links
+        if src != dest:
+            neighbours[src].add(dest)
+
+    # The edges all have the same cost, so a breadth first search from
+    # each wanted vertex finds the shortest distance to everything it
+    # can reach, in O(n * (n + e)) time overall. Vertices outside the
+    # wanted set can still be part of a path.
+    wanted = set(vertices)
     answer = {}
     for v in vertices:
+        distances = {v: 0}
+        frontier = [v]
+        hops = 0
+        while frontier:
+            hops += 1
+            next_frontier = []
+            for u in frontier:
+                for dest in neighbours[u]:
+                    if dest not in distances:
+                        distances[dest] = hops
+                        next_frontier.append(dest)
+            frontier = next_frontier
+
         answer[v] = {}
-        for v2 in vertices:
-            a = distances[v].get(v2, inf)
-            if a < inf:
+        for v2, a in distances.iteritems():
+            if v2 in wanted:
                 answer[v][v2] = a
 
     return answer
@@ -21,12 +21,13 @@
 from samba.auth import system_session
 from samba.samdb import SamDB
 from samba import gensec, Ldb, drs_utils, arcfour_encrypt, string_to_byte_array
-import ldb, samba, sys, uuid
+import ldb, samba, sys, uuid, os, json
 from samba.ndr import ndr_pack, ndr_unpack
 from samba.dcerpc import security, drsuapi, misc, nbt, lsa, drsblobs, dnsserver, dnsp
 from samba.dsdb import DS_DOMAIN_FUNCTION_2003
 from samba.credentials import Credentials, DONT_USE_KERBEROS
 from samba.provision import secretsdb_self_join, provision, provision_fill, FILL_DRS, FILL_SUBDOMAIN
+from samba.provision import guess_names, provision_paths_from_lp
 from samba.provision.common import setup_path
 from samba.schema import Schema
 from samba import descriptor
@@ -43,6 +44,11 @@ import talloc
 import random
 import time
 
+# the replication progress of a resumable join is kept in this file in
+# the private dir, and is committed every CHECKPOINT_CHUNKS chunks
+JOIN_PROGRESS_FILE = "join_progress.json"
+CHECKPOINT_CHUNKS = 8
+
 class DCJoinException(Exception):
 
     def __init__(self, msg):
@@ -56,7 +62,8 @@ class dc_join(object):
                  netbios_name=None, targetdir=None, domain=None,
                  machinepass=None, use_ntvfs=False, dns_backend=None,
                  promote_existing=False, clone_only=False,
-                 plaintext_secrets=False):
+                 plaintext_secrets=False, pipeline_replication=False,
+                 resumable=False, resume=False):
         if site is None:
             site = "Default-First-Site-Name"
 
@@ -69,6 +76,10 @@ class dc_join(object):
         ctx.targetdir = targetdir
         ctx.use_ntvfs = use_ntvfs
         ctx.plaintext_secrets = plaintext_secrets
+        ctx.pipeline_replication = pipeline_replication
+        ctx.resume = resume
+        ctx.resumable = resumable or resume
+        ctx.progress = None
 
         ctx.promote_existing = promote_existing
         ctx.promote_from_dn = None
@@ -858,6 +869,168 @@ class dc_join(object):
         # Fix up the forestsid, it may be different if we are joining as a subdomain
         ctx.names.forestsid = ctx.forestsid
 
+    # attributes of the join that a resumed join must reuse, as they are
+    # already set on the remote DC or in the local SAM
+    progress_attributes = ["acct_pass", "key_version_number", "dnspass",
+                           "dns_key_version_number", "new_krbtgt_dn"]
+
+    def progress_path(ctx):
+        return os.path.join(ctx.paths.private_dir, JOIN_PROGRESS_FILE)
+
+    def save_progress(ctx):
+        """Write the progress of the join, replacing the old file
+        atomically. It holds the machine password, so it is only readable
+        by root, like secrets.ldb beside it."""
+        path = ctx.progress_path()
+        tmp_path = path + ".tmp"
+        f = os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                              0o600), 'w')
+        try:
+            json.dump(ctx.progress, f, indent=2, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(tmp_path, path)
+
+    def start_progress(ctx):
+        """Start recording the progress of a resumable join."""
+        ctx.progress = {
+            "server": ctx.server,
+            "invocation_id": str(ctx.invocation_id),
+            "source_dsa_invocation_id": None,
+            "done": [],
+            "current": None,
+        }
+        if ctx.ntds_guid is not None:
+            ctx.progress["ntds_guid"] = str(ctx.ntds_guid)
+        if getattr(ctx, "new_dc_account_sid", None) is not None:
+            ctx.progress["new_dc_account_sid"] = str(ctx.new_dc_account_sid)
+        for attr in ctx.progress_attributes:
+            if hasattr(ctx, attr):
+                ctx.progress[attr] = getattr(ctx, attr)
+        ctx.save_progress()
+
+    def join_resume(ctx):
+        """Reopen the local SAM of an interrupted join and restore the
+        state it was using, instead of provisioning a new one."""
+
+        if ctx.targetdir is not None:
+            smbconf = os.path.join(ctx.targetdir, "etc", "smb.conf")
+        else:
+            smbconf = ctx.lp.configfile
+        ctx.lp.load(smbconf)
+        ctx.names = guess_names(lp=ctx.lp, hostname=ctx.myname,
+                                domain=ctx.domain_name, dnsdomain=ctx.realm,
+                                serverrole="active directory domain controller",
+                                domaindn=ctx.base_dn, configdn=ctx.config_dn,
+                                schemadn=ctx.schema_dn, serverdn=ctx.server_dn,
+                                sitename=ctx.site, rootdn=ctx.root_dn,
+                                domain_names_forced=True)
+        ctx.paths = provision_paths_from_lp(ctx.lp, ctx.names.dnsdomain)
+        ctx.paths.bind_gid = None
+        ctx.paths.root_uid = None
+        ctx.paths.root_gid = None
+
+        path = ctx.progress_path()
+        try:
+            f = open(path, 'r')
+        except IOError:
+            raise DCJoinException("Can't resume the join, no join progress "
+                                  "was found at %s" % path)
+        try:
+            ctx.progress = json.load(f)
+        finally:
+            f.close()
+
+        if ctx.progress["server"] != ctx.server:
+            raise DCJoinException("The join being resumed was replicating "
+                                  "from %s, use --server=%s to resume it" %
+                                  (ctx.progress["server"],
+                                   ctx.progress["server"]))
+
+        ctx.invocation_id = misc.GUID(str(ctx.progress["invocation_id"]))
+        if "ntds_guid" in ctx.progress:
+            ctx.ntds_guid = misc.GUID(str(ctx.progress["ntds_guid"]))
+        if "new_dc_account_sid" in ctx.progress:
+            ctx.new_dc_account_sid = security.dom_sid(
+                str(ctx.progress["new_dc_account_sid"]))
+        for attr in ctx.progress_attributes:
+            if attr in ctx.progress:
+                setattr(ctx, attr, ctx.progress[attr])
+
+        print "Resuming join, reopening %s" % ctx.paths.samdb
+        ctx.local_samdb = SamDB(url=ctx.paths.samdb,
+                                session_info=system_session(), lp=ctx.lp)
+        ctx.names.domainsid = ctx.domsid
+        ctx.names.forestsid = ctx.forestsid
+        ctx.names.ntdsguid = str(ctx.local_samdb.get_ntds_GUID())
+
+    def commit_progress(ctx, step, highwatermark=None):
+        """Commit what has been replicated so far, and record that
+        step is done, or has been applied up to highwatermark."""
+
+        # The database is committed before the progress is written, so
+        # at worst a resumed join asks again for chunks it has already
+        # applied, which replicate as no-ops.
+        ctx.local_samdb.transaction_commit()
+        try:
+            if highwatermark is None:
+                ctx.progress["done"].append(step)
+                ctx.progress["current"] = None
+            else:
+                ctx.progress["current"] = {
+                    "step": step,
+                    "highwatermark": [highwatermark.tmp_highest_usn,
+                                      highwatermark.reserved_usn,
+                                      highwatermark.highest_usn]}
+            ctx.save_progress()
+        finally:
+            ctx.local_samdb.transaction_start()
+
+    def resume_highwatermark(ctx, step):
+        """Return the highwatermark an interrupted replication of step
+        was applied up to, or None."""
+        if ctx.progress is None:
+            return None
+        current = ctx.progress["current"]
+        if current is None or current["step"] != step:
+            return None
+        hwm = drsuapi.DsReplicaHighWaterMark()
+        (hwm.tmp_highest_usn,
+         hwm.reserved_usn,
+         hwm.highest_usn) = current["highwatermark"]
+        return hwm
+
+    def replicate_step(ctx, repl, nc, source_dsa_invocation_id,
+                       destination_dsa_guid, step=None, **kwargs):
+        """Replicate nc as one step of the join. In a resumable join,
+        steps already done are skipped, an interrupted step continues
+        from its last checkpoint, and progress is committed as it goes."""
+
+        if not ctx.resumable:
+            return repl.replicate(nc, source_dsa_invocation_id,
+                                  destination_dsa_guid, **kwargs)
+        if step is None:
+            step = nc
+        if step in ctx.progress["done"]:
+            print "Already replicated %s" % step
+            return
+
+        hwm = ctx.resume_highwatermark(step)
+        if hwm is not None:
+            print "Resuming %s from USN %d" % (step, hwm.tmp_highest_usn)
+
+        chunks = [0]
+        def checkpoint(highwatermark):
+            chunks[0] += 1
+            if chunks[0] % CHECKPOINT_CHUNKS == 0:
+                ctx.commit_progress(step, highwatermark)
+
+        repl.replicate(nc, source_dsa_invocation_id, destination_dsa_guid,
+                       highwatermark=hwm, checkpoint=checkpoint, **kwargs)
+        ctx.commit_progress(step)
+
     def join_provision_own_domain(ctx):
         """Provision the local SAM."""
 
@@ -903,8 +1076,19 @@ class dc_join(object):
 
         print "Starting replication"
         ctx.local_samdb.transaction_start()
+        dns_fetchers = {}
         try:
             source_dsa_invocation_id = misc.GUID(ctx.samdb.get_invocation_id())
+            if ctx.resumable:
+                # the highwatermarks of an interrupted join only mean
+                # anything to the same source DSA
+                previous = ctx.progress["source_dsa_invocation_id"]
+                if previous is None:
+                    ctx.progress["source_dsa_invocation_id"] = str(source_dsa_invocation_id)
+                elif previous != str(source_dsa_invocation_id):
+                    raise DCJoinException("The invocationId of %s has changed "
+                                          "since the join was interrupted, "
+                                          "it can't be resumed" % ctx.server)
             if ctx.ntds_guid is None:
                 print("Using DS_BIND_GUID_W2K3")
                 destination_dsa_guid = misc.GUID(drsuapi.DRSUAPI_DS_BIND_GUID_W2K3)
@@ -925,12 +1109,31 @@ class dc_join(object):
                 binding_options += ",print"
             repl = drs_utils.drs_Replicate(
                 "ncacn_ip_tcp:%s[%s]" % (ctx.server, binding_options),
-                ctx.lp, repl_creds, ctx.local_samdb, ctx.invocation_id)
-
-            repl.replicate(ctx.schema_dn, source_dsa_invocation_id,
+                ctx.lp, repl_creds, ctx.local_samdb, ctx.invocation_id,
+                pipeline=ctx.pipeline_replication,
+                adaptive_chunks=ctx.pipeline_replication)
+
+            # The DNS partitions don't depend on the others, so with
+            # pipelining we start fetching them now, over their own DRS
+            # connections. They are still applied after the base NCs,
+            # as everything goes into one transaction.
+            if ctx.pipeline_replication:
+                for nc in (ctx.domaindns_zone, ctx.forestdns_zone):
+                    if ctx.progress is not None and (
+                            nc in ctx.progress["done"] or
+                            ctx.resume_highwatermark(nc) is not None):
+                        continue
+                    if nc in ctx.nc_list:
+                        print "Fetching %s in the background" % (str(nc))
+                        dns_fetchers[nc] = repl.prefetch(
+                            nc, source_dsa_invocation_id,
+                            destination_dsa_guid, rodc=ctx.RODC,
+                            replica_flags=ctx.replica_flags)
+
+            ctx.replicate_step(repl, ctx.schema_dn, source_dsa_invocation_id,
                     destination_dsa_guid, schema=True, rodc=ctx.RODC,
                     replica_flags=ctx.replica_flags)
-            repl.replicate(ctx.config_dn, source_dsa_invocation_id,
+            ctx.replicate_step(repl, ctx.config_dn, source_dsa_invocation_id,
                     destination_dsa_guid, rodc=ctx.RODC,
                     replica_flags=ctx.replica_flags)
             if not ctx.subdomain:
@@ -938,11 +1141,12 @@ class dc_join(object):
                 if not ctx.domain_replica_flags & drsuapi.DRSUAPI_DRS_CRITICAL_ONLY:
                     print "Replicating critical objects from the base DN of the domain"
                     ctx.domain_replica_flags |= drsuapi.DRSUAPI_DRS_CRITICAL_ONLY
-                    repl.replicate(ctx.base_dn, source_dsa_invocation_id,
+                    ctx.replicate_step(repl, ctx.base_dn, source_dsa_invocation_id,
                                 destination_dsa_guid, rodc=ctx.RODC,
-                                replica_flags=ctx.domain_replica_flags)
+                                replica_flags=ctx.domain_replica_flags,
+                                step="critical objects of %s" % ctx.base_dn)
                     ctx.domain_replica_flags ^= drsuapi.DRSUAPI_DRS_CRITICAL_ONLY
-                repl.replicate(ctx.base_dn, source_dsa_invocation_id,
+                ctx.replicate_step(repl, ctx.base_dn, source_dsa_invocation_id,
                                destination_dsa_guid, rodc=ctx.RODC,
                                replica_flags=ctx.domain_replica_flags)
             print "Done with always replicated NC (base, config, schema)"
@@ -953,9 +1157,10 @@ class dc_join(object):
             for nc in (ctx.domaindns_zone, ctx.forestdns_zone):
                 if nc in ctx.nc_list:
                     print "Replicating %s" % (str(nc))
-                    repl.replicate(nc, source_dsa_invocation_id,
+                    ctx.replicate_step(repl, nc, source_dsa_invocation_id,
                                     destination_dsa_guid, rodc=ctx.RODC,
-                                    replica_flags=ctx.replica_flags)
+                                    replica_flags=ctx.replica_flags,
+                                    fetcher=dns_fetchers.pop(nc, None))
 
             if ctx.RODC:
                 repl.replicate(ctx.acct_dn, source_dsa_invocation_id,
@@ -967,9 +1172,13 @@ class dc_join(object):
             elif ctx.rid_manager_dn != None:
                 # Try and get a RID Set if we can.  This is only possible against the RID Master.  Warn otherwise.
                 try:
-                    repl.replicate(ctx.rid_manager_dn, source_dsa_invocation_id,
+                    # as a step of its own, so a resumed join does
+                    # not allocate a second RID pool
+                    ctx.replicate_step(repl, ctx.rid_manager_dn,
+                                   source_dsa_invocation_id,
                                    destination_dsa_guid,
-                                   exop=drsuapi.DRSUAPI_EXOP_FSMO_RID_ALLOC)
+                                   exop=drsuapi.DRSUAPI_EXOP_FSMO_RID_ALLOC,
+                                   step="RID Set")
                 except samba.DsExtendedError as e1:
                     (enum, estr) = e1.args
                     if enum == drsuapi.DRSUAPI_EXOP_ERR_FSMO_NOT_OWNER:
@@ -984,6 +1193,8 @@ class dc_join(object):
 
             print "Committing SAM database"
         except:
+            for fetcher in dns_fetchers.values():
+                fetcher.close()
             ctx.local_samdb.transaction_cancel()
             raise
         else:
@@ -1376,16 +1587,21 @@ class dc_join(object):
                 ctx.full_nc_list += [ctx.domaindns_zone]
                 ctx.full_nc_list += [ctx.forestdns_zone]
 
-        if not ctx.clone_only:
+        if ctx.resume:
+            ctx.join_resume()
+        elif not ctx.clone_only:
             if ctx.promote_existing:
                 ctx.promote_possible()
             else:
                 ctx.cleanup_old_join()
 
         try:
-            if not ctx.clone_only:
-                ctx.join_add_objects()
-            ctx.join_provision()
+            if not ctx.resume:
+                if not ctx.clone_only:
+                    ctx.join_add_objects()
+                ctx.join_provision()
+                if ctx.resumable:
+                    ctx.start_progress()
             ctx.join_replicate()
             if (not ctx.clone_only and ctx.subdomain):
                 ctx.join_add_objects2()
@@ -1398,6 +1614,14 @@ class dc_join(object):
 
             ctx.join_finalise()
         except:
+            if ctx.progress is not None:
+                # keep the objects on the remote DC, and what has been
+                # replicated so far, for the join to be resumed
+                try:
+                    print "Join failed - run the same command again with --resume to continue it"
+                except IOError:
+                    pass
+                raise
             try:
                 print "Join failed - cleaning up"
             except IOError:
@@ -1406,16 +1630,22 @@ class dc_join(object):
                 ctx.cleanup_old_join()
             raise
 
+        if ctx.progress is not None:
+            os.unlink(ctx.progress_path())
+
 
 def join_RODC(logger=None, server=None, creds=None, lp=None, site=None, netbios_name=None,
               targetdir=None, domain=None, domain_critical_only=False,
               machinepass=None, use_ntvfs=False, dns_backend=None,
-              promote_existing=False, plaintext_secrets=False):
+              promote_existing=False, plaintext_secrets=False,
+              pipeline_replication=False, resumable=False, resume=False):
     """Join as a RODC."""
 
     ctx = dc_join(logger, server, creds, lp, site, netbios_name, targetdir, domain,
                   machinepass, use_ntvfs, dns_backend, promote_existing,
-                  plaintext_secrets)
+                  plaintext_secrets=plaintext_secrets,
+                  pipeline_replication=pipeline_replication,
+                  resumable=resumable, resume=resume)
 
     lp.set("workgroup", ctx.domain_name)
     logger.info("workgroup is %s" % ctx.domain_name)
@@ -1462,11 +1692,14 @@ def join_RODC(logger=None, server=None, creds=None, lp=None, site=None, netbios_
 def join_DC(logger=None, server=None, creds=None, lp=None, site=None, netbios_name=None,
             targetdir=None, domain=None, domain_critical_only=False,
             machinepass=None, use_ntvfs=False, dns_backend=None,
-            promote_existing=False, plaintext_secrets=False):
+            promote_existing=False, plaintext_secrets=False,
+            pipeline_replication=False, resumable=False, resume=False):
     """Join as a DC."""
     ctx = dc_join(logger, server, creds, lp, site, netbios_name, targetdir, domain,
                   machinepass, use_ntvfs, dns_backend, promote_existing,
-                  plaintext_secrets)
+                  plaintext_secrets=plaintext_secrets,
+                  pipeline_replication=pipeline_replication,
+                  resumable=resumable, resume=resume)
 
     lp.set("workgroup", ctx.domain_name)
     logger.info("workgroup is %s" % ctx.domain_name)
@@ -1489,10 +1722,12 @@ def join_DC(logger=None, server=None, creds=None, lp=None, site=None, netbios_na
     logger.info("Joined domain %s (SID %s) as a DC" % (ctx.domain_name, ctx.domsid))
 
 def join_clone(logger=None, server=None, creds=None, lp=None,
-               targetdir=None, domain=None, include_secrets=False):
+               targetdir=None, domain=None, include_secrets=False,
+               resumable=False, resume=False):
     """Join as a DC."""
     ctx = dc_join(logger, server, creds, lp, site=None, netbios_name=None, targetdir=targetdir, domain=domain,
-                  machinepass=None, use_ntvfs=False, dns_backend="NONE", promote_existing=False, clone_only=True)
+                  machinepass=None, use_ntvfs=False, dns_backend="NONE", promote_existing=False, clone_only=True,
+                  resumable=resumable, resume=resume)
 
     lp.set("workgroup", ctx.domain_name)
     logger.info("workgroup is %s" % ctx.domain_name)
@@ -21,8 +21,10 @@
 
 import random
 import uuid
+import time
 
 import itertools
+from contextlib import contextmanager
 from samba import unix2nttime, nttime2unix
 from samba import ldb, dsdb, drs_utils
 from samba.auth import system_session
@@ -141,6 +143,37 @@ class KCC(object):
         self.debug = debug
         self.dot_file_dir = dot_file_dir
 
+        # (phase name, seconds) for each phase of run()
+        self.phase_times = []
+
+    @contextmanager
+    def timed_phase(self, name):
+        """Record the time spent in a phase of the KCC run
+
+        :param name: the name of the phase
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.phase_times.append((name, time.time() - start))
+
+    def profile_summary(self):
+        """Describe the time spent in each phase of the last run
+
+        :return: a list of lines of text
+        """
+        total = sum(t for name, t in self.phase_times)
+        lines = []
+        for name, t in self.phase_times:
+            if total:
+                share = 100.0 * t / total
+            else:
+                share = 0
+            lines.append("%-10s %9.3fs %5.1f%%" % (name, t, share))
+        lines.append("%-10s %9.3fs" % ('total', total))
+        return lines
+
     def load_ip_transport(self):
         """Loads the inter-site transport objects for Sites
 
@@ -2550,15 +2583,17 @@ class KCC(object):
             self.samdb.set_ntds_settings_dn("CN=NTDS Settings,%s" %
                                             forced_local_dsa)
 
+        self.phase_times = []
         try:
             # Setup
-            self.load_my_site()
-            self.load_my_dsa()
+            with self.timed_phase('load'):
+                self.load_my_site()
+                self.load_my_dsa()
 
-            self.load_all_sites()
-            self.load_all_partitions()
-            self.load_ip_transport()
-            self.load_all_sitelinks()
+                self.load_all_sites()
+                self.load_all_partitions()
+                self.load_ip_transport()
+                self.load_all_sitelinks()
 
             if self.verify or self.dot_file_dir is not None:
                 guid_to_dnstr = {}
@@ -2641,25 +2676,29 @@ class KCC(object):
             # MS-TECH description of the KCC algorithm ([MS-ADTS] 6.2.2)
 
             # Step 1
-            self.refresh_failed_links_connections(ping)
+            with self.timed_phase('refresh'):
+                self.refresh_failed_links_connections(ping)
 
             # Step 2
-            self.intrasite()
+            with self.timed_phase('intrasite'):
+                self.intrasite()
 
             # Step 3
-            all_connected = self.intersite(ping)
+            with self.timed_phase('intersite'):
+                all_connected = self.intersite(ping)
 
-            # Step 4
-            self.remove_unneeded_ntdsconn(all_connected)
+            with self.timed_phase('commit'):
+                # Step 4
+                self.remove_unneeded_ntdsconn(all_connected)
 
-            # Step 5
-            self.translate_ntdsconn()
+                # Step 5
+                self.translate_ntdsconn()
 
-            # Step 6
-            self.remove_unneeded_failed_links_connections()
+                # Step 6
+                self.remove_unneeded_failed_links_connections()
 
-            # Step 7
-            self.update_rodc_connection()
+                # Step 7
+                self.update_rodc_connection()
 
             if self.verify or self.dot_file_dir is not None:
                 self.plot_all_connections('dsa_final',
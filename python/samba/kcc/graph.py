@@ -54,6 +54,10 @@ class ReplInfo(object):
         self.duration = total_schedule(self.schedule)
 
 
+# the number of bits set in each possible byte
+BIT_COUNTS = [bin(i).count('1') for i in range(256)]
+
+
 def total_schedule(schedule):
     """Return the total number of 15 minute windows in which the schedule
     is set to replicate in a week. If the schedule is None it is
@@ -66,12 +70,7 @@ def total_schedule(schedule):
     if schedule is None:
         return 84 * 8  # 84 bytes = 84 * 8 bits
 
-    total = 0
-    for byte in schedule:
-        while byte != 0:
-            total += byte & 1
-            byte >>= 1
-    return total
+    return sum([BIT_COUNTS[byte] for byte in schedule])
 
 
 def convert_schedule_to_repltimes(schedule):
@@ -363,7 +362,14 @@ def dijkstra(graph, edge_type, include_black):
     """
     queue = setup_dijkstra(graph, edge_type, include_black)
     while len(queue) > 0:
-        cost, guid, vertex = heapq.heappop(queue)
+        entry = heapq.heappop(queue)
+        cost, guid, vertex = entry
+        # A vertex is in the queue at most once, as in the spec. When
+        # its cost changes try_new_path() pushes a new entry rather
+        # than moving the old one, so any other entry is stale.
+        if vertex.queue_entry is not entry:
+            continue
+        vertex.queue_entry = None
         for edge in vertex.edges:
             for v in edge.vertices:
                 if v is not vertex:
@@ -382,6 +388,7 @@ def setup_dijkstra(graph, edge_type, include_black):
     queue = []
     setup_vertices(graph)
     for vertex in graph.vertices:
+        vertex.queue_entry = None
         if vertex.is_white():
             continue
 
@@ -392,11 +399,24 @@ def setup_dijkstra(graph, edge_type, include_black):
             vertex.root = None  # NULL GUID
             vertex.demoted = True  # Demoted appears not to be used
         else:
-            heapq.heappush(queue, (vertex.repl_info.cost, vertex.guid, vertex))
+            push_vertex(queue, vertex)
 
     return queue
 
 
+def push_vertex(queue, vertex):
+    """Add a vertex to the Dijkstra's queue, replacing any entry it
+    already has there.
+
+    :param queue: a heap queue of vertices
+    :param vertex: the Vertex to add
+    :return: None
+    """
+    entry = (vertex.repl_info.cost, vertex.guid, vertex)
+    vertex.queue_entry = entry
+    heapq.heappush(queue, entry)
+
+
 def try_new_path(graph, queue, vfrom, edge, vto):
     """Helper function for Dijksta's algorithm.
 
@@ -416,7 +436,7 @@ def try_new_path(graph, queue, vfrom, edge, vto):
         vto.root = vfrom.root
         vto.component_id = vfrom.component_id
         vto.repl_info = new_repl_info
-        heapq.heappush(queue, (vto.repl_info.cost, vto.guid, vto))
+        push_vertex(queue, vto)
 
 
 def check_demote_vertex(vertex, edge_type):
@@ -572,8 +592,13 @@ def kruskal(graph, edges):
     components = set([x for x in graph.vertices if not x.is_white()])
     edges = list(edges)
 
-    # Sorted based on internal comparison function of internal edge
-    edges.sort()
+    # Sorted in the order of InternalEdge comparisons, but with
+    # precomputed keys rather than pairwise __lt__() calls.
+    edges.sort(key=InternalEdge.sort_key)
+
+    # The number of vertices in the tree under each component root,
+    # so the smaller tree can be joined to the larger.
+    sizes = {}
 
     #XXX expected_num_tree_edges is never used
     expected_num_tree_edges = 0  # TODO this value makes little sense
@@ -588,7 +613,12 @@ def kruskal(graph, edges):
         if parent1 is not parent2:
             count_edges += 1
             add_out_edge(graph, output_edges, e)
+            size1 = sizes.get(parent1, 1)
+            size2 = sizes.get(parent2, 1)
+            if size1 > size2:
+                parent1, parent2 = parent2, parent1
             parent1.component_id = parent2
+            sizes[parent2] = size1 + size2
             components.discard(parent1)
 
         index += 1
@@ -722,6 +752,8 @@ class Vertex(object):
         self.demoted = False
         self.options = 0
         self.interval = 0
+        # the entry for this vertex in the Dijkstra's queue, if any
+        self.queue_entry = None
 
     def color_vertex(self):
         """Color to indicate which kind of NC replica the vertex contains
@@ -822,6 +854,11 @@ class InternalEdge(object):
 
     def __lt__(self, other):
         """Here "less than" means "better".
+        """
+        return self.sort_key() < other.sort_key()
+
+    def sort_key(self):
+        """A tuple that sorts the better edges first.
 
         From within MS-ADTS 6.2.2.3.4.4:
 
@@ -832,19 +869,9 @@ class InternalEdge(object):
                                ascending V2ID,
                                ascending Type)
         """
-        if self.red_red != other.red_red:
-            return self.red_red
-
-        if self.repl_info.cost != other.repl_info.cost:
-            return self.repl_info.cost < other.repl_info.cost
-
-        if self.repl_info.duration != other.repl_info.duration:
-            return self.repl_info.duration > other.repl_info.duration
-
-        if self.v1.guid != other.v1.guid:
-            return self.v1.ndrpacked_guid < other.v1.ndrpacked_guid
-
-        if self.v2.guid != other.v2.guid:
-            return self.v2.ndrpacked_guid < other.v2.ndrpacked_guid
-
-        return self.e_type < other.e_type
+        return (not self.red_red,
+                self.repl_info.cost,
+                -self.repl_info.duration,
+                self.v1.ndrpacked_guid,
+                self.v2.ndrpacked_guid,
+                self.e_type)
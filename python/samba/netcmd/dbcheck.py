@@ -16,7 +16,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-import ldb, sys
+import ldb, sys, os, time
 import samba.getopt as options
 from samba.auth import system_session
 from samba.samdb import SamDB
@@ -72,6 +72,14 @@ class cmd_dbcheck(Command):
         Option("--reindex", dest="reindex", default=False, action="store_true", help="force database re-index"),
         Option("--force-modules", dest="force_modules", default=False, action="store_true", help="force loading of Samba modules and ignore the @MODULES record (for very old databases)"),
         Option("--reset-well-known-acls", dest="reset_well_known_acls", default=False, action="store_true", help="reset ACLs on objects with well known default ACL values to the default"),
+        Option("--jobs", dest="jobs", default=1, type=int,
+               help="number of worker processes checking objects in parallel (default 1)"),
+        Option("--batch-size", dest="batch_size", default=0, type=int,
+               help="load objects to check this many at a time, rather than with one search each (default 0, meaning one search each)"),
+        Option("--incremental", dest="incremental", default=False, action="store_true",
+               help="only check objects changed (or linked to objects changed) since the last error-free incremental check"),
+        Option("--profile", dest="profile", default=False, action="store_true",
+               help="print the time taken and a summary of schema lookups"),
         Option("-H", "--URL", help="LDB URL for database or target server (defaults to local SAM database)",
                type=str, metavar="URL", dest="H"),
         ]
@@ -80,7 +88,8 @@ class cmd_dbcheck(Command):
             cross_ncs=False, quiet=False,
             scope="SUB", credopts=None, sambaopts=None, versionopts=None,
             attrs=None, reindex=False, force_modules=False,
-            reset_well_known_acls=False, yes_rules=[]):
+            reset_well_known_acls=False, yes_rules=[], jobs=1,
+            batch_size=0, incremental=False, profile=False):
 
         lp = sambaopts.get_loadparm()
 
@@ -91,22 +100,45 @@ class cmd_dbcheck(Command):
         else:
             creds = None
 
-        if force_modules:
-            samdb = SamDB(session_info=system_session(), url=H,
-                          credentials=creds, lp=lp, options=["modules=samba_dsdb"])
-        else:
-            try:
+        def connect_samdb():
+            if force_modules:
                 samdb = SamDB(session_info=system_session(), url=H,
-                              credentials=creds, lp=lp)
-            except:
-                raise CommandError("Failed to connect to DB at %s.  If this is a really old sam.ldb (before alpha9), then try again with --force-modules" % H)
+                              credentials=creds, lp=lp, options=["modules=samba_dsdb"])
+            else:
+                try:
+                    samdb = SamDB(session_info=system_session(), url=H,
+                                  credentials=creds, lp=lp)
+                except:
+                    raise CommandError("Failed to connect to DB at %s.  If this is a really old sam.ldb (before alpha9), then try again with --force-modules" % H)
+
+            if H is None or not over_ldap:
+                samdb_schema = samdb
+            else:
+                samdb_schema = SamDB(session_info=system_session(), url=None,
+                                     credentials=creds, lp=lp)
+            return samdb, samdb_schema
+
+        if jobs < 1:
+            raise CommandError("--jobs must be at least 1")
+        if batch_size < 0:
+            raise CommandError("--batch-size must not be negative")
+        if incremental:
+            if DN is not None or scope.upper() != "SUB":
+                raise CommandError("--incremental checks whole naming contexts, a DN or --scope can not be given")
+            if jobs > 1:
+                raise CommandError("--incremental can not be combined with --jobs")
+            if over_ldap:
+                raise CommandError("--incremental needs a local database")
+            if H is None:
+                sam_path = lp.samdb_url()
+            else:
+                sam_path = H
+            if sam_path.startswith("tdb://"):
+                sam_path = sam_path[len("tdb://"):]
+            usn_db = os.path.join(os.path.dirname(os.path.abspath(sam_path)),
+                                  "dbcheck_usn.tdb")
 
-
-        if H is None or not over_ldap:
-            samdb_schema = samdb
-        else:
-            samdb_schema = SamDB(session_info=system_session(), url=None,
-                                 credentials=creds, lp=lp)
+        samdb, samdb_schema = connect_samdb()
 
         scope_map = { "SUB": ldb.SCOPE_SUBTREE, "BASE": ldb.SCOPE_BASE, "ONE":ldb.SCOPE_ONELEVEL }
         scope = scope.upper()
@@ -125,10 +157,15 @@ class cmd_dbcheck(Command):
         else:
             attrs = attrs.split()
 
+        start = time.time()
+        parallel = jobs > 1 and not (reindex or force_modules or incremental)
         started_transaction = False
-        if yes and fix:
+        # the parallel check forks workers reading the same database
+        # files, so it starts the transaction itself once they are done
+        if yes and fix and not parallel:
             samdb.transaction_start()
             started_transaction = True
+        chk = None
         try:
             chk = dbcheck(samdb, samdb_schema=samdb_schema, verbose=verbose,
                           fix=fix, yes=yes, quiet=quiet, in_transaction=started_transaction,
@@ -152,16 +189,33 @@ class cmd_dbcheck(Command):
                 if chk.reset_modules():
                     self.outf.write("completed @MODULES reset OK\n")
 
+            elif incremental:
+                error_count = chk.check_database_incremental(usn_db,
+                        attrs=attrs, batch_size=batch_size)
+
+            elif parallel:
+                error_count = chk.check_database_parallel(connect_samdb, jobs,
+                        DN=DN, scope=search_scope, controls=controls,
+                        attrs=attrs, batch_size=batch_size,
+                        transaction=(yes and fix))
+
             else:
                 error_count = chk.check_database(DN=DN, scope=search_scope,
-                        controls=controls, attrs=attrs)
+                        controls=controls, attrs=attrs, batch_size=batch_size)
         except:
+            if chk is not None:
+                started_transaction = chk.in_transaction
             if started_transaction:
                 samdb.transaction_cancel()
             raise
 
-        if started_transaction:
+        if chk.in_transaction:
             samdb.transaction_commit()
 
+        if profile:
+            self.outf.write("dbcheck took %.3fs\n" % (time.time() - start))
+            for line in chk.schema_index.profile_summary():
+                self.outf.write(line + "\n")
+
         if error_count != 0:
             sys.exit(1)
@@ -86,6 +86,7 @@ from samba.dsdb import (
 
 from samba.provision import (
     provision,
+    provision_from_template,
     ProvisioningError,
     DEFAULT_MIN_PWD_LENGTH,
     setup_path
@@ -251,6 +252,14 @@ class cmd_domain_provision(Command):
                 help="Configure Samba's partitions, but do not modify them (ie, join a BDC)", action="store_true"),
          Option("--targetdir", type="string", metavar="DIR",
                 help="Set target directory"),
+         Option("--template", type="string", metavar="DIR",
+                help="Create a new domain in --targetdir by copying the "
+                     "provision in DIR (the --targetdir of an earlier "
+                     "provision that is not in use) and giving it a new "
+                     "domain SID, GUIDs and secrets.  --realm, --domain, "
+                     "--host-name and --host-ip rename the copy.  Only "
+                     "the ldb backend and the SAMBA_INTERNAL or NONE DNS "
+                     "backends are supported"),
          Option("--ol-mmr-urls", type="string", metavar="LDAPSERVER",
                 help="List of LDAP-URLS [ ldap://<FQHN>:<PORT>/  (where <PORT> has to be different than 389!) ] separated with comma (\",\") for use with OpenLDAP-MMR (Multi-Master-Replication), e.g.: \"ldap://s4dc1:9000,ldap://s4dc2:9000\""),
          Option("--use-rfc2307", action="store_true", help="Use AD to store posix attributes (default = no)"),
@@ -317,6 +326,7 @@ class cmd_domain_provision(Command):
             next_rid=None,
             partitions_only=None,
             targetdir=None,
+            template=None,
             ol_mmr_urls=None,
             use_xattrs="auto",
             slapd_path=None,
@@ -335,6 +345,27 @@ class cmd_domain_provision(Command):
         else:
             self.logger.setLevel(logging.INFO)
 
+        if template is not None:
+            if targetdir is None:
+                raise CommandError("--template requires --targetdir")
+            if adminpass:
+                issue = self._adminpass_issue(adminpass)
+                if issue:
+                    raise CommandError(issue)
+            try:
+                result = provision_from_template(
+                    self.logger, system_session(), template, targetdir,
+                    realm=sambaopts._lp.get('realm') or None, domain=domain,
+                    hostname=host_name, domainsid=domain_sid,
+                    adminpass=adminpass, krbtgtpass=krbtgtpass,
+                    machinepass=machinepass, invocationid=invocationid,
+                    hostip=host_ip, hostip6=host_ip6, use_ntvfs=use_ntvfs,
+                    skip_sysvolacl=False)
+            except ProvisioningError as e:
+                raise CommandError("Provision from template failed", e)
+            result.report_logger(self.logger)
+            return
+
         lp = sambaopts.get_loadparm()
         smbconf = lp.configfile
 
@@ -653,6 +684,17 @@ class cmd_domain_join(Command):
         Option("--plaintext-secrets", action="store_true",
                help="Store secret/sensitive values as plain text on disk" +
                     "(default is to encrypt secret/ensitive values)"),
+        Option("--pipeline-replication", action="store_true",
+               help="When joining as a DC or RODC, fetch replication chunks "
+                    "in the background while applying earlier ones, fetch "
+                    "the DNS partitions concurrently, and adapt the chunk "
+                    "size to the server"),
+        Option("--resumable", action="store_true",
+               help="When joining as a DC or RODC, commit the replicated "
+                    "objects as the join goes, so that it can be continued "
+                    "with --resume if it is interrupted"),
+        Option("--resume", action="store_true",
+               help="Continue an interrupted --resumable join"),
         Option("--quiet", help="Be quiet", action="store_true"),
         Option("--verbose", help="Be verbose", action="store_true")
        ]
@@ -670,7 +712,8 @@ class cmd_domain_join(Command):
             versionopts=None, server=None, site=None, targetdir=None,
             domain_critical_only=False, parent_domain=None, machinepass=None,
             use_ntvfs=False, dns_backend=None, adminpass=None,
-            quiet=False, verbose=False, plaintext_secrets=False):
+            quiet=False, verbose=False, plaintext_secrets=False,
+            pipeline_replication=False, resumable=False, resume=False):
         lp = sambaopts.get_loadparm()
         creds = credopts.get_credentials(lp)
         net = Net(creds, lp, server=credopts.ipaddress)
@@ -691,6 +734,10 @@ class cmd_domain_join(Command):
         if not role is None:
             role = role.upper()
 
+        if (resumable or resume) and role not in ("DC", "RODC"):
+            raise CommandError("--resumable and --resume are only supported "
+                               "when joining as a DC or RODC")
+
         if role is None or role == "MEMBER":
             (join_password, sid, domain_name) = net.join_member(
                 domain, netbios_name, LIBNET_JOIN_AUTOMATIC,
@@ -703,14 +750,18 @@ class cmd_domain_join(Command):
                     domain_critical_only=domain_critical_only,
                     machinepass=machinepass, use_ntvfs=use_ntvfs,
                     dns_backend=dns_backend,
-                    plaintext_secrets=plaintext_secrets)
+                    plaintext_secrets=plaintext_secrets,
+                    pipeline_replication=pipeline_replication,
+                    resumable=resumable, resume=resume)
         elif role == "RODC":
             join_RODC(logger=logger, server=server, creds=creds, lp=lp, domain=domain,
                       site=site, netbios_name=netbios_name, targetdir=targetdir,
                       domain_critical_only=domain_critical_only,
                       machinepass=machinepass, use_ntvfs=use_ntvfs,
                       dns_backend=dns_backend,
-                      plaintext_secrets=plaintext_secrets)
+                      plaintext_secrets=plaintext_secrets,
+                      pipeline_replication=pipeline_replication,
+                      resumable=resumable, resume=resume)
         elif role == "SUBDOMAIN":
             if not adminpass:
                 logger.info("Administrator password will be set randomly!")
@@ -3796,10 +3847,20 @@ class cmd_domain_trust_namespaces(DomainTrustCommand):
                                      tln=local_tdo_info.domain_name.string)
         return
 
+DEFAULT_EXPUNGE_BATCH_SIZE = 1000
+
+
 class cmd_domain_tombstones_expunge(Command):
     """Expunge tombstones from the database.
 
-This command expunges tombstones from the database."""
+This command expunges tombstones from the database.
+
+By default everything is expunged in a single transaction.  On a large
+database --batch-size splits the work into transactions of at most that
+many objects, reporting progress after each one, and --rate-limit
+additionally spreads the work out to keep the load on a live DC down.
+A batched run may be interrupted at any point and simply run again
+later: completed batches stay expunged."""
     synopsis = "%prog NC [NC [...]] [options]"
 
     takes_options = [
@@ -3809,6 +3870,12 @@ This command expunges tombstones from the database."""
                 help="The current time to evaluate the tombstone lifetime from, expressed as YYYY-MM-DD",
                 type=str),
         Option("--tombstone-lifetime", help="Number of days a tombstone should be preserved for", type=int),
+        Option("--batch-size",
+                help="Expunge at most this many objects per transaction (default: all at once)",
+                type=int),
+        Option("--rate-limit",
+                help="Expunge at most this many objects and links per second (implies --batch-size=%d)" % DEFAULT_EXPUNGE_BATCH_SIZE,
+                type=float),
     ]
 
     takes_args = ["nc*"]
@@ -3826,6 +3893,8 @@ This command expunges tombstones from the database."""
         H = kwargs.get("H")
         current_time_string = kwargs.get("current_time")
         tombstone_lifetime = kwargs.get("tombstone_lifetime")
+        batch_size = kwargs.get("batch_size")
+        rate_limit = kwargs.get("rate_limit")
         lp = sambaopts.get_loadparm()
         creds = credopts.get_credentials(lp)
         samdb = SamDB(url=H, session_info=system_session(),
@@ -3848,6 +3917,17 @@ This command expunges tombstones from the database."""
         else:
             ncs = list(ncs)
 
+        if batch_size is not None or rate_limit is not None:
+            if batch_size is None:
+                batch_size = DEFAULT_EXPUNGE_BATCH_SIZE
+            if batch_size < 1:
+                raise CommandError("--batch-size must be at least 1")
+            if rate_limit is not None and rate_limit <= 0:
+                raise CommandError("--rate-limit must be greater than 0")
+            self.expunge_batched(samdb, ncs, current_time, tombstone_lifetime,
+                                 batch_size, rate_limit)
+            return
+
         started_transaction = False
         try:
             samdb.transaction_start()
@@ -3867,6 +3947,52 @@ This command expunges tombstones from the database."""
         self.outf.write("Removed %d objects and %d links successfully\n"
                         % (removed_objects, removed_links))
 
+    def expunge_batched(self, samdb, ncs, current_time, tombstone_lifetime,
+                        batch_size, rate_limit):
+        removed_objects = 0
+        removed_links = 0
+        num_skipped = 0
+        start = time.time()
+        try:
+            batches = samdb.garbage_collect_tombstones_batched(ncs,
+                                        current_time=current_time,
+                                        tombstone_lifetime=tombstone_lifetime,
+                                        batch_size=batch_size)
+            for (num_objects, num_links, skipped) in batches:
+                removed_objects += num_objects
+                removed_links += num_links
+                num_skipped += len(skipped)
+                for (dn, estr) in skipped:
+                    self.errf.write("Failed to expunge %s, skipping: %s\n"
+                                    % (dn, estr))
+
+                elapsed = max(time.time() - start, 0.001)
+                self.outf.write("Removed %d objects and %d links so far "
+                                "(%.1f objects/s, %.1f links/s)\n"
+                                % (removed_objects, removed_links,
+                                   removed_objects / elapsed,
+                                   removed_links / elapsed))
+                self.outf.flush()
+
+                if rate_limit is not None:
+                    due = (removed_objects + removed_links) / rate_limit
+                    if due > elapsed:
+                        time.sleep(due - elapsed)
+
+        except Exception as err:
+            raise CommandError("Failed to expunge / garbage collect tombstones "
+                               "after removing %d objects and %d links; "
+                               "the command may be safely re-run"
+                               % (removed_objects, removed_links), err)
+
+        if num_skipped > 0:
+            self.outf.write("Removed %d objects and %d links, skipped %d "
+                            "objects that could not be expunged\n"
+                            % (removed_objects, removed_links, num_skipped))
+            return
+
+        self.outf.write("Removed %d objects and %d links successfully\n"
+                        % (removed_objects, removed_links))
 
 
 class cmd_domain_trust(SuperCommand):
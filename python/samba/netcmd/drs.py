@@ -639,6 +639,12 @@ class cmd_drs_clone_dc_database(Command):
         Option("--targetdir", help="where to store provision (required)", type=str),
         Option("--quiet", help="Be quiet", action="store_true"),
         Option("--include-secrets", help="Also replicate secret values", action="store_true"),
+        Option("--resumable", action="store_true",
+               help="Commit the replicated objects as the clone goes, so "
+                    "that it can be continued with --resume if it is "
+                    "interrupted"),
+        Option("--resume", action="store_true",
+               help="Continue an interrupted --resumable clone"),
         Option("--verbose", help="Be verbose", action="store_true")
        ]
 
@@ -646,7 +652,8 @@ class cmd_drs_clone_dc_database(Command):
 
     def run(self, domain, sambaopts=None, credopts=None,
             versionopts=None, server=None, targetdir=None,
-            quiet=False, verbose=False, include_secrets=False):
+            quiet=False, verbose=False, include_secrets=False,
+            resumable=False, resume=False):
         lp = sambaopts.get_loadparm()
         creds = credopts.get_credentials(lp)
 
@@ -663,7 +670,8 @@ class cmd_drs_clone_dc_database(Command):
 
 
         join_clone(logger=logger, server=server, creds=creds, lp=lp, domain=domain,
-                   targetdir=targetdir, include_secrets=include_secrets)
+                   targetdir=targetdir, include_secrets=include_secrets,
+                   resumable=resumable, resume=resume)
 
 
 class cmd_drs(SuperCommand):
@@ -20,6 +20,11 @@
 #
 
 import os
+import sys
+import json
+import shutil
+import hashlib
+import traceback
 import samba.getopt as options
 import ldb
 
@@ -232,11 +237,106 @@ def parse_unc(unc):
     raise ValueError("Invalid UNC string: %s" % unc)
 
 
-def copy_directory_remote_to_local(conn, remotedir, localdir):
+# files are copied over SMB this many bytes at a time, rather than
+# being held in memory whole
+SMB_CHUNK_SIZE = 1024 * 1024
+
+
+def copy_file_remote_to_local(conn, r_name, l_name):
+    fnum = conn.open_file(r_name, security.SEC_RIGHTS_FILE_READ)
+    try:
+        f = open(l_name, 'wb')
+        try:
+            offset = 0
+            while True:
+                data = conn.read_file(fnum, offset, SMB_CHUNK_SIZE)
+                f.write(data)
+                offset += len(data)
+                if len(data) < SMB_CHUNK_SIZE:
+                    break
+        finally:
+            f.close()
+    finally:
+        conn.close_file(fnum)
+
+
+def copy_file_local_to_remote(conn, l_name, r_name):
+    fnum = conn.open_file(r_name, security.SEC_RIGHTS_FILE_WRITE,
+                          smb.NTCREATEX_SHARE_ACCESS_READ |
+                          smb.NTCREATEX_SHARE_ACCESS_WRITE,
+                          smb.NTCREATEX_DISP_OVERWRITE_IF)
+    try:
+        f = open(l_name, 'rb')
+        try:
+            offset = 0
+            while True:
+                data = f.read(SMB_CHUNK_SIZE)
+                if not data:
+                    break
+                conn.write_file(fnum, data, offset)
+                offset += len(data)
+        finally:
+            f.close()
+    finally:
+        conn.close_file(fnum)
+
+
+def copy_files(conn, connect, copy, transfers, jobs=1):
+    '''Run copy(conn, src, dst) for each (src, dst) in transfers.
+
+    With jobs > 1 the transfers are shared between that many processes,
+    each with an SMB connection of its own from connect(). (The SMB
+    bindings hold the GIL while they wait on the network, so threads
+    would not help.)'''
+    workers = min(jobs, len(transfers))
+    if workers <= 1:
+        for (src, dst) in transfers:
+            copy(conn, src, dst)
+        return
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pids = []
+    for n in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                conn = connect()
+                for (src, dst) in transfers[n::workers]:
+                    copy(conn, src, dst)
+            except BaseException:
+                status = 1
+                try:
+                    sys.stderr.write("EXCEPTION in GPO copy process PID %d\n"
+                                     % os.getpid())
+                    traceback.print_exc(file=sys.stderr)
+                    sys.stderr.flush()
+                except Exception:
+                    pass
+            finally:
+                os._exit(status)
+        pids.append(pid)
+
+    failed = 0
+    for pid in pids:
+        (pid, status) = os.waitpid(pid, 0)
+        if status != 0:
+            failed += 1
+    if failed:
+        raise RuntimeError("%d of %d GPO copy processes failed" %
+                           (failed, workers))
+
+
+def copy_directory_remote_to_local(conn, remotedir, localdir, connect=None,
+                                   jobs=1):
+    '''Copy a remote directory tree, copying the files over jobs
+    connections (see copy_files()) once the tree has been listed.'''
     if not os.path.isdir(localdir):
         os.mkdir(localdir)
     r_dirs = [ remotedir ]
     l_dirs = [ localdir ]
+    transfers = []
     while r_dirs:
         r_dir = r_dirs.pop()
         l_dir = l_dirs.pop()
@@ -251,15 +351,25 @@ def copy_directory_remote_to_local(conn, remotedir, localdir):
                 l_dirs.append(l_name)
                 os.mkdir(l_name)
             else:
-                data = conn.loadfile(r_name)
-                file(l_name, 'w').write(data)
+                transfers.append((e['size'], r_name, l_name))
+
+    # largest first, so they are spread over the processes
+    transfers.sort(reverse=True)
+    copy_files(conn, connect, copy_file_remote_to_local,
+               [(r_name, l_name) for (size, r_name, l_name) in transfers],
+               jobs=jobs)
 
 
-def copy_directory_local_to_remote(conn, localdir, remotedir):
+def copy_directory_local_to_remote(conn, localdir, remotedir, connect=None,
+                                   jobs=1):
+    '''Copy a local directory tree to the server, copying the files
+    over jobs connections (see copy_files()) once the remote directories
+    have been made.'''
     if not conn.chkpath(remotedir):
         conn.mkdir(remotedir)
     l_dirs = [ localdir ]
     r_dirs = [ remotedir ]
+    transfers = []
     while l_dirs:
         l_dir = l_dirs.pop()
         r_dir = r_dirs.pop()
@@ -274,8 +384,105 @@ def copy_directory_local_to_remote(conn, localdir, remotedir):
                 r_dirs.append(r_name)
                 conn.mkdir(r_name)
             else:
-                data = file(l_name, 'r').read()
-                conn.savefile(r_name, data)
+                transfers.append((os.path.getsize(l_name), l_name, r_name))
+
+    transfers.sort(reverse=True)
+    copy_files(conn, connect, copy_file_local_to_remote,
+               [(l_name, r_name) for (size, l_name, r_name) in transfers],
+               jobs=jobs)
+
+
+class GPOCache(object):
+    '''A local cache of GPO file trees, keyed by the GPO GUID and its
+    versionNumber.
+
+    Each cached version is a manifest of its directories and files, and
+    the file contents are stored once each under their SHA-256, so files
+    that are the same in many GPOs or versions are only kept once.'''
+
+    def __init__(self, path):
+        self.path = path
+        self.objects = os.path.join(path, "objects")
+        if not os.path.isdir(self.objects):
+            os.makedirs(self.objects)
+
+    def manifest_path(self, gpo, version):
+        return os.path.join(self.path, "%s-%s.json" % (gpo, version))
+
+    def object_path(self, digest):
+        return os.path.join(self.objects, digest)
+
+    def restore(self, gpo, version, localdir):
+        '''Copy a cached version of a GPO into localdir, returning False
+        if it is not in the cache.'''
+        try:
+            f = open(self.manifest_path(gpo, version), 'r')
+        except IOError:
+            return False
+        try:
+            manifest = json.load(f)
+        finally:
+            f.close()
+
+        for (name, digest) in manifest['files']:
+            if not os.path.exists(self.object_path(digest)):
+                return False
+
+        for name in manifest['dirs']:
+            os.mkdir(os.path.join(localdir, name))
+        for (name, digest) in manifest['files']:
+            shutil.copyfile(self.object_path(digest),
+                            os.path.join(localdir, name))
+        return True
+
+    def add_object(self, filename):
+        h = hashlib.sha256()
+        f = open(filename, 'rb')
+        try:
+            while True:
+                data = f.read(SMB_CHUNK_SIZE)
+                if not data:
+                    break
+                h.update(data)
+        finally:
+            f.close()
+        digest = h.hexdigest()
+
+        path = self.object_path(digest)
+        if not os.path.exists(path):
+            tmp_path = "%s.%d.tmp" % (path, os.getpid())
+            shutil.copyfile(filename, tmp_path)
+            os.rename(tmp_path, path)
+        return digest
+
+    def store(self, gpo, version, localdir):
+        '''Add the copy of a GPO in localdir to the cache, replacing any
+        older version of it.'''
+        manifest = {'dirs': [], 'files': []}
+        for (dirpath, dirnames, filenames) in os.walk(localdir):
+            reldir = os.path.relpath(dirpath, localdir)
+            for name in sorted(dirnames):
+                manifest['dirs'].append(os.path.normpath(os.path.join(reldir,
+                                                                      name)))
+            for name in sorted(filenames):
+                digest = self.add_object(os.path.join(dirpath, name))
+                manifest['files'].append(
+                    [os.path.normpath(os.path.join(reldir, name)), digest])
+
+        path = self.manifest_path(gpo, version)
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        f = open(tmp_path, 'w')
+        try:
+            json.dump(manifest, f)
+        finally:
+            f.close()
+        os.rename(tmp_path, path)
+
+        prefix = "%s-" % gpo
+        for name in os.listdir(self.path):
+            if (name.startswith(prefix) and name.endswith(".json") and
+                os.path.join(self.path, name) != path):
+                os.unlink(os.path.join(self.path, name))
 
 
 def create_directory_hier(conn, remotedir):
@@ -812,10 +1019,16 @@ class cmd_fetch(Command):
 
     takes_options = [
         Option("-H", help="LDB URL for database or target server", type=str),
-        Option("--tmpdir", help="Temporary directory for copying policy files", type=str)
+        Option("--tmpdir", help="Temporary directory for copying policy files", type=str),
+        Option("-j", "--jobs", type=int, default=4, metavar="N",
+               help="Copy the files over N SMB connections (default 4)"),
+        Option("--cache-dir", type=str, metavar="DIR",
+               help="Keep a copy of each fetched GPO version in DIR, and "
+                    "fetch GPOs that have not changed from there")
         ]
 
-    def run(self, gpo, H=None, tmpdir=None, sambaopts=None, credopts=None, versionopts=None):
+    def run(self, gpo, H=None, tmpdir=None, sambaopts=None, credopts=None,
+            versionopts=None, jobs=4, cache_dir=None):
 
         self.lp = sambaopts.get_loadparm()
         self.creds = credopts.get_credentials(self.lp, fallback_machine=True)
@@ -841,12 +1054,6 @@ class cmd_fetch(Command):
         except ValueError:
             raise CommandError("Invalid GPO path (%s)" % unc)
 
-        # SMB connect to DC
-        try:
-            conn = smb.SMB(dc_hostname, service, lp=self.lp, creds=self.creds)
-        except Exception:
-            raise CommandError("Error connecting to '%s' using SMB" % dc_hostname)
-
         # Copy GPT
         if tmpdir is None:
             tmpdir = "/tmp"
@@ -861,12 +1068,41 @@ class cmd_fetch(Command):
         if os.path.isdir(gpodir):
             raise CommandError("GPO directory '%s' already exists, refusing to overwrite" % gpodir)
 
+        cache = None
+        version = attr_default(msg, 'versionNumber', '0')
+
+        def connect():
+            return smb.SMB(dc_hostname, service, lp=self.lp, creds=self.creds)
+
+        # gpodir is made before we know whether the GPO comes from the
+        # cache or the DC, so remove it again if neither works out, or
+        # the next fetch would refuse to overwrite it.
+        os.mkdir(gpodir)
         try:
-            os.mkdir(gpodir)
-            copy_directory_remote_to_local(conn, sharepath, gpodir)
-        except Exception as e:
-            # FIXME: Catch more specific exception
-            raise CommandError("Error copying GPO from DC", e)
+            if cache_dir is not None:
+                cache = GPOCache(cache_dir)
+                if cache.restore(gpo, version, gpodir):
+                    self.outf.write('GPO copied to %s from the cache\n' % gpodir)
+                    return
+
+            # SMB connect to DC
+            try:
+                conn = connect()
+            except Exception:
+                raise CommandError("Error connecting to '%s' using SMB" % dc_hostname)
+
+            try:
+                copy_directory_remote_to_local(conn, sharepath, gpodir,
+                                               connect=connect, jobs=jobs)
+            except Exception as e:
+                # FIXME: Catch more specific exception
+                raise CommandError("Error copying GPO from DC", e)
+        except:
+            shutil.rmtree(gpodir, ignore_errors=True)
+            raise
+
+        if cache is not None:
+            cache.store(gpo, version, gpodir)
         self.outf.write('GPO copied to %s\n' % gpodir)
 
 
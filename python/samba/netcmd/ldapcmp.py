@@ -24,6 +24,11 @@
 import os
 import re
 import sys
+import shutil
+import pickle
+import tempfile
+import traceback
+from cStringIO import StringIO
 
 import samba
 import samba.getopt as options
@@ -31,6 +36,7 @@ from samba import Ldb
 from samba.ndr import ndr_unpack
 from samba.dcerpc import security
 from ldb import SCOPE_SUBTREE, SCOPE_ONELEVEL, SCOPE_BASE, ERR_NO_SUCH_OBJECT, LdbError
+from ldb import binary_encode
 from samba.netcmd import (
     Command,
     CommandError,
@@ -58,10 +64,11 @@ class LDAPBase(object):
             ldb_options = ["modules:paged_searches"]
         self.outf = outf
         self.errf = errf
-        self.ldb = Ldb(url=samdb_url,
-                       credentials=creds,
-                       lp=lp,
-                       options=ldb_options)
+        self.samdb_url = samdb_url
+        self.creds = creds
+        self.lp = lp
+        self.ldb_options = ldb_options
+        self.reconnect()
         self.search_base = base
         self.search_scope = scope
         self.two_domains = two
@@ -95,6 +102,35 @@ class LDAPBase(object):
             self.outf.write(4*" " + "${DOMAIN_NAME}    => %s\n" %
                 self.domain_name)
 
+    def reconnect(self):
+        """ Open a new connection to the server, e.g. in a forked worker
+            that must not share the parent's connection
+        """
+        self.ldb = Ldb(url=self.samdb_url,
+                       credentials=self.creds,
+                       lp=self.lp,
+                       options=self.ldb_options)
+
+    def expand_dn(self, dn):
+        """ Returns the real DN for a DN that may use place-holders
+        """
+        res = dn.replace("${DOMAIN_DN}", self.base_dn)
+        res = res.replace("CN=${DOMAIN_NETBIOS}", "CN=%s" % self.domain_netbios)
+        for x in self.server_names:
+            res = res.replace("CN=${SERVER_NAME}", "CN=%s" % x)
+        return res
+
+    def search_batch(self, dns, attrs):
+        """ Returns dict mapping the upper case DN of each of the objects
+            in dns that was found to its search result, using one search
+        """
+        expression = "(|%s)" % "".join(["(distinguishedName=%s)" %
+                                        binary_encode(x) for x in dns])
+        res = self.ldb.search(base="", scope=SCOPE_SUBTREE,
+                              expression=expression, attrs=attrs,
+                              controls=["search_options:1:2"])
+        return dict([(x.dn.get_linearized().upper(), x) for x in res])
+
     def find_domain_sid(self):
         res = self.ldb.search(base=self.base_dn, expression="(objectClass=*)", scope=SCOPE_BASE)
         return ndr_unpack(security.dom_sid,res[0]["objectSid"][0])
@@ -202,12 +238,15 @@ class LDAPBase(object):
 
         return vals
 
-    def get_attributes(self, object_dn):
+    def get_attributes(self, object_dn, msg=None):
         """ Returns dict with all default visible attributes
+            msg may be the object already found by search_batch()
         """
-        res = self.ldb.search(base=object_dn, scope=SCOPE_BASE, attrs=["*"])
-        assert len(res) == 1
-        res = dict(res[0])
+        if msg is None:
+            res = self.ldb.search(base=object_dn, scope=SCOPE_BASE, attrs=["*"])
+            assert len(res) == 1
+            msg = res[0]
+        res = dict(msg)
         # 'Dn' element is not iterable and we have it as 'distinguishedName'
         del res["dn"]
         for key in res.keys():
@@ -218,9 +257,11 @@ class LDAPBase(object):
 
         return res
 
-    def get_descriptor_sddl(self, object_dn):
-        res = self.ldb.search(base=object_dn, scope=SCOPE_BASE, attrs=["nTSecurityDescriptor"])
-        desc = res[0]["nTSecurityDescriptor"][0]
+    def get_descriptor_sddl(self, object_dn, msg=None):
+        if msg is None:
+            res = self.ldb.search(base=object_dn, scope=SCOPE_BASE, attrs=["nTSecurityDescriptor"])
+            msg = res[0]
+        desc = msg["nTSecurityDescriptor"][0]
         desc = ndr_unpack(security.descriptor, desc)
         return desc.as_sddl(self.domain_sid)
 
@@ -263,12 +304,13 @@ class LDAPBase(object):
                 pass
 
 class Descriptor(object):
-    def __init__(self, connection, dn, outf=sys.stdout, errf=sys.stderr):
+    def __init__(self, connection, dn, outf=sys.stdout, errf=sys.stderr,
+                 msg=None):
         self.outf = outf
         self.errf = errf
         self.con = connection
         self.dn = dn
-        self.sddl = self.con.get_descriptor_sddl(self.dn)
+        self.sddl = self.con.get_descriptor_sddl(self.dn, msg)
         self.dacl_list = self.extract_dacl()
         if self.con.sort_aces:
             self.dacl_list.sort()
@@ -382,7 +424,7 @@ class Descriptor(object):
 
 class LDAPObject(object):
     def __init__(self, connection, dn, summary, filter_list,
-                 outf=sys.stdout, errf=sys.stderr):
+                 outf=sys.stdout, errf=sys.stderr, msg=None):
         self.outf = outf
         self.errf = errf
         self.con = connection
@@ -390,11 +432,13 @@ class LDAPObject(object):
         self.quiet = self.con.quiet
         self.verbose = self.con.verbose
         self.summary = summary
-        self.dn = dn.replace("${DOMAIN_DN}", self.con.base_dn)
-        self.dn = self.dn.replace("CN=${DOMAIN_NETBIOS}", "CN=%s" % self.con.domain_netbios)
-        for x in self.con.server_names:
-            self.dn = self.dn.replace("CN=${SERVER_NAME}", "CN=%s" % x)
-        self.attributes = self.con.get_attributes(self.dn)
+        self.dn = self.con.expand_dn(dn)
+        self.msg = msg
+        if self.con.descriptor:
+            # only the nTSecurityDescriptor is compared
+            self.attributes = {}
+        else:
+            self.attributes = self.con.get_attributes(self.dn, msg)
         # One domain - two domain controllers
         #
         # Some attributes are defined as FLAG_ATTR_NOT_REPLICATED
@@ -554,8 +598,10 @@ class LDAPObject(object):
         return self.cmp_attrs(other)
 
     def cmp_desc(self, other):
-        d1 = Descriptor(self.con, self.dn, outf=self.outf, errf=self.errf)
-        d2 = Descriptor(other.con, other.dn, outf=self.outf, errf=self.errf)
+        d1 = Descriptor(self.con, self.dn, outf=self.outf, errf=self.errf,
+                        msg=self.msg)
+        d2 = Descriptor(other.con, other.dn, outf=self.outf, errf=self.errf,
+                        msg=other.msg)
         if self.con.view == "section":
             res = d1.diff_2(d2)
         elif self.con.view == "collision":
@@ -688,7 +734,7 @@ class LDAPObject(object):
 class LDAPBundel(object):
 
     def __init__(self, connection, context, dn_list=None, filter_list=None,
-                 outf=sys.stdout, errf=sys.stderr):
+                 outf=sys.stdout, errf=sys.stderr, jobs=1, batch_size=1000):
         self.outf = outf
         self.errf = errf
         self.con = connection
@@ -704,6 +750,8 @@ class LDAPBundel(object):
         self.summary["known_ignored_dn"] = []
         self.summary["abnormal_ignored_dn"] = []
         self.filter_list = filter_list
+        self.jobs = jobs
+        self.batch_size = batch_size
         if dn_list:
             self.dn_list = dn_list
         elif context.upper() in ["DOMAIN", "CONFIGURATION", "SCHEMA", "DNSDOMAIN", "DNSFOREST"]:
@@ -748,83 +796,200 @@ class LDAPBundel(object):
         # It does not matter if they are in the same DC, in two DC in one domain or in two
         # different domains.
         if self.search_scope != SCOPE_BASE:
+            # index each list by the upper case DN, rather than searching
+            # the other list for every DN
+            other_index = dict([(x.upper(), x) for x in other.dn_list])
+            self_index = dict([(x.upper(), x) for x in self.dn_list])
             title= "\n* DNs found only in %s:" % self.con.host
             for x in self.dn_list:
-                if not x.upper() in [q.upper() for q in other.dn_list]:
+                if not x.upper() in other_index:
                     if title and not self.skip_missing_dn:
                         self.log( title )
                         title = None
                         res = False
                     self.log( 4*" " + x )
-                    self.dn_list[self.dn_list.index(x)] = ""
-            self.dn_list = [x for x in self.dn_list if x]
+            self.dn_list = [x for x in self.dn_list if x.upper() in other_index]
             #
             title= "\n* DNs found only in %s:" % other.con.host
             for x in other.dn_list:
-                if not x.upper() in [q.upper() for q in self.dn_list]:
+                if not x.upper() in self_index:
                     if title and not self.skip_missing_dn:
                         self.log( title )
                         title = None
                         res = False
                     self.log( 4*" " + x )
-                    other.dn_list[other.dn_list.index(x)] = ""
-            other.dn_list = [x for x in other.dn_list if x]
+            other.dn_list = [x for x in other.dn_list if x.upper() in self_index]
             #
             self.update_size()
             other.update_size()
             assert self.size == other.size
-            assert sorted([x.upper() for x in self.dn_list]) == sorted([x.upper() for x in other.dn_list])
+            pairs = [(x, other_index[x.upper()]) for x in self.dn_list]
+        else:
+            pairs = zip(self.dn_list, other.dn_list)
         self.log( "\n* Objects to be compared: %s" % self.size )
 
-        index = 0
-        while index < self.size:
-            skip = False
-            try:
-                object1 = LDAPObject(connection=self.con,
-                                     dn=self.dn_list[index],
-                                     summary=self.summary,
-                                     filter_list=self.filter_list,
-                                     outf=self.outf, errf=self.errf)
-            except LdbError as e:
-                (enum, estr) = e.args
-                if enum == ERR_NO_SUCH_OBJECT:
-                    self.log( "\n!!! Object not found: %s" % self.dn_list[index] )
-                    skip = True
-                raise
-            try:
-                object2 = LDAPObject(connection=other.con,
-                        dn=other.dn_list[index],
-                        summary=other.summary,
-                        filter_list=self.filter_list,
-                        outf=self.outf, errf=self.errf)
-            except LdbError as e1:
-                (enum, estr) = e1.args
-                if enum == ERR_NO_SUCH_OBJECT:
-                    self.log( "\n!!! Object not found: %s" % other.dn_list[index] )
-                    skip = True
-                raise
-            if skip:
-                index += 1
-                continue
-            if object1 == object2:
-                if self.con.verbose:
-                    self.log( "\nComparing:" )
-                    self.log( "'%s' [%s]" % (object1.dn, object1.con.host) )
-                    self.log( "'%s' [%s]" % (object2.dn, object2.con.host) )
-                    self.log( 4*" " + "OK" )
-            else:
+        if self.jobs > 1 and len(pairs) > 1:
+            if not self.compare_in_workers(other, pairs):
+                res = False
+        elif not self.compare_objects(other, pairs):
+            res = False
+        #
+        return res
+
+    def fetch_batch(self, dns):
+        """ Returns the search results for the objects in dns, in the
+            same order, with None for any that could not be found in one
+            search with the others
+        """
+        if self.con.descriptor:
+            attrs = ["nTSecurityDescriptor"]
+        else:
+            attrs = ["*"]
+        real_dns = [self.con.expand_dn(x) for x in dns]
+        found = self.con.search_batch(real_dns, attrs)
+        return [found.get(x.upper()) for x in real_dns]
+
+    def compare_objects(self, other, pairs):
+        """ Compare each pair of DNs in pairs, the first from this
+            bundle and the second from other. The objects are fetched
+            from each server batch_size at a time.
+        """
+        res = True
+        for start in range(0, len(pairs), self.batch_size):
+            batch = pairs[start:start + self.batch_size]
+            msgs1 = self.fetch_batch([x[0] for x in batch])
+            msgs2 = other.fetch_batch([x[1] for x in batch])
+            for ((dn1, dn2), msg1, msg2) in zip(batch, msgs1, msgs2):
+                if not self.compare_object(other, dn1, dn2, msg1, msg2):
+                    res = False
+        return res
+
+    def compare_object(self, other, dn1, dn2, msg1=None, msg2=None):
+        skip = False
+        try:
+            object1 = LDAPObject(connection=self.con,
+                                 dn=dn1,
+                                 summary=self.summary,
+                                 filter_list=self.filter_list,
+                                 outf=self.outf, errf=self.errf,
+                                 msg=msg1)
+        except LdbError as e:
+            (enum, estr) = e.args
+            if enum == ERR_NO_SUCH_OBJECT:
+                self.log( "\n!!! Object not found: %s" % dn1 )
+                skip = True
+            raise
+        try:
+            object2 = LDAPObject(connection=other.con,
+                    dn=dn2,
+                    summary=other.summary,
+                    filter_list=self.filter_list,
+                    outf=self.outf, errf=self.errf,
+                    msg=msg2)
+        except LdbError as e1:
+            (enum, estr) = e1.args
+            if enum == ERR_NO_SUCH_OBJECT:
+                self.log( "\n!!! Object not found: %s" % dn2 )
+                skip = True
+            raise
+        if skip:
+            return True
+        res = True
+        if object1 == object2:
+            if self.con.verbose:
                 self.log( "\nComparing:" )
                 self.log( "'%s' [%s]" % (object1.dn, object1.con.host) )
                 self.log( "'%s' [%s]" % (object2.dn, object2.con.host) )
-                self.log( object1.screen_output )
-                self.log( 4*" " + "FAILED" )
+                self.log( 4*" " + "OK" )
+        else:
+            self.log( "\nComparing:" )
+            self.log( "'%s' [%s]" % (object1.dn, object1.con.host) )
+            self.log( "'%s' [%s]" % (object2.dn, object2.con.host) )
+            self.log( object1.screen_output )
+            self.log( 4*" " + "FAILED" )
+            res = False
+        self.summary = object1.summary
+        other.summary = object2.summary
+        return res
+
+    def compare_in_workers(self, other, pairs):
+        """ Split pairs into self.jobs contiguous chunks and compare each
+            in a forked worker process. The output of each worker is
+            written out in order once they have all finished, so it is
+            the same as comparing the objects in this process.
+        """
+        chunk_size = (len(pairs) + self.jobs - 1) // self.jobs
+        chunks = [pairs[i:i + chunk_size]
+                  for i in range(0, len(pairs), chunk_size)]
+        tmpdir = tempfile.mkdtemp(prefix='samba-ldapcmp')
+        pids = []
+        try:
+            for n, chunk in enumerate(chunks):
+                filename = os.path.join(tmpdir, 'worker-%d' % n)
+                self.outf.flush()
+                pid = os.fork()
+                if pid == 0:
+                    self._compare_worker(other, chunk, filename)
+                pids.append((pid, filename))
+
+            results = []
+            failed = []
+            for pid, filename in pids:
+                (pid, status) = os.waitpid(pid, 0)
+                if not (os.WIFEXITED(status) and
+                        os.WEXITSTATUS(status) == 0):
+                    failed.append(pid)
+                    continue
+                f = open(filename, 'rb')
+                try:
+                    results.append(pickle.load(f))
+                finally:
+                    f.close()
+            if failed:
+                raise CommandError("ldapcmp worker process(es) %s failed" %
+                                   ', '.join([str(x) for x in failed]))
+        finally:
+            shutil.rmtree(tmpdir)
+
+        res = True
+        for (worker_res, output, summary1, summary2) in results:
+            self.outf.write(output)
+            for key in summary1:
+                self.summary[key] += summary1[key]
+                other.summary[key] += summary2[key]
+            if not worker_res:
                 res = False
-            self.summary = object1.summary
-            other.summary = object2.summary
-            index += 1
-        #
         return res
 
+    def _compare_worker(self, other, pairs, filename):
+        """ Compare pairs in a forked worker, saving the result, output and
+            summaries to filename. This never returns.
+        """
+        status = 1
+        try:
+            self.con.reconnect()
+            other.con.reconnect()
+            output = StringIO()
+            self.outf = output
+            self.summary = dict([(key, []) for key in self.summary])
+            other.summary = dict([(key, []) for key in other.summary])
+            res = self.compare_objects(other, pairs)
+            f = open(filename, 'wb')
+            try:
+                pickle.dump((res, output.getvalue(), self.summary,
+                             other.summary), f, 2)
+            finally:
+                f.close()
+            status = 0
+        except Exception:
+            sys.stderr.write("EXCEPTION in ldapcmp worker PID %d\n" %
+                             os.getpid())
+            traceback.print_exc(file=sys.stderr)
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(status)
+
     def get_dn_list(self, context):
         """ Query LDAP server about the DNs of certain naming self.con.ext Domain (or Default), Configuration, Schema.
             Parse all DNs and filter those that are 'strange' or abnormal.
@@ -920,13 +1085,18 @@ class cmd_ldapcmp(Command):
             help="List of comma separated attributes to ignore in the comparision"),
         Option("--skip-missing-dn", dest="skip_missing_dn", action="store_true", default=False,
             help="Skip report and failure due to missing DNs in one server or another"),
+        Option("-j", "--jobs", dest="jobs", type="int", default=1,
+            help="Compare objects in this many worker processes"),
+        Option("--batch-size", dest="batch_size", type="int", default=1000,
+            help="Fetch objects from each server this many at a time"),
         ]
 
     def run(self, URL1, URL2,
             context1=None, context2=None, context3=None, context4=None, context5=None,
             two=False, quiet=False, verbose=False, descriptor=False, sort_aces=False,
             view="section", base="", base2="", scope="SUB", filter="",
-            credopts=None, sambaopts=None, versionopts=None, skip_missing_dn=False):
+            credopts=None, sambaopts=None, versionopts=None, skip_missing_dn=False,
+            jobs=1, batch_size=1000):
 
         lp = sambaopts.get_loadparm()
 
@@ -971,6 +1141,10 @@ class cmd_ldapcmp(Command):
             raise CommandError("Invalid --view value. Choose from: section or collision")
         if not scope.upper() in ["SUB", "ONE", "BASE"]:
             raise CommandError("Invalid --scope value. Choose from: SUB, ONE, BASE")
+        if jobs < 1:
+            raise CommandError("--jobs must be at least 1")
+        if batch_size < 1:
+            raise CommandError("--batch-size must be at least 1")
 
         con1 = LDAPBase(URL1, creds, lp,
                         two=two, quiet=quiet, descriptor=descriptor, sort_aces=sort_aces,
@@ -992,9 +1166,11 @@ class cmd_ldapcmp(Command):
                 self.outf.write("\n* Comparing [%s] context...\n" % context)
 
             b1 = LDAPBundel(con1, context=context, filter_list=filter_list,
-                            outf=self.outf, errf=self.errf)
+                            outf=self.outf, errf=self.errf,
+                            jobs=jobs, batch_size=batch_size)
             b2 = LDAPBundel(con2, context=context, filter_list=filter_list,
-                            outf=self.outf, errf=self.errf)
+                            outf=self.outf, errf=self.errf,
+                            jobs=jobs, batch_size=batch_size)
 
             if b1 == b2:
                 if not quiet:
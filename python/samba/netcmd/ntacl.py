@@ -183,11 +183,17 @@ class cmd_ntacl_sysvolreset(Command):
 
     takes_options = [
         Option("--use-ntvfs", help="Set the ACLs for use with the ntvfs file server", action="store_true"),
-        Option("--use-s3fs", help="Set the ACLs for use with the default s3fs file server", action="store_true")
+        Option("--use-s3fs", help="Set the ACLs for use with the default s3fs file server", action="store_true"),
+        Option("-j", "--jobs", type="int", default=1,
+               help="Set the ACLs in this many worker processes"),
+        Option("--incremental", action="store_true", default=False,
+               help="Only set the ACLs on files and folders where they differ")
         ]
 
-    def run(self, use_ntvfs=False, use_s3fs=False,
+    def run(self, use_ntvfs=False, use_s3fs=False, jobs=1, incremental=False,
             credopts=None, sambaopts=None, versionopts=None):
+        if jobs < 1:
+            raise CommandError("--jobs must be at least 1")
         lp = sambaopts.get_loadparm()
         path = lp.private_path("secrets.ldb")
         creds = credopts.get_credentials(lp)
@@ -236,7 +242,8 @@ class cmd_ntacl_sysvolreset(Command):
         provision.setsysvolacl(samdb, netlogon, sysvol,
                                LA_uid, BA_gid, domain_sid,
                                lp.get("realm").lower(), samdb.domain_dn(),
-                               lp, use_ntvfs=use_ntvfs)
+                               lp, use_ntvfs=use_ntvfs, jobs=jobs,
+                               incremental=incremental)
 
 class cmd_ntacl_sysvolcheck(Command):
     """Check sysvol ACLs match defaults (including correct ACLs on GPOs)."""
@@ -45,6 +45,7 @@ from samba import (
     gensec,
     generate_random_password,
     Ldb,
+    nttime2unix,
     )
 from samba.net import Net
 
@@ -1623,6 +1624,16 @@ If you specify the '--no-wait' option the command skips the
 LDAP_SERVER_NOTIFICATION_OID 'waiting' step and exit once
 all LDAP_SERVER_DIRSYNC_OID changes are consumed.
 
+The '--batch-size' option groups up to the given number of changed
+objects together (default 1).  The script specified by '--script' is then
+called once per group and gets the LDIF of all objects of the group on STDIN,
+one record after the other.  It has to process all of them before it responds
+with 'DONE-EXIT: ', otherwise the whole group is passed to the script again
+on the next run.  The cache is updated once per group.  This keeps up much
+better with a large number of changes at once, e.g. a mass password reset.
+After each group the number of objects, the throughput and the lag behind
+the most recent password change (from pwdLastSet) are logged.
+
 Sync Loop Terminate
 ===================
 
@@ -1678,6 +1689,9 @@ samba-tool user syncpasswords --terminate \\
                metavar="/path/to/syncpasswords.script", dest="script"),
         Option("--no-wait", help="Don't block waiting for changes",
                action="store_true", default=False, dest="nowait"),
+        Option("--batch-size", type=int, default=1,
+               help="Number of changed objects passed to the script at once (default 1)",
+               metavar="N", dest="batch_size"),
         Option("--logfile", type=str,
                help="The logfile to use (required in --daemon mode).",
                metavar="/path/to/syncpasswords.log", dest="logfile"),
@@ -1692,13 +1706,16 @@ samba-tool user syncpasswords --terminate \\
             H=None, filter=None,
             attributes=None, decrypt_samba_gpg=None,
             script=None, nowait=None, logfile=None, daemon=None, terminate=None,
-            sambaopts=None, versionopts=None):
+            batch_size=1, sambaopts=None, versionopts=None):
 
         self.lp = sambaopts.get_loadparm()
         self.logfile = None
         self.samdb_url = None
         self.samdb = None
         self.cache = None
+        self.sync_objects = 0
+        self.sync_batches = 0
+        self.sync_seconds = 0.0
 
         if not cache_ldb_initialize:
             if attributes is not None:
@@ -1720,6 +1737,8 @@ samba-tool user syncpasswords --terminate \\
                 raise CommandError("--daemon is not allowed together with --cache-ldb-initialize")
             if terminate is not False:
                 raise CommandError("--terminate is not allowed together with --cache-ldb-initialize")
+            if batch_size != 1:
+                raise CommandError("--batch-size is not allowed together with --cache-ldb-initialize")
 
         if nowait is True:
             if daemon is True:
@@ -1730,6 +1749,9 @@ samba-tool user syncpasswords --terminate \\
         if terminate is True and daemon is True:
             raise CommandError("--terminate is not allowed together with --daemon")
 
+        if batch_size < 1:
+            raise CommandError("--batch-size must be at least 1")
+
         if daemon is True and logfile is None:
             raise CommandError("--daemon is only allowed together with --logfile")
 
@@ -1933,7 +1955,7 @@ samba-tool user syncpasswords --terminate \\
             log_msg("RESULT: %s\n" % (res))
             raise Exception("ERROR: %s - %s\n" % (res, reply))
 
-        def handle_object(idx, dirsync_obj):
+        def get_object_ldif(idx, dirsync_obj):
             binary_guid = dirsync_obj.dn.get_extended_component("GUID")
             guid = ndr_unpack(misc.GUID, binary_guid)
             binary_sid = dirsync_obj.dn.get_extended_component("SID")
@@ -1941,7 +1963,7 @@ samba-tool user syncpasswords --terminate \\
             domain_sid, rid = sid.split()
             if rid == security.DOMAIN_RID_KRBTGT:
                 log_msg("# Dirsync[%d] SKIP: DOMAIN_RID_KRBTGT\n\n" % (idx))
-                return
+                return None
             for a in list(dirsync_obj.keys()):
                 for h in dirsync_secret_attrs:
                     if a.lower() == h.lower():
@@ -1958,11 +1980,61 @@ samba-tool user syncpasswords --terminate \\
                                               decrypt=self.decrypt_samba_gpg)
             ldif = self.samdb.write_ldif(obj, ldb.CHANGETYPE_NONE)
             log_msg("# Passwords[%d] %s %s\n" % (idx, guid, sid))
-            if self.sync_command is None:
-                self.outf.write("%s" % (ldif))
-                return
-            self.outf.write("# attrs=%s\n" % (sorted(obj.keys())))
-            run_sync_command(obj.dn, ldif)
+            return (obj, ldif)
+
+        def password_lag(dirsync_obj):
+            # pwdLastSet is only returned if it changed
+            if "pwdLastSet" not in dirsync_obj:
+                return None
+            pwd_last_set = int(dirsync_obj["pwdLastSet"][0])
+            if pwd_last_set <= 0:
+                return None
+            return max(time.time() - nttime2unix(pwd_last_set), 0)
+
+        def handle_batch(batch, res_controls):
+            start = time.time()
+            objs = []
+            ldifs = []
+            for (idx, dirsync_obj) in batch:
+                ret = get_object_ldif(idx, dirsync_obj)
+                if ret is None:
+                    continue
+                (obj, ldif) = ret
+                objs.append(obj)
+                ldifs.append(ldif)
+
+            if len(objs) > 0:
+                if self.sync_command is None:
+                    for ldif in ldifs:
+                        self.outf.write("%s" % (ldif))
+                else:
+                    for obj in objs:
+                        self.outf.write("# attrs=%s\n" % (sorted(obj.keys())))
+                    if len(objs) == 1:
+                        name = objs[0].dn
+                    else:
+                        name = "%d objects" % len(objs)
+                    run_sync_command(name, "".join(ldifs))
+
+            update_objects([dirsync_obj for (idx, dirsync_obj) in batch],
+                           res_controls)
+
+            elapsed = time.time() - start
+            self.sync_objects += len(batch)
+            self.sync_batches += 1
+            self.sync_seconds += elapsed
+            lags = [password_lag(o) for (idx, o) in batch]
+            lags = [l for l in lags if l is not None]
+            if len(lags) > 0:
+                lag = "%.1fs" % max(lags)
+            else:
+                lag = "unknown"
+            log_msg("# Batch of %d objects in %.3fs (%.1f objects/s), "
+                    "password lag %s, total %d objects in %d batches "
+                    "(%.1f objects/s)\n" % (
+                        len(batch), elapsed, len(batch) / max(elapsed, 0.001),
+                        lag, self.sync_objects, self.sync_batches,
+                        self.sync_objects / max(self.sync_seconds, 0.001)))
 
         def check_current_pid_conflict(terminate):
             flags = os.O_RDWR
@@ -2106,34 +2178,37 @@ samba-tool user syncpasswords --terminate \\
                 return True
             return False
 
-        def update_object(dirsync_obj, res_controls):
+        def update_objects(dirsync_objs, res_controls):
             assert len(res_controls) > 0
             assert res_controls[0].oid == "1.2.840.113556.1.4.841"
 
-            binary_sid = dirsync_obj.dn.get_extended_component("SID")
-            sid = ndr_unpack(security.dom_sid, binary_sid)
-            dn = "KEY=%s" % sid
             lastCookie = str(res_controls[0])
 
+            # All objects of a batch are recorded in one transaction
             self.cache.transaction_start()
             try:
-                res = self.cache.search(base=dn, scope=ldb.SCOPE_BASE,
-                                        expression="(objectClass=*)",
-                                        attrs=["lastCookie"])
-                if len(res) == 0:
-                    add_ldif  = "dn: %s\n" % (dn)
-                    add_ldif += "objectClass: userCookie\n"
-                    add_ldif += "lastCookie: %s\n" % (lastCookie)
-                    add_ldif += "currentTime: %s\n" % ldb.timestring(int(time.time()))
-                    self.cache.add_ldif(add_ldif)
-                else:
-                    modify_ldif =  "dn: %s\n" % (dn)
-                    modify_ldif += "changetype: modify\n"
-                    modify_ldif += "replace: lastCookie\n"
-                    modify_ldif += "lastCookie: %s\n" % (lastCookie)
-                    modify_ldif += "replace: currentTime\n"
-                    modify_ldif += "currentTime: %s\n" % ldb.timestring(int(time.time()))
-                    self.cache.modify_ldif(modify_ldif)
+                for dirsync_obj in dirsync_objs:
+                    binary_sid = dirsync_obj.dn.get_extended_component("SID")
+                    sid = ndr_unpack(security.dom_sid, binary_sid)
+                    dn = "KEY=%s" % sid
+
+                    res = self.cache.search(base=dn, scope=ldb.SCOPE_BASE,
+                                            expression="(objectClass=*)",
+                                            attrs=["lastCookie"])
+                    if len(res) == 0:
+                        add_ldif  = "dn: %s\n" % (dn)
+                        add_ldif += "objectClass: userCookie\n"
+                        add_ldif += "lastCookie: %s\n" % (lastCookie)
+                        add_ldif += "currentTime: %s\n" % ldb.timestring(int(time.time()))
+                        self.cache.add_ldif(add_ldif)
+                    else:
+                        modify_ldif =  "dn: %s\n" % (dn)
+                        modify_ldif += "changetype: modify\n"
+                        modify_ldif += "replace: lastCookie\n"
+                        modify_ldif += "lastCookie: %s\n" % (lastCookie)
+                        modify_ldif += "replace: currentTime\n"
+                        modify_ldif += "currentTime: %s\n" % ldb.timestring(int(time.time()))
+                        self.cache.modify_ldif(modify_ldif)
                 self.cache.transaction_commit()
             except Exception as e:
                 self.cache.transaction_cancel()
@@ -2147,13 +2222,18 @@ samba-tool user syncpasswords --terminate \\
                                         attrs=self.dirsync_attrs,
                                         controls=self.dirsync_controls)
                 log_msg("dirsync_loop(): results %d\n" % len(res))
+                batch = []
                 ri = 0
                 for r in res:
                     done = check_object(r, res.controls)
                     if not done:
-                        handle_object(ri, r)
-                        update_object(r, res.controls)
+                        batch.append((ri, r))
+                        if len(batch) >= batch_size:
+                            handle_batch(batch, res.controls)
+                            batch = []
                     ri += 1
+                if len(batch) > 0:
+                    handle_batch(batch, res.controls)
                 update_cache(res.controls)
                 if len(res) == 0:
                     break
@@ -105,7 +105,6 @@ def setntacl(lp, file, sddl, domsid, backend=None, eadbfile=None, use_ntvfs=True
         sd = security.descriptor.from_sddl(sddl, sid)
     elif isinstance(sddl, security.descriptor):
         sd = sddl
-        sddl = sd.as_sddl(sid)
 
     if not use_ntvfs and skip_invalid_chown:
         # Check if the owner can be resolved as a UID
@@ -32,14 +32,17 @@ import os
 import stat
 import re
 import pwd
+import shutil
 import grp
 import logging
 import time
 import uuid
 import socket
+import sys
 import urllib
 import string
 import tempfile
+import traceback
 import samba.dsdb
 
 import ldb
@@ -123,6 +126,11 @@ from samba.schema import Schema
 from samba.samdb import SamDB
 from samba.dbchecker import dbcheck
 from samba.provision.kerberos import create_kdc_conf
+from samba.provision.template import (
+    collect_guid_map,
+    read_partitions,
+    rewrite_provision,
+    )
 
 DEFAULT_POLICY_GUID = "31B2F340-016D-11D2-945F-00C04FB984F9"
 DEFAULT_DC_POLICY_GUID = "6AC1786C-016F-11D2-945F-00C04FB984F9"
@@ -1593,8 +1601,128 @@ def set_gpos_acl(sysvol, dnsdomain, domainsid, domaindn, samdb, lp, use_ntvfs, p
                     passdb=passdb)
 
 
+def get_gpos_acls(sysvol, dnsdomain, domainsid, domaindn, samdb):
+    """Find the ACLs for the sysvol/<dnsname>/Policies folder and the
+    files and folders of each policy beneath, as set by set_gpos_acl().
+
+    :param sysvol: Physical path for the sysvol folder
+    :param dnsdomain: The DNS name of the domain
+    :param domainsid: The SID of the domain
+    :param domaindn: The DN of the domain (ie. DC=...)
+    :param samdb: An LDB object on the SAM db
+    :return: a list of (path, sddl) tuples
+    """
+    root_policy_path = os.path.join(sysvol, dnsdomain, "Policies")
+    acls = [(root_policy_path, POLICIES_ACL)]
+
+    res = samdb.search(base="CN=Policies,CN=System,%s"%(domaindn),
+                        attrs=["cn", "nTSecurityDescriptor"],
+                        expression="", scope=ldb.SCOPE_ONELEVEL)
+
+    for policy in res:
+        acl = ndr_unpack(security.descriptor,
+                         str(policy["nTSecurityDescriptor"])).as_sddl()
+        acl = dsacl2fsacl(acl, domainsid)
+        policy_path = getpolicypath(sysvol, dnsdomain, str(policy["cn"]))
+        acls.append((policy_path, acl))
+        for root, dirs, files in os.walk(policy_path, topdown=False):
+            for name in files + dirs:
+                acls.append((os.path.join(root, name), acl))
+
+    return acls
+
+
+def ntacl_matches(lp, path, acl, domainsid, use_ntvfs):
+    """Check whether a file or folder already has the given NT ACL
+
+    :param path: the file or folder
+    :param acl: the expected ACL, as SDDL
+    :param domainsid: The SID of the domain, as a dom_sid
+    :param use_ntvfs: whether to look at the ntvfs (xattr) ACL rather
+        than the one smbd sees
+    """
+    try:
+        fsacl = getntacl(lp, path, direct_db_access=use_ntvfs,
+                         service=SYSVOL_SERVICE)
+    except Exception:
+        # no ACL, or not one we can read
+        return False
+    if fsacl is None:
+        return False
+    return fsacl.as_sddl(domainsid) == acl
+
+
+def _set_ntacls(acls, lp, domainsid, use_ntvfs, passdb, gid, incremental):
+    sid = security.dom_sid(str(domainsid))
+    # each distinct ACL is converted from SDDL once, and unpacked again
+    # for each path because setntacl() may change the owner.
+    blobs = {}
+    for path, acl in acls:
+        if gid is not None:
+            os.chown(path, -1, gid)
+        if incremental and ntacl_matches(lp, path, acl, sid, use_ntvfs):
+            continue
+        blob = blobs.get(acl)
+        if blob is None:
+            blob = ndr_pack(security.descriptor.from_sddl(acl, sid))
+            blobs[acl] = blob
+        sd = ndr_unpack(security.descriptor, blob)
+        setntacl(lp, path, sd, str(domainsid), use_ntvfs=use_ntvfs,
+                 skip_invalid_chown=True, passdb=passdb,
+                 service=SYSVOL_SERVICE)
+
+
+def set_ntacls(acls, lp, domainsid, use_ntvfs, passdb, gid=None,
+               jobs=1, incremental=False):
+    """Set the NT ACLs on a list of files and folders
+
+    :param acls: a list of (path, sddl) tuples
+    :param domainsid: The SID of the domain
+    :param use_ntvfs: Set the ACLs for use with the ntvfs file server
+    :param passdb: the passdb, for mapping the owner when not use_ntvfs
+    :param gid: if not None, also chown each path to this group
+    :param jobs: share the paths between this many worker processes
+    :param incremental: skip paths that already have the right ACL
+    """
+    if jobs <= 1 or len(acls) <= 1:
+        _set_ntacls(acls, lp, domainsid, use_ntvfs, passdb, gid,
+                    incremental)
+        return
+
+    pids = []
+    for n in range(jobs):
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                _set_ntacls(acls[n::jobs], lp, domainsid, use_ntvfs,
+                            passdb, gid, incremental)
+                status = 0
+            except Exception:
+                sys.stderr.write("EXCEPTION in ACL worker PID %d\n" %
+                                 os.getpid())
+                traceback.print_exc(file=sys.stderr)
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(status)
+        pids.append(pid)
+
+    failed = []
+    for pid in pids:
+        (pid, status) = os.waitpid(pid, 0)
+        if not (os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0):
+            failed.append(pid)
+    if failed:
+        raise ProvisioningError("Setting sysvol ACLs failed in worker "
+                                "process(es) %s" %
+                                ', '.join([str(x) for x in failed]))
+
+
 def setsysvolacl(samdb, netlogon, sysvol, uid, gid, domainsid, dnsdomain,
-        domaindn, lp, use_ntvfs):
+        domaindn, lp, use_ntvfs, jobs=1, incremental=False):
     """Set the ACL for the sysvol share and the subfolders
 
     :param samdb: An LDB object on the SAM db
@@ -1605,6 +1733,9 @@ def setsysvolacl(samdb, netlogon, sysvol, uid, gid, domainsid, dnsdomain,
     :param domainsid: The SID of the domain
     :param dnsdomain: The DNS name of the domain
     :param domaindn: The DN of the domain (ie. DC=...)
+    :param jobs: The number of worker processes to set the ACLs with
+    :param incremental: Skip files and folders that already have the
+        right ACL
     """
     s4_passdb = None
 
@@ -1666,26 +1797,28 @@ def setsysvolacl(samdb, netlogon, sysvol, uid, gid, domainsid, dnsdomain,
     else:
         canchown = True
 
-    # Set the SYSVOL_ACL on the sysvol folder and subfolder (first level)
-    setntacl(lp,sysvol, SYSVOL_ACL, str(domainsid), use_ntvfs=use_ntvfs,
-             skip_invalid_chown=True, passdb=s4_passdb,
-             service=SYSVOL_SERVICE)
+    # Set the SYSVOL_ACL on the sysvol folder and everything below,
+    # except for the Policy folder and policies folders, which get the
+    # ACLs from set_gpos_acl(). Working out the final ACL for each path
+    # first means each is only set once.
+    acls = [(sysvol, SYSVOL_ACL)]
     for root, dirs, files in os.walk(sysvol, topdown=False):
-        for name in files:
-            if use_ntvfs and canchown:
-                os.chown(os.path.join(root, name), -1, gid)
-            setntacl(lp, os.path.join(root, name), SYSVOL_ACL, str(domainsid),
-                     use_ntvfs=use_ntvfs, skip_invalid_chown=True,
-                     passdb=s4_passdb, service=SYSVOL_SERVICE)
-        for name in dirs:
-            if use_ntvfs and canchown:
-                os.chown(os.path.join(root, name), -1, gid)
-            setntacl(lp, os.path.join(root, name), SYSVOL_ACL, str(domainsid),
-                     use_ntvfs=use_ntvfs, skip_invalid_chown=True,
-                     passdb=s4_passdb, service=SYSVOL_SERVICE)
+        for name in files + dirs:
+            acls.append((os.path.join(root, name), SYSVOL_ACL))
+
+    gpos_acls = dict(get_gpos_acls(sysvol, dnsdomain, domainsid, domaindn,
+                                   samdb))
+    acls = [(path, gpos_acls.pop(path, acl)) for path, acl in acls]
+    # any policy folders outside the walk (an error, as before)
+    acls.extend(sorted(gpos_acls.items()))
 
-    # Set acls on Policy folder and policies folders
-    set_gpos_acl(sysvol, dnsdomain, domainsid, domaindn, samdb, lp, use_ntvfs, passdb=s4_passdb)
+    if use_ntvfs and canchown:
+        chown_gid = gid
+    else:
+        chown_gid = None
+
+    set_ntacls(acls, lp, domainsid, use_ntvfs, s4_passdb, gid=chown_gid,
+               jobs=jobs, incremental=incremental)
 
 def acl_type(direct_db_access):
     if direct_db_access:
@@ -2382,6 +2515,259 @@ def provision_become_dc(smbconf=None, targetdir=None,
     return res
 
 
+def provision_from_template(logger, session_info, templatedir, targetdir,
+        realm=None, domain=None, hostname=None, domainsid=None,
+        adminpass=None, krbtgtpass=None, machinepass=None, invocationid=None,
+        hostip=None, hostip6=None, use_ntvfs=None, skip_sysvolacl=True):
+    """Create a new domain by rewriting a copy of a provision made
+    earlier with provision().
+
+    This is much quicker than provision().  The copy gets its own domain
+    SID, objectGUIDs, invocationId and secrets, and may be given a new
+    realm, NetBIOS domain and host name; the schema, the objects and
+    the GPOs are those of the template.
+
+    Only templates with the ldb backend and the internal (or no) DNS
+    server are supported, and the template must not be in use.
+
+    :param templatedir: The targetdir of the provision to copy
+    :param targetdir: The directory to create the new domain in
+    :param realm: The new realm (otherwise that of the template)
+    :param domain: The new NetBIOS domain (otherwise that of the template)
+    :param hostname: The new host name (otherwise that of the template)
+    :param domainsid: The new domain SID (otherwise random)
+    :param adminpass: The Administrator password (otherwise random)
+    :param krbtgtpass: The krbtgt password (otherwise random)
+    :param machinepass: The machine password (otherwise random)
+    :param invocationid: The new invocationId (otherwise random)
+    :param hostip: The IPv4 address of the DC in DNS (otherwise unchanged)
+    :param hostip6: The IPv6 address of the DC in DNS (otherwise unchanged)
+    :return: ProvisionResult
+    """
+    templatedir = os.path.abspath(templatedir)
+    targetdir = os.path.abspath(targetdir)
+    if os.path.exists(targetdir):
+        raise ProvisioningError("%s already exists" % targetdir)
+
+    template_smbconf = os.path.join(templatedir, "etc", "smb.conf")
+    if not os.path.exists(template_smbconf):
+        raise ProvisioningError("%s is not the target directory of a "
+                                "provision" % templatedir)
+
+    template_lp = samba.param.LoadParm()
+    template_lp.load(template_smbconf)
+    template_paths = provision_paths_from_lp(template_lp,
+                                             template_lp.get("realm").lower())
+    samdb = SamDB(url=template_paths.samdb, session_info=session_info,
+                  lp=template_lp)
+    secrets_ldb = Ldb(template_paths.secrets, session_info=session_info,
+                      lp=template_lp)
+    idmap = IDmapDB(template_paths.idmapdb, session_info=session_info,
+                    lp=template_lp)
+    old = find_provision_key_parameters(samdb, secrets_ldb, idmap,
+                                        template_paths, template_smbconf,
+                                        template_lp)
+    res = secrets_ldb.search(base="CN=Principals", scope=ldb.SCOPE_ONELEVEL,
+                             expression="(samAccountName=dns-*)", attrs=[])
+    if len(res) > 0:
+        raise ProvisioningError("Templates with a BIND9 DNS backend are "
+                                "not supported")
+    del samdb, secrets_ldb, idmap
+
+    if realm is None:
+        realm = old.realm
+    if domain is None:
+        domain = old.domain
+    if hostname is None:
+        hostname = old.hostname
+        netbiosname = old.netbiosname
+    else:
+        netbiosname = determine_netbios_name(hostname)
+    old_sysvol = os.path.join(os.sep, "sysvol", old.dnsdomain)
+
+    logger.info("Copying the provision in %s to %s" % (templatedir,
+                                                       targetdir))
+    shutil.copytree(templatedir, targetdir, symlinks=True)
+
+    # make_smbconf() wrote absolute paths below the template directory
+    smbconf = os.path.join(targetdir, "etc", "smb.conf")
+    f = open(smbconf, 'r')
+    try:
+        lines = f.readlines()
+    finally:
+        f.close()
+    settings = {
+        "realm": realm.upper(),
+        "workgroup": domain.upper(),
+        "netbios name": netbiosname,
+        }
+    for i, line in enumerate(lines):
+        (key, sep, value) = line.partition("=")
+        name = key.strip().lower()
+        value = value.strip()
+        if not sep:
+            continue
+        if name in settings:
+            value = settings[name]
+        elif value == templatedir or value.startswith(templatedir + os.sep):
+            value = targetdir + value[len(templatedir):]
+            if old_sysvol in value:
+                value = value.replace(old_sysvol, os.path.join(
+                    os.sep, "sysvol", realm.lower()), 1)
+        else:
+            continue
+        lines[i] = "%s= %s\n" % (key, value)
+    f = open(smbconf, 'w')
+    try:
+        f.writelines(lines)
+    finally:
+        f.close()
+
+    lp = samba.param.LoadParm()
+    lp.load(smbconf)
+    names = guess_names(lp=lp, hostname=hostname, domain=domain,
+                        dnsdomain=realm, serverrole=lp.get("server role"),
+                        sitename=old.sitename)
+    paths = provision_paths_from_lp(lp, names.dnsdomain)
+
+    if domainsid is None:
+        names.domainsid = security.random_sid()
+    else:
+        names.domainsid = security.dom_sid(domainsid)
+    if invocationid is None:
+        invocationid = str(uuid.uuid4())
+    names.invocation = invocationid
+
+    # Things of the template that are rebuilt from scratch, or that are
+    # keyed by the inode of a file and so mean nothing in the copy
+    stale = [os.path.join(paths.private_dir, "secrets.tdb"),
+             os.path.join(paths.private_dir, "tls"),
+             lp.get("posix:eadb"), lp.get("xattr_tdb:file")]
+    for path in stale:
+        if not path or not os.path.exists(path):
+            continue
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.unlink(path)
+
+    logger.info("Rewriting the databases for the domain %s (SID %s)" % (
+        names.dnsdomain, names.domainsid))
+    try:
+        guid_map = collect_guid_map(
+            [os.path.join(os.path.dirname(paths.samdb), path) for
+             (dn, path) in read_partitions(paths.samdb, lp)], lp)
+        guid_map[old.invocation] = names.invocation
+        accounts = rewrite_provision(lp, paths.samdb, paths.idmapdb, old,
+                                     names, guid_map, hostip=hostip,
+                                     hostip6=hostip6)
+    except ValueError as e:
+        raise ProvisioningError("Unable to rewrite %s: %s" % (targetdir, e))
+    names.ntdsguid = guid_map[old.ntdsguid]
+    names.domainguid = guid_map[old.domainguid]
+
+    if os.path.exists(paths.encrypted_secrets_key_path):
+        # Nothing encrypted with the key of the template is left
+        setup_encrypted_secrets_key(paths.encrypted_secrets_key_path)
+
+    if names.dnsdomain != old.dnsdomain:
+        os.rename(os.path.join(paths.sysvol, old.dnsdomain),
+                  os.path.join(paths.sysvol, names.dnsdomain))
+
+    if adminpass is None:
+        adminpass = samba.generate_random_password(12, 32)
+        adminpass_generated = True
+    else:
+        adminpass = unicode(adminpass, 'utf-8')
+        adminpass_generated = False
+    if krbtgtpass is None:
+        krbtgtpass = samba.generate_random_machine_password(128, 255)
+    if machinepass is None:
+        machinepass = samba.generate_random_machine_password(128, 255)
+
+    # This also writes the @INDEXLIST that the rewrite left out, which
+    # indexes the databases again
+    samdb = SamDB(url=paths.samdb, session_info=session_info, lp=lp)
+
+    logger.info("Setting the passwords of %d accounts" % len(accounts))
+    machine_account = "%s$" % names.netbiosname
+    samdb.transaction_start()
+    try:
+        for (dn, rid, account_name) in accounts:
+            if rid == security.DOMAIN_RID_ADMINISTRATOR:
+                password = adminpass
+            elif rid == security.DOMAIN_RID_KRBTGT:
+                password = krbtgtpass
+            elif account_name == machine_account:
+                password = machinepass
+            else:
+                password = samba.generate_random_password(128, 255)
+            # Not samdb.setpassword(), which would enable krbtgt
+            m = ldb.Message()
+            m.dn = ldb.Dn(samdb, dn)
+            m["unicodePwd"] = ldb.MessageElement(
+                (u'"%s"' % password).encode('utf-16-le'),
+                ldb.FLAG_MOD_REPLACE, "unicodePwd")
+            samdb.modify(m)
+
+        res = samdb.search(base=samdb.domain_dn(), scope=ldb.SCOPE_SUBTREE,
+                           expression="(sAMAccountName=%s)" %
+                           ldb.binary_encode(machine_account),
+                           attrs=["msDS-KeyVersionNumber"])
+        kvno = int(res[0]["msDS-KeyVersionNumber"][0])
+    except:
+        samdb.transaction_cancel()
+        raise
+    else:
+        samdb.transaction_commit()
+
+    secrets_ldb = setup_secretsdb(paths, session_info, None, lp)
+    try:
+        secretsdb_self_join(secrets_ldb, domain=names.domain,
+                            realm=names.realm, dnsdomain=names.dnsdomain,
+                            netbiosname=names.netbiosname,
+                            domainsid=names.domainsid,
+                            machinepass=machinepass,
+                            key_version_number=kvno,
+                            secure_channel_type=SEC_CHAN_BDC)
+    except:
+        secrets_ldb.transaction_cancel()
+        raise
+    else:
+        secrets_ldb.transaction_commit()
+
+    if not is_heimdal_built():
+        create_kdc_conf(paths.kdcconf, names.realm, names.domain,
+                        os.path.dirname(lp.get("log file")))
+    create_krb5_conf(paths.krb5conf, dnsdomain=names.dnsdomain,
+                     hostname=names.hostname, realm=names.realm)
+
+    if not skip_sysvolacl:
+        # The NT ACLs of sysvol are not copied with the files, and name
+        # the SIDs of the template anyway
+        if use_ntvfs is None:
+            use_ntvfs = "smb" in lp.get("server services")
+        root_uid = findnss_uid(["root"])
+        setsysvolacl(samdb, paths.netlogon, paths.sysvol, root_uid,
+                     pwd.getpwuid(root_uid).pw_gid, names.domainsid,
+                     names.dnsdomain, names.domaindn, lp, use_ntvfs)
+    else:
+        logger.info("Setting acl on sysvol skipped")
+
+    result = ProvisionResult()
+    result.server_role = lp.get("server role")
+    result.domaindn = names.domaindn
+    result.paths = paths
+    result.names = names
+    result.lp = lp
+    result.samdb = samdb
+    result.idmap = IDmapDB(paths.idmapdb, session_info=session_info, lp=lp)
+    result.domainsid = str(names.domainsid)
+    result.adminpass_generated = adminpass_generated
+    result.adminpass = adminpass
+    return result
+
+
 def create_krb5_conf(path, dnsdomain, hostname, realm):
     """Write out a file containing a valid krb5.conf file
 
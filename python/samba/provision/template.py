@@ -0,0 +1,418 @@
+# Unix SMB/CIFS implementation.
+# Stamp out new domains from an existing provision
+#
+# Copyright (C) Catalyst IT Ltd. 2018
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Rewrite a copy of a provision so that it holds a new domain.
+
+The databases are rewritten without any modules loaded, record by
+record, into new files.  The @INDEXLIST records of the sam.ldb files
+are not carried over: the first full open of the result writes them
+again from the schema, which rebuilds every index with the syntaxes
+of the schema.
+"""
+
+import os
+import re
+import uuid
+
+import ldb
+import samba
+from samba.dcerpc import dnsp, misc, security
+from samba.ndr import ndr_pack, ndr_unpack
+
+# Secret attributes that resetting the password of the account
+# generates again
+PASSWORD_ATTRIBUTES = frozenset([
+    "unicodepwd",
+    "dbcspwd",
+    "ntpwdhistory",
+    "lmpwdhistory",
+    "supplementalcredentials",
+    "cleartextpassword",
+    ])
+
+# The rest of DSDB_SECRET_ATTRIBUTES, which we can not regenerate
+OTHER_SECRET_ATTRIBUTES = frozenset([
+    "peklist",
+    "msds-executescriptpassword",
+    "currentvalue",
+    "priorvalue",
+    "initialauthincoming",
+    "initialauthoutgoing",
+    "trustauthincoming",
+    "trustauthoutgoing",
+    ])
+
+# What the DN (or host name) of a DNS label may not be next to
+LABEL_BEFORE = r'(?<![A-Za-z0-9-])'
+LABEL_AFTER = r'(?![A-Za-z0-9-])'
+
+# Where a DN starts within a value: at the start, after the extended
+# components or after the binary part of a DN+Binary
+DN_START = r'(^|[,;:])'
+
+GUID_RE = re.compile(r'(?<![0-9A-Fa-f-])'
+                     r'[0-9A-Fa-f]{8}-[0-9A-Fa-f]{4}-[0-9A-Fa-f]{4}-'
+                     r'[0-9A-Fa-f]{4}-[0-9A-Fa-f]{12}'
+                     r'(?![0-9A-Fa-f-])')
+
+CONTROL_RE = re.compile(u'[\x00-\x08\x0b\x0c\x0e-\x1f\x7f]')
+
+
+def case_like(found, new):
+    """Return new in the case of found, for names that we match
+    ignoring case."""
+    if found.isupper():
+        return new.upper()
+    if found.islower():
+        return new.lower()
+    return new
+
+
+def ldb_records(db):
+    """Return every record of a database opened without modules, apart
+    from those that ldb builds itself."""
+    res = db.search(expression="")
+    return [msg for msg in res
+            if not str(msg.dn).startswith("@INDEX:") and
+            str(msg.dn) != "@BASEINFO"]
+
+
+def open_raw(path, lp):
+    return samba.Ldb(url=path, lp=lp, options=["modules:"])
+
+
+def read_partitions(samdb_path, lp):
+    """Return the (dn, path) of each partition in sam.ldb, where path is
+    relative to the directory of sam.ldb.
+
+    :raise ValueError: if sam.ldb keeps its data in LDAP
+    """
+    db = open_raw(samdb_path, lp)
+    res = db.search(base="@PARTITION", scope=ldb.SCOPE_BASE,
+                    attrs=["partition", "ldapBackend"])
+    if "ldapBackend" in res[0]:
+        raise ValueError("the partitions of %s are kept in LDAP" %
+                         samdb_path)
+    partitions = []
+    for value in res[0]["partition"]:
+        (dn, sep, path) = str(value).partition(":")
+        partitions.append((dn, path))
+    return partitions
+
+
+def collect_guid_map(paths, lp):
+    """Return a new objectGUID for each of the objects in the given
+    databases, as a dict of GUID strings."""
+    guid_map = {}
+    for path in paths:
+        db = open_raw(path, lp)
+        res = db.search(expression="(objectGUID=*)", attrs=["objectGUID"])
+        for msg in res:
+            old = str(ndr_unpack(misc.GUID, msg["objectGUID"][0]))
+            guid_map[old] = str(uuid.uuid4())
+    return guid_map
+
+
+class IdentityRewriter(object):
+    """Rewrites the records of one domain into those of another.
+
+    :param old: ProvisionNames of the template
+    :param new: ProvisionNames of the new domain
+    :param guid_map: New GUID strings by the GUID strings of the
+        template, covering every objectGUID and the invocationId
+    :param hostip: IPv4 address to give the DC in DNS, if it changes
+    :param hostip6: IPv6 address to give the DC in DNS, if it changes
+    """
+
+    def __init__(self, old, new, guid_map, hostip=None, hostip6=None):
+        self.guid_map = dict((k.lower(), v.lower())
+                             for (k, v) in guid_map.items())
+        self.hostip = hostip
+        self.hostip6 = hostip6
+
+        self.blob_guid_map = {}
+        for (k, v) in self.guid_map.items():
+            self.blob_guid_map[ndr_pack(misc.GUID(k))] = ndr_pack(misc.GUID(v))
+
+        old_sid = ndr_pack(old.domainsid)
+        new_sid = ndr_pack(new.domainsid)
+        if len(old_sid) != len(new_sid):
+            raise ValueError("the domain SID %s is not the same length as "
+                             "%s" % (new.domainsid, old.domainsid))
+
+        # Every SID of the domain carries the identifier authority and
+        # sub-authorities of the domain SID after its first two bytes.
+        # The invocationId and the GUID of the DSA are embedded in the
+        # replication metadata, the up-to-dateness vectors and the
+        # schemaInfo.
+        self.blob_substitutions = [(old_sid[2:], new_sid[2:])]
+        for guid in (old.invocation, old.ntdsguid):
+            blob = ndr_pack(misc.GUID(guid))
+            self.blob_substitutions.append((blob, self.blob_guid_map[blob]))
+
+        self.text_rules = []
+        self.value_rules = {}
+
+        def add_rule(pattern, repl):
+            self.text_rules.append((re.compile(pattern, re.IGNORECASE),
+                                    repl))
+
+        if old.netbiosname.lower() != new.netbiosname.lower() or \
+                old.hostname.lower() != new.hostname.lower():
+            hosts = {}
+            hosts[old.hostname.lower()] = new.hostname
+            hosts.setdefault(old.netbiosname.lower(),
+                             new.netbiosname.lower())
+            add_rule(LABEL_BEFORE + '(%s)' %
+                     '|'.join(re.escape(h) for h in hosts) +
+                     r'(?=\.%s%s)' % (re.escape(old.dnsdomain),
+                                      LABEL_AFTER),
+                     lambda m: case_like(m.group(1),
+                                         hosts[m.group(1).lower()]))
+            add_rule(DN_START + r'(CN=)%s'
+                     r'(?=,(?:OU=Domain Controllers|CN=Servers),)' %
+                     re.escape(old.netbiosname),
+                     lambda m: m.group(1) + m.group(2) + new.netbiosname)
+            add_rule(DN_START + r'(DC=)%s(?=,DC=[^,]+,CN=MicrosoftDNS,)' %
+                     re.escape(old.hostname),
+                     lambda m: m.group(1) + m.group(2) + new.hostname)
+            add_rule(LABEL_BEFORE + r'(dns-)%s' % re.escape(old.hostname) +
+                     LABEL_AFTER,
+                     lambda m: m.group(1) + new.hostname)
+            self.value_rules["samaccountname"] = {
+                old.netbiosname.lower() + "$": new.netbiosname + "$",
+                }
+            self.value_rules["mssfu30masterservername"] = {
+                old.netbiosname.lower(): new.netbiosname,
+                }
+            self.value_rules["description"] = {
+                "dns service account for %s" % old.hostname.lower():
+                "DNS Service Account for %s" % new.hostname,
+                }
+
+        if old.domain.lower() != new.domain.lower():
+            add_rule(DN_START + r'(CN=)(%s)'
+                     r'(?=,(?:CN=Partitions|CN=[^,]+,CN=ypServ30),)' %
+                     re.escape(old.domain),
+                     lambda m: m.group(1) + m.group(2) +
+                     case_like(m.group(3), new.domain))
+            self.value_rules["netbiosname"] = {
+                old.domain.lower(): new.domain,
+                }
+            self.value_rules["mssfu30domains"] = {
+                old.domain.lower(): new.domain.lower(),
+                }
+
+        if old.dnsdomain.lower() != new.dnsdomain.lower():
+            add_rule(DN_START + '(%s)(?=$|[,;])' % re.escape(old.domaindn),
+                     lambda m: m.group(1) + case_like(m.group(2),
+                                                      new.domaindn))
+            add_rule(LABEL_BEFORE + '(%s)' % re.escape(old.dnsdomain) +
+                     LABEL_AFTER,
+                     lambda m: case_like(m.group(1), new.dnsdomain))
+
+        if old.domainsid != new.domainsid:
+            add_rule(re.escape(str(old.domainsid)) + '(?![0-9])',
+                     lambda m: str(new.domainsid))
+
+        add_rule(GUID_RE.pattern, self._replace_guid)
+
+    def _replace_guid(self, m):
+        found = m.group(0)
+        new = self.guid_map.get(found.lower())
+        if new is None:
+            return found
+        return case_like(found, new)
+
+    def rewrite_text(self, text):
+        for (regex, repl) in self.text_rules:
+            text = regex.sub(repl, text)
+        return text
+
+    def rewrite_blob(self, blob):
+        for (old, new) in self.blob_substitutions:
+            blob = blob.replace(old, new)
+        return blob
+
+    def rewrite_dns_record(self, value, root_hints):
+        rec = ndr_unpack(dnsp.DnssrvRpcRecord, value)
+        if rec.wType in (dnsp.DNS_TYPE_CNAME, dnsp.DNS_TYPE_NS,
+                         dnsp.DNS_TYPE_PTR):
+            rec.data = self.rewrite_text(rec.data)
+        elif rec.wType == dnsp.DNS_TYPE_SOA:
+            rec.data.mname = self.rewrite_text(rec.data.mname)
+            rec.data.rname = self.rewrite_text(rec.data.rname)
+        elif rec.wType in (dnsp.DNS_TYPE_SRV, dnsp.DNS_TYPE_MX):
+            rec.data.nameTarget = self.rewrite_text(rec.data.nameTarget)
+        elif root_hints:
+            pass
+        elif rec.wType == dnsp.DNS_TYPE_A and self.hostip is not None:
+            rec.data = self.hostip
+        elif rec.wType == dnsp.DNS_TYPE_AAAA and self.hostip6 is not None:
+            rec.data = self.hostip6
+        return ndr_pack(rec)
+
+    def rewrite_value(self, attr, value):
+        if len(value) == 16 and value in self.blob_guid_map:
+            return self.blob_guid_map[value]
+        try:
+            text = value.decode('utf-8')
+        except UnicodeDecodeError:
+            return self.rewrite_blob(value)
+        if CONTROL_RE.search(text):
+            return self.rewrite_blob(value)
+
+        known = self.value_rules.get(attr.lower(), {}).get(text.lower())
+        if known is not None:
+            return known.encode('utf-8')
+        return self.rewrite_text(text).encode('utf-8')
+
+    def rewrite_partition(self, value):
+        """Rewrite the dn:path value of the partition attribute of
+        @PARTITION, renaming the file with the partition."""
+        (dn, sep, path) = value.partition(":")
+        (dirname, basename) = os.path.split(path)
+        if basename.lower().endswith(".ldb"):
+            basename = self.rewrite_text(basename[:-4]) + basename[-4:]
+        return "%s:%s" % (self.rewrite_text(dn),
+                          os.path.join(dirname, basename))
+
+    def rewrite_message(self, db, msg):
+        """Return the record msg of the template as it is in the new
+        domain, and whether it held a password.
+
+        :raise ValueError: if msg holds a secret other than a password
+        """
+        old_dn = str(msg.dn)
+        new = ldb.Message()
+        new.dn = ldb.Dn(db, self.rewrite_text(old_dn))
+        root_hints = ",dc=rootdnsservers," in old_dn.lower()
+        has_password = False
+
+        for attr in msg.keys():
+            lattr = attr.lower()
+            if lattr in ("dn", "distinguishedname"):
+                continue
+            if lattr in PASSWORD_ATTRIBUTES:
+                has_password = True
+                continue
+            if lattr in OTHER_SECRET_ATTRIBUTES:
+                raise ValueError("%s holds the secret attribute %s" %
+                                 (old_dn, attr))
+            if old_dn == "@PARTITION" and lattr == "partition":
+                values = [self.rewrite_partition(str(v)) for v in msg[attr]]
+            elif lattr == "dnsrecord":
+                values = []
+                for v in msg[attr]:
+                    v = self.rewrite_dns_record(str(v), root_hints)
+                    if v not in values:
+                        values.append(v)
+            else:
+                values = [self.rewrite_value(attr, str(v))
+                          for v in msg[attr]]
+            new[attr] = ldb.MessageElement(values, 0, attr)
+
+        if not new.dn.is_special() and new.dn != msg.dn:
+            # The RDN attribute and name follow the DN
+            rdn_names = (new.dn.get_rdn_name().lower(), "name")
+            rdn_value = new.dn.get_rdn_value()
+            for attr in new.keys():
+                if attr.lower() in rdn_names:
+                    new[attr] = ldb.MessageElement([rdn_value], 0, attr)
+
+        return (new, has_password)
+
+    def rewrite_ldb(self, lp, path, new_path, keep_indexes=True):
+        """Write the records of the database at path, as they are in
+        the new domain, to a new database at new_path.
+
+        :return: the (dn, rid, sAMAccountName) of each account whose
+            password was dropped
+        """
+        old_db = open_raw(path, lp)
+        new_db = open_raw(new_path, lp)
+
+        records = ldb_records(old_db)
+        if not keep_indexes:
+            records = [msg for msg in records
+                       if str(msg.dn) != "@INDEXLIST"]
+
+        # @ATTRIBUTES and @INDEXLIST decide how the rest is stored
+        def order(msg):
+            dn = str(msg.dn)
+            return (dn != "@ATTRIBUTES", dn != "@INDEXLIST",
+                    not dn.startswith("@"))
+        records.sort(key=order)
+
+        accounts = []
+        new_db.transaction_start()
+        try:
+            for msg in records:
+                (new, has_password) = self.rewrite_message(new_db, msg)
+                new_db.add(new)
+                if has_password:
+                    rid = None
+                    if "objectSid" in new:
+                        sid = ndr_unpack(security.dom_sid,
+                                         new["objectSid"][0])
+                        rid = sid.split()[1]
+                    account_name = None
+                    if "sAMAccountName" in new:
+                        account_name = str(new["sAMAccountName"][0])
+                    accounts.append((str(new.dn), rid, account_name))
+        except:
+            new_db.transaction_cancel()
+            raise
+        else:
+            new_db.transaction_commit()
+        return accounts
+
+
+def rewrite_provision(lp, samdb_path, idmapdb_path, old, new, guid_map,
+                      hostip=None, hostip6=None):
+    """Rewrite the sam.ldb and idmap.ldb of a copied provision in place,
+    so that they hold the new domain.
+
+    The partitions of sam.ldb are renamed with their DNs.
+
+    :return: the (dn, rid, sAMAccountName) of each account whose
+        password was dropped
+    """
+    rewriter = IdentityRewriter(old, new, guid_map, hostip=hostip,
+                                hostip6=hostip6)
+    samdb_dir = os.path.dirname(samdb_path)
+
+    accounts = []
+    for (dn, path) in read_partitions(samdb_path, lp):
+        new_path = os.path.join(samdb_dir,
+                                rewriter.rewrite_partition(
+                                    "%s:%s" % (dn, path)).partition(":")[2])
+        old_path = os.path.join(samdb_dir, path)
+        accounts.extend(rewriter.rewrite_ldb(lp, old_path,
+                                             new_path + ".new",
+                                             keep_indexes=False))
+        os.unlink(old_path)
+        os.rename(new_path + ".new", new_path)
+
+    for (path, keep_indexes) in ((samdb_path, False), (idmapdb_path, True)):
+        rewriter.rewrite_ldb(lp, path, path + ".new",
+                             keep_indexes=keep_indexes)
+        os.rename(path + ".new", path)
+
+    return accounts
@@ -30,11 +30,19 @@ import os
 from samba import dsdb, dsdb_dns
 from samba.ndr import ndr_unpack, ndr_pack
 from samba.dcerpc import drsblobs, misc
-from samba.common import normalise_int32
+from samba.common import normalise_int32, dsdb_Dn
 from samba.compat import text_type
 
 __docformat__ = "restructuredText"
 
+# Matching rule used to find objects carrying expired deleted links,
+# see DSDB_MATCH_FOR_EXPUNGE in ldb_matching_rules.h
+DSDB_MATCH_FOR_EXPUNGE = "1.3.6.1.4.1.7165.4.5.2"
+
+# Used when the forest does not set tombstoneLifetime, as in
+# dsdb_tombstone_lifetime()
+DEFAULT_TOMBSTONE_LIFETIME = 180
+
 
 class SamDB(samba.Ldb):
     """The SAM database."""
@@ -908,6 +916,14 @@ accountExpires: %u
 
         return dsheuristics
 
+    def get_tombstone_lifetime(self):
+        res = self.search("CN=Directory Service,CN=Windows NT,CN=Services,%s"
+                          % self.get_config_basedn().get_linearized(),
+                          scope=ldb.SCOPE_BASE, attrs=["tombstoneLifetime"])
+        if len(res) == 0 or "tombstoneLifetime" not in res[0]:
+            return DEFAULT_TOMBSTONE_LIFETIME
+        return int(res[0]["tombstoneLifetime"][0])
+
     def create_ou(self, ou_dn, description=None, name=None, sd=None):
         """Creates an organizationalUnit object
         :param ou_dn: dn of the new object
@@ -993,6 +1009,139 @@ accountExpires: %u
                                                          current_time,
                                                          tombstone_lifetime)
 
+    def garbage_collect_tombstones_batched(self, dn, current_time,
+                                           tombstone_lifetime=None,
+                                           batch_size=1000):
+        '''garbage_collect_tombstones_batched([dn], current_time, tombstone_lifetime, batch_size)
+        -> iterator of (num_objects_expunged, num_links_expunged, skipped)
+
+        This removes the same tombstones and expired links as
+        garbage_collect_tombstones(), but each NC is scanned only once
+        and the expunge is then split into transactions covering at
+        most batch_size objects.  The counts for each batch are
+        yielded once it has been committed, outside any transaction,
+        so the caller may stop at any point: everything already
+        yielded stays expunged, and a later run simply finds less to
+        do.
+
+        As in the C garbage collector, an object that cannot be
+        expunged does not stop the run: it is left alone, and skipped
+        lists the (dn, error string) of each such object in the batch.'''
+
+        if tombstone_lifetime is None:
+            tombstone_lifetime = self.get_tombstone_lifetime()
+        expunge_time = current_time - tombstone_lifetime * 60 * 60 * 24
+        expunge_nttime = samba.unix2nttime(expunge_time)
+
+        # Only forward links hold deleted values with their own
+        # tombstone lifetime
+        res = self.search(self.get_schema_basedn(), scope=ldb.SCOPE_ONELEVEL,
+                          expression="(&(objectClass=attributeSchema)(linkID=*))",
+                          attrs=["lDAPDisplayName", "linkID"])
+        link_attrs = [str(msg["lDAPDisplayName"][0]) for msg in res
+                      if int(msg["linkID"][0]) & 1 == 0]
+
+        expression = "(|%s(&(isDeleted=TRUE)(whenChanged<=%s)))" % (
+            "".join(["(%s:%s:=%d)" % (attr, DSDB_MATCH_FOR_EXPUNGE,
+                                      expunge_nttime)
+                     for attr in link_attrs]),
+            ldb.timestring(expunge_time))
+
+        for nc in dn:
+            nc_dn = ldb.Dn(self, str(nc))
+            try:
+                deleted_objects_dn = self.get_wellknown_dn(nc_dn,
+                                        dsdb.DS_GUID_DELETED_OBJECTS_CONTAINER)
+            except KeyError:
+                # some partitions have no Deleted Objects container
+                continue
+
+            res = self.search(nc_dn, scope=ldb.SCOPE_SUBTREE,
+                              expression=expression, attrs=["isDeleted"],
+                              controls=["show_recycled:1",
+                                        "reveal_internals:0"])
+            pending = []
+            for msg in res:
+                is_deleted = ("isDeleted" in msg and
+                              str(msg["isDeleted"][0]).upper() == "TRUE")
+                if is_deleted and msg.dn == deleted_objects_dn:
+                    continue
+                pending.append((msg.dn, is_deleted))
+            del res
+
+            for i in range(0, len(pending), batch_size):
+                num_objects = 0
+                num_links = 0
+                skipped = []
+                self.transaction_start()
+                try:
+                    for (obj_dn, is_deleted) in pending[i:i + batch_size]:
+                        try:
+                            if is_deleted:
+                                num_objects += self._expunge_tombstone(obj_dn)
+                            else:
+                                num_links += self._expunge_links(obj_dn,
+                                                                 link_attrs,
+                                                                 expunge_nttime)
+                        except ldb.LdbError as e:
+                            (enum, estr) = e.args
+                            skipped.append((obj_dn, estr))
+                except:
+                    self.transaction_cancel()
+                    raise
+                self.transaction_commit()
+                yield (num_objects, num_links, skipped)
+
+    def _expunge_tombstone(self, dn):
+        try:
+            self.delete(dn, ["show_recycled:1", "relax:0"])
+        except ldb.LdbError as e:
+            (enum, estr) = e.args
+            if enum != ldb.ERR_NO_SUCH_OBJECT:
+                raise
+            # Already gone, eg it is below an NC we handled earlier
+            return 0
+        return 1
+
+    def _expunge_links(self, dn, link_attrs, expunge_nttime):
+        try:
+            res = self.search(dn, scope=ldb.SCOPE_BASE, attrs=link_attrs,
+                              controls=["show_recycled:1",
+                                        "reveal_internals:0",
+                                        "extended_dn:1:1"])
+        except ldb.LdbError as e:
+            (enum, estr) = e.args
+            if enum != ldb.ERR_NO_SUCH_OBJECT:
+                raise
+            return 0
+
+        m = ldb.Message()
+        m.dn = dn
+        num_links = 0
+        for attr in link_attrs:
+            if attr not in res[0]:
+                continue
+            expired = []
+            for val in res[0][attr]:
+                target = dsdb_Dn(self, str(val))
+                rmd_flags = target.dn.get_extended_component("RMD_FLAGS")
+                if rmd_flags is None or not int(rmd_flags) & 1:
+                    continue
+                changetime = target.dn.get_extended_component("RMD_CHANGETIME")
+                if changetime is None or int(changetime) >= expunge_nttime:
+                    continue
+                expired.append(str(val))
+            if len(expired) > 0:
+                m[attr] = ldb.MessageElement(expired, ldb.FLAG_MOD_DELETE,
+                                             attr)
+                num_links += len(expired)
+
+        if num_links > 0:
+            self.modify(m, controls=["show_recycled:1",
+                                     "local_oid:%s:0" %
+                                     dsdb.DSDB_CONTROL_REPLMD_VANISH_LINKS])
+        return num_links
+
     def create_own_rid_set(self):
         '''create a RID set for this DSA'''
         return dsdb._dsdb_create_own_rid_set(self)
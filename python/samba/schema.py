@@ -25,12 +25,98 @@
 from base64 import b64encode
 from samba import read_and_sub_file, substitute_var, check_all_substituted
 from samba.dcerpc import security
+from samba import ms_schema
 from samba.ms_schema import read_ms_schema
 from samba.ndr import ndr_pack
 from samba.samdb import SamDB
 from samba import dsdb
 from ldb import SCOPE_SUBTREE, SCOPE_ONELEVEL
 import os
+import re
+import uuid
+import shutil
+import hashlib
+import tempfile
+
+# Every Schema() converts the WSPP schema files with read_ms_schema()
+# and substitutes the schema DN into the result.  The converted LDIF
+# only depends on the content of the schema files and on the conversion
+# code, so it is kept here (keyed by a hash of those) and, if
+# SAMBA_SCHEMA_CACHE_DIR is set in the environment, on disk in that
+# directory, where it is shared between processes.
+#
+# This saves the conversion for every backend.  The schema partition
+# itself is not cached: with the default (ldb) backend, fill_samdb()
+# still adds the schema objects to sam.ldb through the full module
+# stack on every provision.  Only the schema-tmp.ldb of the OpenLDAP
+# and Fedora DS backends is kept, see Schema.write_to_tmp_ldb().
+_ms_schema_cache = {}
+_schema_data_cache = {}
+
+
+def schema_cache_dir():
+    """Returns the directory of the on-disk schema cache, or None"""
+    return os.environ.get("SAMBA_SCHEMA_CACHE_DIR")
+
+
+def _cache_write(path, data):
+    (fd, tmp) = tempfile.mkstemp(dir=os.path.dirname(path),
+                                 prefix=os.path.basename(path))
+    try:
+        os.write(fd, data)
+        os.close(fd)
+        os.rename(tmp, path)
+    except:
+        os.unlink(tmp)
+        raise
+
+
+def _new_object_guids(ldif):
+    """Gives every object in the (cached) schema LDIF a fresh objectGUID,
+    as read_ms_schema() would have done"""
+    return re.sub(r"(?m)^objectGUID: [0-9a-fA-F-]{36}$",
+                  lambda m: "objectGUID: %s" % uuid.uuid4(), ldif)
+
+
+def read_ms_schema_cached(attr_file, classes_file):
+    """Returns read_ms_schema(attr_file, classes_file), only converting
+    each version of the files once.
+
+    The objectGUIDs in the returned LDIF are shared by all callers, see
+    _new_object_guids().
+
+    :return: (key, ldif) where key identifies the content of the LDIF
+    """
+    h = hashlib.sha256()
+    converter = ms_schema.__file__
+    if converter.endswith((".pyc", ".pyo")) and os.path.exists(converter[:-1]):
+        converter = converter[:-1]
+    for path in (converter, attr_file, classes_file):
+        with open(path, 'r') as f:
+            h.update(hashlib.sha256(f.read()).digest())
+    key = h.hexdigest()
+
+    if key in _ms_schema_cache:
+        return (key, _ms_schema_cache[key])
+
+    cache_dir = schema_cache_dir()
+    cache_path = None
+    if cache_dir is not None:
+        cache_path = os.path.join(cache_dir, "ms-schema-%s.ldif" % key)
+        if os.path.exists(cache_path):
+            with open(cache_path, 'r') as f:
+                _ms_schema_cache[key] = f.read()
+            return (key, _ms_schema_cache[key])
+
+    data = read_ms_schema(attr_file, classes_file)
+    _ms_schema_cache[key] = data
+
+    if cache_path is not None:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, 0755)
+        _cache_write(cache_path, data)
+
+    return (key, data)
 
 def get_schema_descriptor(domain_sid, name_map={}):
     sddl = "O:SAG:SAD:AI(OA;;CR;e12b56b6-0a95-11d1-adbb-00c04fd8d5cd;;SA)" \
@@ -105,17 +191,27 @@ class Schema(object):
         if invocationid is not None:
             self.ldb.set_invocation_id(invocationid)
 
-        self.schema_data = read_ms_schema(
+        (key, ms_schema_data) = read_ms_schema_cached(
             setup_path('ad-schema/%s' % Schema.base_schemas[base_schema][0]),
             setup_path('ad-schema/%s' % Schema.base_schemas[base_schema][1]))
 
-        if files is not None:
-            for file in files:
-                self.schema_data += open(file, 'r').read()
+        if files is None and (key, schemadn) in _schema_data_cache:
+            self.schema_data = _schema_data_cache[(key, schemadn)]
+        else:
+            self.schema_data = ms_schema_data
+            if files is not None:
+                for file in files:
+                    self.schema_data += open(file, 'r').read()
+
+            self.schema_data = substitute_var(self.schema_data,
+                {"SCHEMADN": schemadn})
+            check_all_substituted(self.schema_data)
+            if files is None:
+                _schema_data_cache[(key, schemadn)] = self.schema_data
 
-        self.schema_data = substitute_var(self.schema_data,
-            {"SCHEMADN": schemadn})
-        check_all_substituted(self.schema_data)
+        # used to find a cached schema-tmp.ldb
+        self.schema_data_shared = self.schema_data
+        self.schema_data = _new_object_guids(self.schema_data)
 
         schema_version = str(Schema.get_version(base_schema))
         self.schema_dn_modify = read_and_sub_file(
@@ -156,6 +252,31 @@ class Schema(object):
         dsdb._dsdb_set_schema_from_ldif(self.ldb, pf, df, dn)
 
     def write_to_tmp_ldb(self, schemadb_path):
+        """Writes the schema to a stand-alone ldb at schemadb_path.
+
+        This is only used by the OpenLDAP and Fedora DS backends.  With
+        SAMBA_SCHEMA_CACHE_DIR set, the database built is kept there and
+        copied into place by later calls with the same LDIF.  Nothing
+        like that is done for the schema partition of the default
+        backend, which is built from scratch by every provision.
+        """
+        # The database is only searched for the schema definitions, so
+        # a copy of one built earlier for the same LDIF (apart from the
+        # objectGUIDs) can be used if we have it
+        cache_dir = schema_cache_dir()
+        template_path = None
+        if cache_dir is not None:
+            h = hashlib.sha256()
+            for ldif in (self.schema_dn_add, self.schema_dn_modify,
+                         self.schema_data_shared):
+                h.update(hashlib.sha256(ldif).digest())
+            template_path = os.path.join(cache_dir,
+                                         "schema-%s.ldb" % h.hexdigest())
+            if os.path.exists(template_path):
+                shutil.copyfile(template_path, schemadb_path)
+                self.ldb.connect(url=schemadb_path)
+                return
+
         self.ldb.connect(url=schemadb_path)
         self.ldb.transaction_start()
         try:
@@ -183,6 +304,12 @@ dn: @INDEXLIST
         else:
             self.ldb.transaction_commit()
 
+        if template_path is not None:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir, 0755)
+            with open(schemadb_path, 'rb') as f:
+                _cache_write(template_path, f.read())
+
     # Return a hash with the forward attribute as a key and the back as the
     # value
     def linked_attributes(self):
@@ -477,6 +477,35 @@ class AutoTimingTestResultDecorator(HookedTestResultDecorator):
         return self.decorated.time(a_datetime)
 
 
+class ProfilingTestResultDecorator(TestResultDecorator):
+    """Decorate a TestResult to profile each test with cProfile.
+
+    The statistics of each test are written to a file named after the
+    test id, with a ".pstats" suffix, in the given directory.  They can
+    be read with the pstats module.
+    """
+
+    def __init__(self, decorated, profile_dir):
+        super(ProfilingTestResultDecorator, self).__init__(decorated)
+        self.profile_dir = profile_dir
+        self._profile = None
+
+    def startTest(self, test):
+        import cProfile
+        result = self.decorated.startTest(test)
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+        return result
+
+    def stopTest(self, test):
+        if self._profile is not None:
+            self._profile.disable()
+            fn = "%s.pstats" % test.id().replace(os.sep, "_")
+            self._profile.dump_stats(os.path.join(self.profile_dir, fn))
+            self._profile = None
+        return self.decorated.stopTest(test)
+
+
 class SubunitTestRunner(object):
 
     def __init__(self, verbosity=None, buffer=None, stream=None):
@@ -491,6 +520,11 @@ class SubunitTestRunner(object):
         "Run the given test case or test suite."
         result = TestProtocolClient(self.stream)
         result = AutoTimingTestResultDecorator(result)
+        # Used by script/perf_benchmark.py to profile the performance
+        # tests.
+        profile_dir = os.environ.get("SAMBA_TEST_PROFILE_DIR")
+        if profile_dir:
+            result = ProfilingTestResultDecorator(result, profile_dir)
         test(result)
         return result
 
@@ -16,6 +16,8 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import os
+import json
 import samba.tests
 
 class SambaDnsUpdateTests(samba.tests.BlackboxTestCase):
@@ -57,3 +59,19 @@ class SambaDnsUpdateTests(samba.tests.BlackboxTestCase):
         self.assertTrue(" DNS deletes needed" in rpc_out, rpc_out)
         out = self.check_output("samba_dnsupdate --verbose")
         self.assertTrue("No DNS updates needed" in out, out + rpc_out)
+
+    def test_samba_dnsupdate_stats_file(self):
+        stats_file = os.path.join(self.tempdir, "dnsupdate-stats.json")
+        try:
+            out = self.check_output("samba_dnsupdate --verbose --parallel-checks=4 --stats-file=%s" % stats_file)
+            self.assertTrue("No DNS updates needed" in out, out)
+
+            stats = json.load(open(stats_file))
+            self.assertTrue(stats["names_checked"] > 0, stats)
+            self.assertEqual(stats["updates"], 0)
+            self.assertEqual(stats["deletes"], 0)
+            self.assertEqual(stats["nsupdate_calls"], 0)
+            self.assertEqual(stats["errors"], 0)
+        finally:
+            if os.path.exists(stats_file):
+                os.unlink(stats_file)
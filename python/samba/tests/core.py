@@ -49,6 +49,67 @@ class SubstituteVarTestCase(TestCase):
         self.assertRaises(Exception, samba.check_all_substituted,
                 "Not subsituted: ${FOOBAR}")
 
+    def test_multiple(self):
+        self.assertEquals("bla bla foo",
+                samba.substitute_var("${bar} ${bar} ${baz}",
+                                     {"bar": "bla", "baz": "foo"}))
+
+    def test_value_not_substituted(self):
+        self.assertEquals("foo ${baz}",
+                samba.substitute_var("foo ${bar}",
+                                     {"bar": "${baz}", "baz": "bla"}))
+
+    def test_render_template_check(self):
+        template = samba.parse_template("foo ${bar} ${baz}")
+        self.assertEquals("foo bla 1",
+                samba.render_template(template, {"bar": "bla", "baz": "1"},
+                                      check=True))
+        self.assertRaises(Exception, samba.render_template, template,
+                          {"bar": "bla"}, check=True)
+
+
+class ReadAndSubFileTestCase(TestCaseInTempDir):
+
+    def setUp(self):
+        super(ReadAndSubFileTestCase, self).setUp()
+        self.path = os.path.join(self.tempdir, "template.ldif")
+
+    def tearDown(self):
+        os.unlink(self.path)
+        super(ReadAndSubFileTestCase, self).tearDown()
+
+    def write(self, text):
+        f = open(self.path, 'w')
+        try:
+            f.write(text)
+        finally:
+            f.close()
+
+    def test_sub(self):
+        self.write("dn: ${DOMAINDN}\n")
+        self.assertEquals("dn: DC=samba,DC=example,DC=com\n",
+                samba.read_and_sub_file(self.path,
+                        {"DOMAINDN": "DC=samba,DC=example,DC=com"}))
+        self.assertEquals("dn: DC=foo\n",
+                samba.read_and_sub_file(self.path, {"DOMAINDN": "DC=foo"}))
+
+    def test_no_subst_vars(self):
+        self.write("dn: ${DOMAINDN}\n")
+        self.assertEquals("dn: ${DOMAINDN}\n",
+                samba.read_and_sub_file(self.path, None))
+
+    def test_not_all_substituted(self):
+        self.write("dn: ${DOMAINDN}\n")
+        self.assertRaises(Exception, samba.read_and_sub_file, self.path,
+                          {"CONFIGDN": "CN=Configuration"})
+
+    def test_file_changed(self):
+        self.write("dn: ${DOMAINDN}\n")
+        samba.read_and_sub_file(self.path, {"DOMAINDN": "DC=foo"})
+        self.write("dn: CN=Users,${DOMAINDN}\n")
+        self.assertEquals("dn: CN=Users,DC=foo\n",
+                samba.read_and_sub_file(self.path, {"DOMAINDN": "DC=foo"}))
+
 class ArcfourTestCase(TestCase):
 
     def test_arcfour_direct(self):
@@ -0,0 +1,63 @@
+# Tests for samba.drs_utils
+#
+# Copyright (C) Catalyst IT Ltd. 2018
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for samba.drs_utils"""
+
+import samba.tests
+from samba.dcerpc import drsuapi
+from samba.ndr import ndr_pack, ndr_unpack
+from samba.drs_utils import drs_ChunkSizer
+
+
+class DrsUtilsTests(samba.tests.TestCase):
+
+    def test_chunk_sizer(self):
+        sizer = drs_ChunkSizer(target_time=2.0)
+        req = drsuapi.DsGetNCChangesRequest8()
+        sizer.set_request(req)
+        self.assertEqual(req.max_object_count, 402)
+        self.assertEqual(req.max_ndr_size, 402116)
+
+        # quick, full chunks grow up to the maximum
+        for i in range(10):
+            sizer.update(0.1, sizer.max_object_count)
+        self.assertEqual(sizer.max_object_count, drs_ChunkSizer.MAX_OBJECTS)
+
+        # a short chunk means the server has run out or limited us
+        sizer = drs_ChunkSizer(target_time=2.0)
+        sizer.update(0.1, 50)
+        self.assertEqual(sizer.max_object_count, 402)
+
+        # slow chunks shrink down to the minimum
+        for i in range(10):
+            sizer.update(5.0, sizer.max_object_count)
+        self.assertEqual(sizer.max_object_count, drs_ChunkSizer.MIN_OBJECTS)
+        sizer.set_request(req)
+        self.assertEqual(req.max_ndr_size,
+                         402116 * drs_ChunkSizer.MIN_OBJECTS // 402)
+
+    def test_prefetched_chunk_round_trip(self):
+        # drs_Prefetcher passes chunks between processes packed as NDR
+        ctr = drsuapi.DsGetNCChangesCtr6()
+        ctr.more_data = 1
+        ctr.new_highwatermark.highest_usn = 12345
+        ctr.new_highwatermark.tmp_highest_usn = 12346
+        ctr2 = ndr_unpack(drsuapi.DsGetNCChangesCtr6, ndr_pack(ctr))
+        self.assertEqual(ctr2.more_data, 1)
+        self.assertEqual(ctr2.new_highwatermark.highest_usn, 12345)
+        self.assertEqual(ctr2.new_highwatermark.tmp_highest_usn, 12346)
+        self.assertEqual(ctr2.object_count, 0)
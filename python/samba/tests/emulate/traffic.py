@@ -17,6 +17,13 @@
 
 # from pprint import pprint
 from cStringIO import StringIO
+import time
+import random
+import json
+import os
+import gzip
+import shutil
+import tempfile
 
 import samba.tests
 
@@ -93,8 +100,11 @@ class TrafficEmulatorTests(samba.tests.TestCase):
         f.seek(0)
         model2.load(f)
 
-        self.assertEqual(expected_ngrams, model2.ngrams)
-        self.assertEqual(expected_query_details, model2.query_details)
+        self.assertEqual(expected_ngrams,
+                         {k: list(v) for k, v in model2.ngrams.items()})
+        self.assertEqual(expected_query_details,
+                         {k: list(v)
+                          for k, v in model2.query_details.items()})
 
     def test_parse_ngrams(self):
         f = open(TEST_FILE)
@@ -156,5 +166,311 @@ class TrafficEmulatorTests(samba.tests.TestCase):
         f.seek(0)
         model2.load(f)
 
-        self.assertEqual(expected_ngrams, model2.ngrams)
-        self.assertEqual(expected_query_details, model2.query_details)
+        self.assertEqual(expected_ngrams,
+                         {k: list(v) for k, v in model2.ngrams.items()})
+        self.assertEqual(expected_query_details,
+                         {k: list(v)
+                          for k, v in model2.query_details.items()})
+
+    def test_weighted_choice(self):
+        choices = traffic.WeightedChoice([('a', 3), ('b', 1)])
+        choices.add('c', 5)
+        choices.add('a')
+        expanded = list(choices)
+        self.assertEqual(expanded, ['a'] * 4 + ['b'] + ['c'] * 5)
+        self.assertEqual(len(choices), 10)
+
+        # sampling the counts picks exactly what random.choice() would
+        # have picked from the expanded list
+        random.seed(3)
+        expected = [random.choice(expanded) for i in range(1000)]
+        random.seed(3)
+        actual = [choices.choice() for i in range(1000)]
+        self.assertEqual(expected, actual)
+
+    def test_load_model_version(self):
+        f = open(TEST_FILE)
+        (conversations,
+         interval,
+         duration,
+         dns_counts) = traffic.ingest_summaries([f])
+        f.close()
+        self.model.learn(conversations, dns_counts)
+        f = StringIO()
+        self.model.save(f)
+        d = json.loads(f.getvalue())
+        self.assertEqual(d['version'], traffic.MODEL_VERSION)
+
+        # models saved before the version key was added still load
+        del d['version']
+        model2 = traffic.TrafficModel()
+        model2.load(StringIO(json.dumps(d)))
+        self.assertEqual({k: sorted(v) for k, v in self.model.ngrams.items()},
+                         {k: sorted(v) for k, v in model2.ngrams.items()})
+
+        d['version'] = traffic.MODEL_VERSION + 1
+        self.assertRaises(ValueError, traffic.TrafficModel().load,
+                          StringIO(json.dumps(d)))
+
+    def test_learn_summaries(self):
+        f = open(TEST_FILE)
+        (conversations,
+         interval,
+         duration,
+         dns_counts) = traffic.ingest_summaries([f])
+        f.close()
+        self.model.learn(conversations, dns_counts)
+        expected = StringIO()
+        self.model.save(expected)
+
+        tempdir = tempfile.mkdtemp()
+        try:
+            compressed = os.path.join(tempdir, 'summary.gz')
+            gz = gzip.open(compressed, 'wb')
+            gz.write(open(TEST_FILE).read())
+            gz.close()
+
+            for f in (TEST_FILE, compressed):
+                model = traffic.learn_summaries([f])
+                actual = StringIO()
+                model.save(actual)
+                self.assertEqual(expected.getvalue(), actual.getvalue())
+
+            # two workers each learn the same summary, so every count
+            # doubles
+            model = traffic.learn_summaries([TEST_FILE, compressed], jobs=2)
+            for k, v in self.model.ngrams.items():
+                self.assertEqual(sorted((p, 2 * n) for p, n in v.items()),
+                                 sorted(model.ngrams[k].items()))
+            self.assertEqual(model.conversation_rate[0],
+                             2 * self.model.conversation_rate[0])
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_summary_reader_idle_timeout(self):
+        reader = traffic.SummaryReader()
+        conversations = list(reader.conversations([TEST_FILE]))
+        endpoints = [c.endpoints for c in conversations]
+        self.assertEqual(len(set(endpoints)), len(endpoints))
+
+        # with a tiny timeout, conversations with gaps get split up
+        reader = traffic.SummaryReader(idle_timeout=0.001)
+        split = list(reader.conversations([TEST_FILE]))
+        self.assertGreater(len(split), len(conversations))
+        self.assertEqual(sum(len(c) for c in split),
+                         sum(len(c) for c in conversations))
+        self.assertEqual(set(c.endpoints for c in split), set(endpoints))
+
+    def test_conversation_rate_idle_timeout(self):
+        # with an idle timeout the conversation between 3 and 2 is
+        # closed, and learnt, before the earlier one between 1 and 2.
+        lines = ["%f\t06\t1\t%d\t2\tldap\t3\tsearchRequest\n" % (t, src)
+                 for (t, src) in ((0.0, 1), (0.5, 3), (1.5, 1), (3.0, 1),
+                                  (4.5, 1), (5.0, 4), (6.0, 1))]
+        tempdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tempdir, 'summary')
+            f = open(filename, 'w')
+            f.writelines(lines)
+            f.close()
+
+            reader = traffic.SummaryReader(idle_timeout=2.0)
+            starts = [c.start_time for c in reader.conversations([filename])]
+            self.assertEqual(starts, [0.5, 0.0, 5.0])
+
+            model = traffic.learn_summaries([filename], idle_timeout=2.0)
+            self.assertEqual(model.conversation_rate, [3, 5.0])
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_connection_pool(self):
+        class Account(object):
+            def __init__(self, name):
+                self.netbios_name = name
+                self.username = name
+
+        def new_context(ldap=None):
+            context = traffic.ReplayContext.__new__(traffic.ReplayContext)
+            context.reset_connections()
+            if ldap is not None:
+                context.ldap_connections.append(ldap)
+            return context
+
+        a = Account('a')
+        b = Account('b')
+        pool = traffic.ConnectionPool(2)
+
+        # nothing is kept for a conversation without connections
+        pool.release(a, new_context())
+        self.assertFalse(pool.acquire(a, new_context()))
+
+        pool.release(a, new_context('ldap-a'))
+        context = new_context()
+        self.assertFalse(pool.acquire(b, context))
+        self.assertTrue(pool.acquire(a, context))
+        self.assertEqual(context.ldap_connections, ['ldap-a'])
+        self.assertFalse(pool.acquire(a, new_context()))
+
+        # the least recently released connections are dropped first
+        pool.release(a, new_context('ldap-a1'))
+        pool.release(b, new_context('ldap-b'))
+        pool.release(a, new_context('ldap-a2'))
+        context = new_context()
+        self.assertTrue(pool.acquire(a, context))
+        self.assertEqual(context.ldap_connections, ['ldap-a2'])
+        self.assertFalse(pool.acquire(a, new_context()))
+        self.assertEqual((pool.hits, pool.misses, pool.evictions), (2, 4, 1))
+
+        pool = traffic.ConnectionPool(10, idle_timeout=0.01)
+        pool.release(a, new_context('ldap-a'))
+        time.sleep(0.02)
+        self.assertFalse(pool.acquire(a, new_context()))
+        self.assertEqual(pool.evictions, 1)
+
+    def test_replay_cooperatively(self):
+        # packet timestamps are relative to the start of their
+        # conversation, so the second conversation's packets come after
+        # all of the first's, even though their timestamps are smaller.
+        conversations = []
+        for start_time, timestamps in ((0.0, (0.0, 1.0, 10.0)),
+                                       (20.0, (0.0, 0.5)),
+                                       (5.0, (0.0, 2.0, 30.0))):
+            c = traffic.Conversation()
+            for t in timestamps:
+                c.add_packet(traffic.Packet(
+                    "%f\t06\t1\t1\t2\tldap\t3\tsearchRequest" %
+                    (start_time + t)))
+            conversations.append(c)
+
+        played = []
+
+        class FakeContext(object):
+            connection_pool = None
+
+            def copy_for_conversation(self):
+                return self
+
+            def generate_process_local_config(self, account, conversation):
+                pass
+
+        def play(packet, conversation, context):
+            played.append((conversation.start_time + packet.timestamp,
+                           conversation))
+
+        original_play = traffic.Packet.play
+        traffic.Packet.play = play
+        try:
+            # everything is overdue, so nothing sleeps
+            now = time.time()
+            traffic.replay_cooperatively([(c, None) for c in conversations],
+                                         now - 1e6, now + 1e6,
+                                         FakeContext())
+        finally:
+            traffic.Packet.play = original_play
+
+        self.assertEqual([t for t, c in played],
+                         [0.0, 1.0, 5.0, 7.0, 10.0, 20.0, 20.5, 35.0])
+        self.assertEqual([conversations.index(c) for t, c in played],
+                         [0, 0, 2, 2, 0, 1, 1, 2])
+
+    def test_replay_cooperatively_shared_account(self):
+        conversations = []
+        for start_time, timestamps in ((0.0, (0.0, 10.0)),
+                                       (5.0, (0.0, 1.0)),
+                                       (2.0, (0.0,))):
+            c = traffic.Conversation()
+            for t in timestamps:
+                c.add_packet(traffic.Packet(
+                    "%f\t06\t1\t1\t2\tldap\t3\tsearchRequest" %
+                    (start_time + t)))
+            conversations.append(c)
+        shared = object()
+        accounts = [shared, shared, object()]
+
+        played = []
+
+        class FakeContext(object):
+            connection_pool = None
+
+            def copy_for_conversation(self):
+                return self
+
+            def generate_process_local_config(self, account, conversation):
+                pass
+
+        def play(packet, conversation, context):
+            played.append(conversations.index(conversation))
+
+        original_play = traffic.Packet.play
+        traffic.Packet.play = play
+        try:
+            now = time.time()
+            traffic.replay_cooperatively(zip(conversations, accounts),
+                                         now - 1e6, now + 1e6,
+                                         FakeContext())
+        finally:
+            traffic.Packet.play = original_play
+
+        # the second conversation waits for the first to finish with
+        # the account they share
+        self.assertEqual(played, [0, 2, 0, 1, 1])
+
+    def test_latency_histogram(self):
+        random.seed(2)
+        values = [random.expovariate(100) for i in range(10000)]
+        h = traffic.LatencyHistogram()
+        for v in values[:5000]:
+            h.add(v)
+        h2 = traffic.LatencyHistogram()
+        for v in values[5000:]:
+            h2.add(v)
+        h.merge(traffic.LatencyHistogram.from_dict(h2.as_dict()))
+
+        values.sort()
+        self.assertEqual(h.count, len(values))
+        self.assertEqual(h.min, values[0])
+        self.assertEqual(h.max, values[-1])
+        self.assertAlmostEqual(h.mean(), sum(values) / len(values))
+        for p in (0.01, 0.5, 0.95, 0.99):
+            exact = traffic.calc_percentile(values, p)
+            self.assertAlmostEqual(h.percentile(p), exact,
+                                   delta=exact * traffic.LatencyHistogram.PRECISION)
+
+    def test_traffic_stats_merge(self):
+        lines = ["%f\t%d\tldap\t3\t%f\tTrue\t\n" % (100 + i, i % 5, i / 100.0)
+                 for i in range(50)]
+        lines.append("150.0\t9\tldap\t3\t0.5\tFalse\tboom\n")
+        lines.append("not a stats line\n")
+
+        stats = traffic.TrafficStats()
+        results = [stats.add_line(l) for l in lines]
+        self.assertEqual(results, [True] * 51 + [False])
+        self.assertEqual(stats.successful, 50)
+        self.assertEqual(stats.failed, 1)
+        self.assertEqual(stats.conversations(), 6)
+        self.assertEqual(stats.failures[('ldap', '3')], 1)
+        self.assertEqual(stats.latencies[('ldap', '3')].count, 51)
+
+        f = StringIO()
+        stats.save(f)
+        f.seek(0)
+        merged = traffic.TrafficStats()
+        merged.load(f)
+        merged.merge(stats)
+        self.assertEqual(merged.successful, 100)
+        self.assertEqual(merged.failed, 2)
+        self.assertEqual(merged.conversations(), 12)
+        self.assertEqual(merged.latencies[('ldap', '3')].count, 102)
+        self.assertEqual(merged.duration(), stats.duration())
+
+        tempdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tempdir, 'stats.json')
+            stats.save(path)
+            loaded = traffic.TrafficStats()
+            loaded.load(path)
+            self.assertEqual(loaded.successful, 50)
+            self.assertEqual(loaded.failed, 1)
+            self.assertEqual(loaded.latencies[('ldap', '3')].count, 51)
+        finally:
+            shutil.rmtree(tempdir)
@@ -27,6 +27,7 @@ from samba import graph
 
 import re
 import itertools
+import random
 
 
 class DotFileTests(samba.tests.TestCaseInTempDir):
@@ -150,3 +151,31 @@ class DistanceTests(samba.tests.TestCase):
                                           colour=colour)
                 print(s)
                 print()
+
+    def test_transitive_distance_random(self):
+        # compare with a naive all-pairs shortest path search
+        def naive_distance(vertices, edges):
+            inf = len(vertices) + 1
+            d = dict(((a, b), 0 if a == b else inf)
+                     for a in vertices for b in vertices)
+            for a, b in edges:
+                if a != b:
+                    d[(a, b)] = 1
+            for k in vertices:
+                for i in vertices:
+                    for j in vertices:
+                        if d[(i, k)] + d[(k, j)] < d[(i, j)]:
+                            d[(i, j)] = d[(i, k)] + d[(k, j)]
+            return dict((a, dict((b, d[(a, b)]) for b in vertices
+                                 if d[(a, b)] < inf))
+                        for a in vertices)
+
+        rng = random.Random(1)
+        for n in (1, 2, 5, 20, 40):
+            for n_edges in (0, n, 3 * n):
+                vertices = ['v%d' % i for i in range(n)]
+                edges = [(rng.choice(vertices), rng.choice(vertices))
+                         for i in range(n_edges)]
+                self.assertEqual(graph.find_transitive_distance(vertices,
+                                                                edges),
+                                 naive_distance(vertices, edges))
@@ -0,0 +1,105 @@
+# Performance tests for samba.graph distance calculations
+#
+# Copyright (C) Catalyst IT Ltd. 2018
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Time samba.graph.distance_matrix() on synthetic replication
+topologies of up to 1000 DSAs, of the kind samba-tool visualize draws.
+The time taken by each test is the benchmark."""
+
+from __future__ import print_function
+
+import random
+
+import samba.tests
+from samba import graph
+
+
+def dsa_names(n):
+    return ['CN=NTDS Settings,CN=DC%04d,CN=Servers,CN=Site%d' % (i, i % 10)
+            for i in range(n)]
+
+
+def ring(n):
+    """Each DSA replicates both ways with its neighbours, like the
+    intrasite topology the KCC generates"""
+    vertices = dsa_names(n)
+    edges = []
+    for i in range(n):
+        edges.append((vertices[i], vertices[(i + 1) % n]))
+        edges.append((vertices[(i + 1) % n], vertices[i]))
+    return vertices, edges
+
+
+def random_sparse(n, degree=3, seed=1):
+    """Each DSA has a few inbound connections from random DSAs"""
+    rng = random.Random(seed)
+    vertices = dsa_names(n)
+    edges = []
+    for v in vertices:
+        for i in range(degree):
+            edges.append((rng.choice(vertices), v))
+    return vertices, edges
+
+
+def hub_and_spoke(n, sites=10):
+    """Rings within each site, with the first DSA in each site (the
+    bridgehead) connected to the hub site's bridgehead"""
+    vertices = dsa_names(n)
+    edges = []
+    for s in range(sites):
+        members = vertices[s::sites]
+        for i in range(len(members)):
+            a = members[i]
+            b = members[(i + 1) % len(members)]
+            edges.append((a, b))
+            edges.append((b, a))
+        if s != 0:
+            edges.append((vertices[0], members[0]))
+            edges.append((members[0], vertices[0]))
+    return vertices, edges
+
+
+class GraphPerformanceTests(samba.tests.TestCase):
+
+    def _test_distance_matrix(self, vertices, edges):
+        s = graph.distance_matrix(sorted(vertices), edges)
+        self.assertTrue(s)
+
+    def _test_transitive_distance(self, vertices, edges):
+        distances = graph.find_transitive_distance(vertices, edges)
+        self.assertEqual(len(distances), len(vertices))
+
+    def test_00_00_do_nothing(self):
+        # this gives us an idea of the overhead
+        pass
+
+    def test_ring_150(self):
+        self._test_distance_matrix(*ring(150))
+
+    def test_ring_1000(self):
+        self._test_transitive_distance(*ring(1000))
+
+    def test_random_sparse_150(self):
+        self._test_distance_matrix(*random_sparse(150))
+
+    def test_random_sparse_1000(self):
+        self._test_transitive_distance(*random_sparse(1000))
+
+    def test_hub_and_spoke_150(self):
+        self._test_distance_matrix(*hub_and_spoke(150))
+
+    def test_hub_and_spoke_1000(self):
+        self._test_transitive_distance(*hub_and_spoke(1000))
@@ -68,3 +68,75 @@ class GraphFunctionTests(samba.tests.TestCase):
             schedule = ntdsconn_schedule(ntdsconn_times)
             self.assertEquals(convert_schedule_to_repltimes(schedule),
                               repltimes)
+
+    def _make_vertices(self, n, colors):
+        vertices = []
+        for i in range(n):
+            v = Vertex(None, None)
+            v.guid = '%08d' % i
+            v.ndrpacked_guid = '%08d' % (n - i)
+            v.color = colors[i % len(colors)]
+            vertices.append(v)
+        return vertices
+
+    def test_internal_edge_sort_key(self):
+        vertices = self._make_vertices(4, [VertexColor.red])
+        edges = []
+        for red_red, cost, duration, e_type in itertools.product(
+                (True, False), (1, 5), (10, 672), ('a', 'b')):
+            for v1, v2 in itertools.combinations(vertices, 2):
+                repl = ReplInfo()
+                repl.cost = cost
+                repl.duration = duration
+                edges.append(InternalEdge(v1, v2, red_red, repl,
+                                          e_type, None))
+        expected = sorted(edges, cmp=lambda a, b: (b < a) - (a < b))
+        self.assertEqual(sorted(edges, key=InternalEdge.sort_key),
+                         expected)
+
+    def test_kruskal_spanning_tree(self):
+        graph = IntersiteGraph()
+        vertices = self._make_vertices(20, [VertexColor.red,
+                                            VertexColor.black])
+        graph.vertices = set(vertices)
+        setup_vertices(graph)
+        edges = []
+        for i, (v1, v2) in enumerate(itertools.combinations(vertices, 2)):
+            repl = ReplInfo()
+            repl.cost = (i * 7) % 13
+            edges.append(InternalEdge(v1, v2, False, repl, 'IP', None))
+
+        output_edges, components = kruskal(graph, edges)
+        self.assertEqual(components, 1)
+        self.assertEqual(len(output_edges), len(vertices) - 1)
+        roots = set(find_component(v) for v in vertices)
+        self.assertEqual(len(roots), 1)
+
+    def test_dijkstra_costs(self):
+        # a line of vertices with the red vertex at one end
+        graph = IntersiteGraph()
+        vertices = self._make_vertices(6, [VertexColor.black])
+        vertices[0].color = VertexColor.red
+        graph.vertices = set(vertices)
+        for v in vertices:
+            v.accept_black = ['IP']
+            v.accept_red_red = ['IP']
+            v.edges = []
+        # the direct links from the red vertex are expensive, so the
+        # cheapest paths to each vertex are along the line
+        for i, v in enumerate(vertices[1:]):
+            links = [(vertices[i], 1)]
+            if i > 0:
+                links.append((vertices[0], 100))
+            for e_from, cost in links:
+                e = MultiEdge()
+                e.vertices = [e_from, v]
+                e.repl_info.cost = cost
+                e.con_type = 'IP'
+                e_from.edges.append(e)
+                v.edges.append(e)
+
+        dijkstra(graph, 'IP', False)
+        self.assertEqual([v.repl_info.cost for v in vertices],
+                         [0, 1, 2, 3, 4, 5])
+        self.assertEqual(set(v.root for v in vertices), set([vertices[0]]))
@@ -198,6 +198,24 @@ class KCCMultisiteLdifTests(samba.tests.TestCaseInTempDir):
                    attempt_live_connections=False)
         self.remove_files(tmpdb)
 
+    def test_profile(self):
+        """Check that the time taken by each phase of a run is recorded.
+        """
+        my_kcc = self._get_kcc('test-profile')
+        tmpdb = os.path.join(self.tempdir, 'profile-tmpdb')
+        my_kcc.import_ldif(tmpdb, self.lp, MULTISITE_LDIF)
+        my_kcc.run(None,
+                   self.lp, self.creds,
+                   attempt_live_connections=False)
+        self.remove_files(tmpdb)
+
+        phases = [name for name, t in my_kcc.phase_times]
+        self.assertEqual(phases, ['load', 'refresh', 'intrasite',
+                                  'intersite', 'commit'])
+        summary = my_kcc.profile_summary()
+        self.assertEqual(len(summary), len(phases) + 1)
+        self.assertTrue(summary[-1].startswith('total'))
+
     def test_unconnected_db(self):
         """Check that the KCC generates errors on a unconnected db
         """
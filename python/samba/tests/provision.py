@@ -18,6 +18,9 @@
 """Tests for samba.provision."""
 
 import os
+import re
+import shutil
+from samba import schema
 from samba.provision import (
     ProvisionNames,
     ProvisionPaths,
@@ -73,6 +76,65 @@ class ProvisionTestCase(samba.tests.TestCaseInTempDir):
             if os.path.exists(secrets_tdb_path):
                 os.unlink(secrets_tdb_path)
 
+class SchemaCacheTests(samba.tests.TestCaseInTempDir):
+    """Tests for the cache of the converted AD schema."""
+
+    def setUp(self):
+        super(SchemaCacheTests, self).setUp()
+        self.old_cache_dir = os.environ.get("SAMBA_SCHEMA_CACHE_DIR")
+        self.cache_dir = os.path.join(self.tempdir, "schema-cache")
+        os.environ["SAMBA_SCHEMA_CACHE_DIR"] = self.cache_dir
+        schema._ms_schema_cache.clear()
+        schema._schema_data_cache.clear()
+
+    def tearDown(self):
+        if self.old_cache_dir is None:
+            del os.environ["SAMBA_SCHEMA_CACHE_DIR"]
+        else:
+            os.environ["SAMBA_SCHEMA_CACHE_DIR"] = self.old_cache_dir
+        if os.path.isdir(self.cache_dir):
+            shutil.rmtree(self.cache_dir)
+        super(SchemaCacheTests, self).tearDown()
+
+    def test_cached_schema(self):
+        domainsid = "S-1-5-21-1-2-3"
+        s1 = schema.ldb_with_schema(domainsid=domainsid)
+        cached = os.listdir(self.cache_dir)
+        self.assertEqual(1, len(cached))
+        self.assertTrue(cached[0].startswith("ms-schema-"))
+
+        # A new process would only find the copy on disk
+        schema._ms_schema_cache.clear()
+        schema._schema_data_cache.clear()
+        s2 = schema.ldb_with_schema(domainsid=domainsid)
+        self.assertEqual(cached, os.listdir(self.cache_dir))
+
+        guid_re = re.compile(r"(?m)^objectGUID: .*$")
+        self.assertEqual(guid_re.sub("", s1.schema_data),
+                         guid_re.sub("", s2.schema_data))
+        self.assertNotEqual(guid_re.findall(s1.schema_data),
+                            guid_re.findall(s2.schema_data))
+
+    def test_cached_schema_ldb(self):
+        s1 = schema.ldb_with_schema(domainsid="S-1-5-21-1-2-3")
+        s2 = schema.ldb_with_schema(domainsid="S-1-5-21-1-2-3")
+        path1 = os.path.join(self.tempdir, "schema1.ldb")
+        path2 = os.path.join(self.tempdir, "schema2.ldb")
+        try:
+            s1.write_to_tmp_ldb(path1)
+            self.assertEqual(2, len(os.listdir(self.cache_dir)))
+            s2.write_to_tmp_ldb(path2)
+            self.assertEqual(2, len(os.listdir(self.cache_dir)))
+            self.assertEqual(open(path1, "rb").read(),
+                             open(path2, "rb").read())
+        finally:
+            del s1
+            del s2
+            for path in (path1, path2):
+                if os.path.exists(path):
+                    os.unlink(path)
+
+
 class FindNssTests(TestCase):
     """Test findnss() function."""
 
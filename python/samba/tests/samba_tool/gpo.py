@@ -43,6 +43,28 @@ class GpoCmdTestCase(SambaToolCmdTest):
         self.assertCmdSuccess(result, out, err, "Ensuring gpo fetched successfully")
         shutil.rmtree(os.path.join(self.tempdir, "policy"))
 
+    def test_fetch_cached(self):
+        """Fetch a GPO twice through a cache, and make sure the second
+        copy comes from the cache and is the same"""
+        cache_dir = os.path.join(self.tempdir, "gpo_cache")
+        gpt_ini = os.path.join(self.tempdir, "policy", self.gpo_guid, "GPT.INI")
+        args = ["gpo", "fetch", self.gpo_guid,
+                "-H", "ldap://%s" % os.environ["SERVER"],
+                "--tmpdir", self.tempdir, "--cache-dir", cache_dir]
+
+        (result, out, err) = self.runsubcmd(*args)
+        self.assertCmdSuccess(result, out, err, "Ensuring gpo fetched successfully")
+        self.assertNotIn("from the cache", out)
+        fetched = open(gpt_ini).read()
+        shutil.rmtree(os.path.join(self.tempdir, "policy"))
+
+        (result, out, err) = self.runsubcmd(*args)
+        self.assertCmdSuccess(result, out, err, "Ensuring gpo fetched from the cache")
+        self.assertIn("from the cache", out)
+        self.assertEqual(fetched, open(gpt_ini).read())
+        shutil.rmtree(os.path.join(self.tempdir, "policy"))
+        shutil.rmtree(cache_dir)
+
     def test_show(self):
         """Show a real GPO, and make sure it passes"""
         (result, out, err) = self.runsubcmd("gpo", "show", self.gpo_guid, "-H", "ldap://%s" % os.environ["SERVER"])
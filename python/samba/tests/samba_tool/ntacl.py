@@ -69,6 +69,28 @@ class NtACLCmdSysvolTestCase(SambaToolCmdTest):
         self.assertEquals(err,"","Shouldn't be any error messages")
         self.assertEquals(out,"","Shouldn't be any output messages")
 
+    def test_s3fs_jobs_incremental_check(self):
+        (result, out, err) =  self.runsubcmd("ntacl", "sysvolreset",
+                                             "--use-s3fs", "--jobs=4")
+
+        self.assertCmdSuccess(result, out, err)
+        self.assertEquals(err,"","Shouldn't be any error messages")
+        self.assertEquals(out,"","Shouldn't be any output messages")
+
+        # Nothing should need changing the second time
+        (result, out, err) =  self.runsubcmd("ntacl", "sysvolreset",
+                                             "--use-s3fs", "--incremental")
+
+        self.assertCmdSuccess(result, out, err)
+        self.assertEquals(err,"","Shouldn't be any error messages")
+        self.assertEquals(out,"","Shouldn't be any output messages")
+
+        # Now check they were set correctly
+        (result, out, err) =  self.runsubcmd("ntacl", "sysvolcheck")
+        self.assertCmdSuccess(result, out, err)
+        self.assertEquals(err,"","Shouldn't be any error messages")
+        self.assertEquals(out,"","Shouldn't be any output messages")
+
 class NtACLCmdGetSetTestCase(SambaToolCmdTest):
     """Tests for samba-tool ntacl get/set subcommands"""
 
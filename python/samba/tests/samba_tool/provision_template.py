@@ -0,0 +1,102 @@
+# Unix SMB/CIFS implementation.
+# Copyright (C) Catalyst IT Ltd. 2018
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from samba.tests.samba_tool.base import SambaToolCmdTest
+from samba.auth import system_session
+from samba.param import LoadParm
+from samba.samdb import SamDB
+from samba.ndr import ndr_unpack
+from samba.dcerpc import misc
+import ldb
+import os
+import shutil
+
+class ProvisionTemplateTestCase(SambaToolCmdTest):
+    """Test for domain provision --template"""
+
+    def setUp(self):
+        super(SambaToolCmdTest, self).setUp()
+        self.templatedir = os.path.join(self.tempdir, "template")
+        self.copydir = os.path.join(self.tempdir, "copy")
+        os.mkdir(self.templatedir)
+        (result, out, err) = self.runsubcmd(
+            "domain", "provision", "--realm=foo.example.com", "--domain=FOO",
+            "--targetdir=%s" % self.templatedir, "--adminpass=Fo0!_9.",
+            "--use-ntvfs")
+        self.assertCmdSuccess(result, out, err)
+
+    def _samdb(self, targetdir):
+        lp = LoadParm()
+        lp.load(os.path.join(targetdir, "etc", "smb.conf"))
+        return SamDB(url=lp.samdb_url(), session_info=system_session(),
+                     lp=lp)
+
+    def _guids(self, samdb):
+        res = samdb.search(base="", scope=ldb.SCOPE_SUBTREE,
+                           expression="(objectGUID=*)",
+                           attrs=["objectGUID"],
+                           controls=["search_options:1:2"])
+        return set(str(ndr_unpack(misc.GUID, msg["objectGUID"][0]))
+                   for msg in res)
+
+    def test_template(self):
+        (result, out, err) = self.runsubcmd(
+            "domain", "provision", "--template=%s" % self.templatedir,
+            "--targetdir=%s" % self.copydir, "--realm=bar.example.com",
+            "--domain=BAR", "--host-name=copydc", "--adminpass=Ba0!_9.",
+            "--use-ntvfs")
+        self.assertCmdSuccess(result, out, err)
+
+        template = self._samdb(self.templatedir)
+        copy = self._samdb(self.copydir)
+        smbconf = os.path.join(self.copydir, "etc", "smb.conf")
+        lp = LoadParm()
+        lp.load(smbconf)
+        self.assertEqual(lp.get("private dir"),
+                         os.path.join(self.copydir, "private"))
+        self.assertEqual(lp.get("realm"), "BAR.EXAMPLE.COM")
+        self.assertEqual(lp.get("workgroup"), "BAR")
+        self.assertEqual(str(copy.domain_dn()).lower(),
+                         "dc=bar,dc=example,dc=com")
+
+        self.assertNotEqual(template.domain_sid, copy.domain_sid)
+        self.assertNotEqual(template.get_ntds_GUID(), copy.get_ntds_GUID())
+        self.assertNotEqual(template.get_invocation_id(),
+                            copy.get_invocation_id())
+        template_guids = self._guids(template)
+        copy_guids = self._guids(copy)
+        self.assertEqual(len(template_guids), len(copy_guids))
+        self.assertEqual(template_guids & copy_guids, set())
+
+        (result, out, err) = self.runsubcmd("dbcheck", "--cross-ncs",
+                                            "-s", smbconf)
+        self.assertCmdSuccess(result, out, err)
+        (result, out, err) = self.runsubcmd("ntacl", "sysvolcheck",
+                                            "-s", smbconf)
+        self.assertCmdSuccess(result, out, err)
+
+    def test_no_targetdir(self):
+        (result, out, err) = self.runsubcmd(
+            "domain", "provision", "--template=%s" % self.templatedir)
+        self.assertCmdFail(result)
+        self.assertIn("--template requires --targetdir", err)
+
+    def tearDown(self):
+        super(SambaToolCmdTest, self).tearDown()
+        shutil.rmtree(self.templatedir)
+        if os.path.exists(self.copydir):
+            shutil.rmtree(self.copydir)
@@ -302,6 +302,16 @@ class UserCmdTestCase(SambaToolCmdTest):
             self.assertEquals(err,"","setpassword with forced change")
             self.assertMatch(out, "Changed password OK", "setpassword with forced change")
 
+        (result, out, err) = self.runsubcmd("user", "syncpasswords", "--no-wait",
+                                            "--batch-size=%d" % len(self.users))
+        self.assertCmdSuccess(result, out, err, "Ensure syncpasswords --no-wait --batch-size runs")
+        self.assertEqual(err,"","syncpasswords --no-wait --batch-size")
+        self.assertMatch(out, "# Batch of %d objects" % len(self.users),
+            "syncpasswords --no-wait --batch-size: '# Batch of': out[%s]" % (out))
+        for user in self.users:
+            self.assertMatch(out, "sAMAccountName: %s" % (user["name"]),
+                "syncpasswords --no-wait --batch-size: 'sAMAccountName': %s out[%s]" % (user["name"], out))
+
 
 
 
@@ -0,0 +1,358 @@
+#!/usr/bin/env python
+#
+# Collect, summarise and compare the timings of the performance tests
+#
+# Copyright (C) Catalyst IT Ltd. 2018
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmark the performance tests in selftest/perf_tests.py.
+
+"make perftest" writes the time taken by each test to st/summary.json.
+This script runs it a number of times (or reads the summary.json files
+or subunit streams of earlier runs), and writes the timings of all runs
+together with their mean, median and standard deviation and some
+details of the machine as JSON:
+
+    script/perf_benchmark.py --repeat=5 --output=before.json
+    ...
+    script/perf_benchmark.py --repeat=5 --output=after.json \\
+        --baseline=before.json
+
+With --baseline, tests that have become slower than the baseline by
+more than --threshold, where the difference is significant according to
+Welch's t-test, are reported as regressions and the script exits with
+an error.
+
+With --profile=DIR, the tests are run once more with each test under
+cProfile (see ProfilingTestResultDecorator in samba.subunit.run), and
+the profiles of the slowest tests are printed.
+"""
+
+from __future__ import print_function
+
+import json
+import math
+import optparse
+import os
+import platform
+import pstats
+import socket
+import subprocess
+import sys
+import time
+
+DEFAULT_COMMAND = "make perftest"
+DEFAULT_SUMMARY = "st/summary.json"
+
+
+def load_timings(filename):
+    """Read the test timings of one or more runs from a file.
+
+    The file can be a summary.json written by format-subunit-json, the
+    output of this script, or a subunit stream that has been through
+    "filter-subunit --perf-test-output".
+
+    :return: a dictionary mapping test names to lists of times
+    """
+    f = open(filename)
+    try:
+        text = f.read()
+    finally:
+        f.close()
+
+    timings = {}
+    if text.lstrip().startswith("{"):
+        data = json.loads(text)
+        if "tests" in data:
+            for name, result in data["tests"].items():
+                timings[name] = list(result["times"])
+        else:
+            for name, t in data.items():
+                timings[name] = [float(t)]
+        return timings
+
+    for line in text.splitlines():
+        if line.startswith("elapsed-time: "):
+            name, t = line[14:].rsplit(":", 1)
+            timings.setdefault(name, []).append(float(t))
+    return timings
+
+
+def merge_timings(timings, more):
+    for name, times in more.items():
+        timings.setdefault(name, []).extend(times)
+
+
+def run_perftest(command, summary, profile_dir=None):
+    """Run the performance tests once and return their timings."""
+    if os.path.exists(summary):
+        os.unlink(summary)
+    env = dict(os.environ)
+    if profile_dir is not None:
+        env["SAMBA_TEST_PROFILE_DIR"] = os.path.abspath(profile_dir)
+    ret = subprocess.call(command, shell=True, env=env)
+    if ret != 0:
+        print("'%s' failed with exit code %d" % (command, ret),
+              file=sys.stderr)
+    if not os.path.exists(summary):
+        raise Exception("'%s' did not write %s" % (command, summary))
+    return load_timings(summary)
+
+
+def summarise(times):
+    n = len(times)
+    mean = sum(times) / n
+    ordered = sorted(times)
+    if n % 2:
+        median = ordered[n // 2]
+    else:
+        median = (ordered[n // 2 - 1] + ordered[n // 2]) / 2.0
+    if n > 1:
+        stdev = math.sqrt(sum((t - mean) ** 2 for t in times) / (n - 1))
+    else:
+        stdev = 0.0
+    return {
+        "runs": n,
+        "times": times,
+        "mean": mean,
+        "median": median,
+        "stdev": stdev,
+        "min": ordered[0],
+        "max": ordered[-1],
+    }
+
+
+def get_git_revision():
+    try:
+        p = subprocess.Popen(["git", "rev-parse", "HEAD"],
+                             stdout=subprocess.PIPE,
+                             stderr=open(os.devnull, "w"))
+        out = p.communicate()[0]
+    except OSError:
+        return None
+    if p.returncode != 0:
+        return None
+    return out.strip()
+
+
+def get_metadata(command):
+    metadata = {
+        "date": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "hostname": socket.gethostname(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "python": platform.python_version(),
+        "git-revision": get_git_revision(),
+        "command": command,
+    }
+    try:
+        import multiprocessing
+        metadata["cpus"] = multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        pass
+    if hasattr(os, "getloadavg"):
+        metadata["loadavg"] = os.getloadavg()
+    return metadata
+
+
+def welch_t(a, b):
+    """Welch's t statistic of the difference between the means of two
+    summaries, or None if there is not enough data for it."""
+    if a["runs"] < 2 or b["runs"] < 2:
+        return None
+    se = math.sqrt(a["stdev"] ** 2 / a["runs"] +
+                   b["stdev"] ** 2 / b["runs"])
+    if se == 0:
+        return None
+    return (b["mean"] - a["mean"]) / se
+
+
+def compare(baseline, current, threshold, min_t):
+    """Compare the summaries of two benchmarks.
+
+    A test has regressed if its mean time has grown by more than the
+    threshold (a fraction of the baseline mean), and either the
+    difference is significant (t >= min_t), or there are not enough
+    runs to tell.
+
+    :return: a list of (name, baseline summary, current summary,
+        relative change, t, status) tuples, slowest change first
+    """
+    results = []
+    for name in sorted(set(baseline) & set(current)):
+        a = baseline[name]
+        b = current[name]
+        if a["mean"] > 0:
+            change = (b["mean"] - a["mean"]) / a["mean"]
+        else:
+            change = 0.0
+        t = welch_t(a, b)
+        significant = t is None or abs(t) >= min_t
+        if change > threshold and significant:
+            status = "REGRESSION"
+        elif change < -threshold and significant:
+            status = "improvement"
+        else:
+            status = "ok"
+        results.append((name, a, b, change, t, status))
+    results.sort(key=lambda x: x[3], reverse=True)
+    return results
+
+
+def print_comparison(results, baseline, current):
+    for name, a, b, change, t, status in results:
+        if t is None:
+            t = "-"
+        else:
+            t = "%.1f" % t
+        print("%-11s %+7.1f%% t=%-6s %9.3fs -> %9.3fs  %s" %
+              (status, change * 100, t, a["mean"], b["mean"], name))
+    for name in sorted(set(baseline) - set(current)):
+        print("missing     %s" % name)
+    for name in sorted(set(current) - set(baseline)):
+        print("new         %s" % name)
+
+
+def print_profiles(tests, profile_dir, n_tests, n_lines):
+    """Print the cProfile statistics of the slowest tests."""
+    if not os.path.isdir(profile_dir):
+        print("No profiles found in %s" % profile_dir, file=sys.stderr)
+        return
+    profiles = [fn[:-len(".pstats")] for fn in os.listdir(profile_dir)
+                if fn.endswith(".pstats")]
+    slowest = sorted(tests.items(), key=lambda x: x[1]["mean"],
+                     reverse=True)
+    for name, summary in slowest[:n_tests]:
+        # filter-subunit prefixes the test ids with the name of the
+        # suite, while the profiles are named after the bare test ids.
+        matches = [p for p in profiles if name.endswith(p)]
+        if not matches:
+            print("No profile for %s" % name, file=sys.stderr)
+            continue
+        fn = os.path.join(profile_dir, max(matches, key=len) + ".pstats")
+        print()
+        print("%s: %.3fs" % (name, summary["mean"]))
+        stats = pstats.Stats(fn, stream=sys.stdout)
+        stats.sort_stats("cumulative").print_stats(n_lines)
+
+
+def main():
+    parser = optparse.OptionParser(
+        "perf_benchmark.py [options] [RESULTS...]",
+        description=("Run the performance tests, or read the results "
+                     "of earlier runs, and summarise and compare them."))
+    parser.add_option("--repeat", type=int, default=0,
+                      help=("Run the performance tests this many times "
+                            "rather than reading RESULTS"))
+    parser.add_option("--command", default=DEFAULT_COMMAND,
+                      help="Command running the tests [%default]")
+    parser.add_option("--summary", default=DEFAULT_SUMMARY,
+                      help=("JSON file the command writes the timings "
+                            "to [%default]"))
+    parser.add_option("--output", help="Write the results as JSON here")
+    parser.add_option("--baseline",
+                      help="Compare against the results in this file")
+    parser.add_option("--threshold", type=float, default=0.1,
+                      help=("Relative slowdown to consider a regression "
+                            "[%default]"))
+    parser.add_option("--t-threshold", type=float, default=2.0,
+                      help=("Minimum Welch's t statistic for a change "
+                            "to be significant [%default]"))
+    parser.add_option("--profile", metavar="DIR",
+                      help=("Run the tests once more with cProfile, "
+                            "writing the statistics to DIR"))
+    parser.add_option("--profile-tests", type=int, default=5,
+                      help=("Print the profiles of this many of the "
+                            "slowest tests [%default]"))
+    parser.add_option("--profile-lines", type=int, default=20,
+                      help="Lines to print for each profile [%default]")
+    opts, args = parser.parse_args()
+
+    if opts.repeat and args:
+        parser.error("--repeat runs the tests; don't give RESULTS")
+    if not opts.repeat and not args:
+        parser.error("either give RESULTS to read or --repeat")
+    if opts.profile and not opts.repeat:
+        parser.error("--profile needs --repeat")
+    if opts.profile and os.path.exists(opts.profile):
+        # The profiling run clears out the profiles of an earlier one,
+        # but never a directory holding anything else.
+        if not os.path.isdir(opts.profile):
+            parser.error("--profile %s is not a directory" % opts.profile)
+        others = [fn for fn in os.listdir(opts.profile)
+                  if not fn.endswith(".pstats")]
+        if others:
+            parser.error("--profile directory %s contains files other "
+                         "than profiles" % opts.profile)
+
+    timings = {}
+    if opts.repeat:
+        for i in range(opts.repeat):
+            print("perf_benchmark: run %d of %d" % (i + 1, opts.repeat),
+                  file=sys.stderr)
+            merge_timings(timings, run_perftest(opts.command, opts.summary))
+        command = opts.command
+    else:
+        for fn in args:
+            merge_timings(timings, load_timings(fn))
+        command = None
+
+    tests = dict((name, summarise(times))
+                 for name, times in timings.items())
+
+    if opts.output:
+        f = open(opts.output, "w")
+        try:
+            json.dump({"metadata": get_metadata(command),
+                       "tests": tests},
+                      f, sort_keys=True, indent=2, separators=(',', ': '))
+        finally:
+            f.close()
+
+    if opts.profile:
+        # The profiler slows the tests down, so the profiles come from
+        # a separate run that isn't counted in the timings.
+        if os.path.isdir(opts.profile):
+            for fn in os.listdir(opts.profile):
+                if fn.endswith(".pstats"):
+                    os.unlink(os.path.join(opts.profile, fn))
+        else:
+            os.makedirs(opts.profile)
+        print("perf_benchmark: profiling run", file=sys.stderr)
+        run_perftest(opts.command, opts.summary, opts.profile)
+        print_profiles(tests, opts.profile, opts.profile_tests,
+                       opts.profile_lines)
+
+    if not opts.baseline:
+        for name, summary in sorted(tests.items()):
+            print("%9.3fs +/- %7.3fs (%d runs)  %s" %
+                  (summary["mean"], summary["stdev"], summary["runs"],
+                   name))
+        return 0
+
+    baseline = dict((name, summarise(times))
+                    for name, times in load_timings(opts.baseline).items())
+    results = compare(baseline, tests, opts.threshold, opts.t_threshold)
+    print_comparison(results, baseline, tests)
+    regressions = [r for r in results if r[5] == "REGRESSION"]
+    if regressions:
+        print("%d of %d tests regressed" % (len(regressions), len(results)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -73,6 +73,8 @@ plantestsuite_loadlist("samba4.ldb.multi_connect.python(ad_dc_ntvfs)",
                         'tdb://$PREFIX_ABS/ad_dc_ntvfs/private/sam.ldb'
                         '$LOADLIST', '$LISTOPT'])
 
+planpythontestsuite("none", "samba.tests.graph_performance")
+
 
 # this one doesn't tidy itself up fully, so leave it as last unless
 # you want a messy database.
@@ -32,6 +32,34 @@ VALID_RESULTS = set(['success', 'successful', 'failure', 'fail', 'skip',
                      'testsuite-success', 'testsuite-error',
                      'uxsuccess', 'testsuite-uxsuccess'])
 
+# matches the arguments of result lines: the test name, and whether a
+# reason follows
+_result_re = re.compile(r"(.*?)( \[)?([ \t]*)( multipart)?\n")
+
+# the time format written by TestProtocolClient.time()
+_time_re = re.compile(r"([0-9]{4})-([0-9]{2})-([0-9]{2})[ T]"
+                      r"([0-9]{2}):([0-9]{2}):([0-9]{2})(?:\.([0-9]{1,6}))?Z$")
+
+
+def parse_time(arg):
+    """Parse the argument of a time line.
+
+    The usual format is handled directly, which is much faster than
+    iso8601.parse_date(); anything else is left to the latter.
+    """
+    m = _time_re.match(arg)
+    if m is None:
+        return iso8601.parse_date(arg)
+    (year, month, day, hour, minute, second, fraction) = m.groups()
+    if fraction is None:
+        microsecond = 0
+    else:
+        microsecond = int(fraction.ljust(6, "0"))
+    return datetime.datetime(int(year), int(month), int(day), int(hour),
+                             int(minute), int(second), microsecond,
+                             iso8601.UTC)
+
+
 class TestsuiteEnabledTestResult(unittest.TestResult):
 
     def start_testsuite(self, name):
@@ -52,7 +80,15 @@ def parse_results(msg_ops, statistics, fh):
             continue
         command = parts[0].rstrip(":")
         arg = parts[1]
-        if command in ("test", "testing"):
+        if command == "time":
+            msg_ops.control_msg(l)
+            try:
+                dt = parse_time(arg.rstrip("\n"))
+            except TypeError as e:
+                print "Unable to parse time line: %s" % arg.rstrip("\n")
+            else:
+                msg_ops.time(dt)
+        elif command in ("test", "testing"):
             msg_ops.control_msg(l)
             name = arg.rstrip()
             test = subunit.RemotedTestCase(name)
@@ -60,18 +96,10 @@ def parse_results(msg_ops, statistics, fh):
                 msg_ops.addError(open_tests.pop(name), subunit.RemoteError(u"Test already running"))
             msg_ops.startTest(test)
             open_tests[name] = test
-        elif command == "time":
-            msg_ops.control_msg(l)
-            try:
-                dt = iso8601.parse_date(arg.rstrip("\n"))
-            except TypeError as e:
-                print "Unable to parse time line: %s" % arg.rstrip("\n")
-            else:
-                msg_ops.time(dt)
         elif command in VALID_RESULTS:
             msg_ops.control_msg(l)
             result = command
-            grp = re.match("(.*?)( \[)?([ \t]*)( multipart)?\n", arg)
+            grp = _result_re.match(arg)
             (testname, hasreason) = (grp.group(1), grp.group(2))
             if hasreason:
                 reason = ""
@@ -260,12 +288,68 @@ def read_test_regexes(*names):
     return ret
 
 
+# Python 2 refuses to compile patterns with more than 100 groups
+MAX_REGEX_GROUPS = 100
+
+
+def compile_test_regexes(regexes):
+    """Compile the regexes returned by read_test_regexes() for
+    find_in_list().
+
+    The regexes are combined into a few alternations, so that a test
+    name matching none of them, which is the common case, is checked
+    with a handful of re.match() calls rather than one for every regex.
+
+    :return: a list of (combined regex, [(regex, reason), ...]) tuples
+    """
+    chunks = []
+    members = []
+    groups = 0
+
+    def add_chunk(members):
+        combined = "|".join("(?:%s)" % r.pattern for (r, reason) in members)
+        chunks.append((re.compile(combined), members))
+
+    for (regex, reason) in sorted(regexes.items()):
+        r = re.compile(regex)
+        if reason is None:
+            reason = ""
+        if re.search(r"\\[1-9]|\(\?P=|\(\?[iLmsux]+\)", regex):
+            # back references and global flags don't survive being
+            # combined with other regexes
+            chunks.append((r, [(r, reason)]))
+            continue
+        if members and groups + r.groups >= MAX_REGEX_GROUPS:
+            add_chunk(members)
+            members = []
+            groups = 0
+        members.append((r, reason))
+        groups += r.groups
+    if members:
+        add_chunk(members)
+    return chunks
+
+
 def find_in_list(regexes, fullname):
-    for regex, reason in regexes.iteritems():
-        if re.match(regex, fullname):
-            if reason is None:
-                return ""
-            return reason
+    """Find the reason for the first regex matching a test name.
+
+    :param regexes: a dictionary from read_test_regexes(), or better,
+        the result of compile_test_regexes() on it
+    :return: the reason, "" if there is none, or None if nothing matches
+    """
+    if isinstance(regexes, dict):
+        for regex, reason in regexes.iteritems():
+            if re.match(regex, fullname):
+                if reason is None:
+                    return ""
+                return reason
+        return None
+
+    for (combined, members) in regexes:
+        if combined.match(fullname):
+            for (r, reason) in members:
+                if r.match(fullname):
+                    return reason
     return None
 
 
@@ -425,13 +509,13 @@ class FilterOps(unittest.TestResult):
         self.prefix = prefix
         self.suffix = suffix
         if expected_failures is not None:
-            self.expected_failures = expected_failures
+            self.expected_failures = compile_test_regexes(expected_failures)
         else:
-            self.expected_failures = {}
+            self.expected_failures = []
         if flapping is not None:
-            self.flapping = flapping
+            self.flapping = compile_test_regexes(flapping)
         else:
-            self.flapping = {}
+            self.flapping = []
         self.strip_ok_output = strip_ok_output
         self.xfail_added = 0
         self.fail_added = 0
@@ -604,6 +688,9 @@ class PlainFormatter(TestsuiteEnabledTestResult):
 
         if result in ("success", "xfail"):
             self.suites_ok+=1
+            # only the output of failed suites is needed for the
+            # summary, don't let it pile up over long runs
+            self.test_output.pop(name, None)
         else:
             self.output_msg("ERROR: Testsuite[%s]\n" % name)
             if reason is not None:
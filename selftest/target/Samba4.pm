@@ -1348,6 +1348,10 @@ sub provision_vampire_dc($$$)
 	$cmd .= "$samba_tool domain join $ret->{CONFIGURATION} $dcvars->{REALM} DC --realm=$dcvars->{REALM}";
 	$cmd .= " -U$dcvars->{DC_USERNAME}\%$dcvars->{DC_PASSWORD} --domain-critical-only";
 	$cmd .= " --machinepass=machine$ret->{PASSWORD} --use-ntvfs";
+	if ($fl == "2000") {
+		# exercise the pipelined replication code
+		$cmd .= " --pipeline-replication";
+	}
 
 	unless (system($cmd) == 0) {
 		warn("Join failed\n$cmd");
@@ -522,6 +522,83 @@ static PyObject *py_close_file(PyObject *self, PyObject *args, PyObject *kwargs)
 	Py_RETURN_NONE;
 }
 
+/*
+ * Raise an exception for a failed read or write, which only return -1
+ */
+static PyObject *py_smb_io_error(struct smb_private_data *spdata)
+{
+	NTSTATUS status = smbcli_nt_error(spdata->tree);
+
+	if (NT_STATUS_IS_OK(status)) {
+		status = NT_STATUS_UNSUCCESSFUL;
+	}
+	PyErr_SetNTSTATUS(status);
+	return NULL;
+}
+
+/*
+ * Read up to size bytes at offset from an open file, returning fewer
+ * at the end of the file
+ */
+static PyObject *py_smb_read_file(PyObject *self, PyObject *args)
+{
+	struct smb_private_data *spdata;
+	PyObject *result;
+	int fnum;
+	unsigned PY_LONG_LONG offset;
+	unsigned int size;
+	ssize_t nread;
+
+	if (!PyArg_ParseTuple(args, "iKI:read_file", &fnum, &offset, &size)) {
+		return NULL;
+	}
+
+	result = PyString_FromStringAndSize(NULL, size);
+	if (result == NULL) {
+		return NULL;
+	}
+
+	spdata = pytalloc_get_ptr(self);
+	nread = smbcli_read(spdata->tree, fnum, PyString_AS_STRING(result),
+			    offset, size);
+	if (nread < 0) {
+		Py_DECREF(result);
+		return py_smb_io_error(spdata);
+	}
+
+	if ((size_t)nread < size && _PyString_Resize(&result, nread) != 0) {
+		return NULL;
+	}
+
+	return result;
+}
+
+/*
+ * Write a string to an open file at offset
+ */
+static PyObject *py_smb_write_file(PyObject *self, PyObject *args)
+{
+	struct smb_private_data *spdata;
+	int fnum;
+	const char *data;
+	Py_ssize_t size;
+	unsigned PY_LONG_LONG offset;
+	ssize_t nwritten;
+
+	if (!PyArg_ParseTuple(args, "is#K:write_file", &fnum, &data, &size,
+			      &offset)) {
+		return NULL;
+	}
+
+	spdata = pytalloc_get_ptr(self);
+	nwritten = smbcli_write(spdata->tree, fnum, 0, data, offset, size);
+	if (nwritten != size) {
+		return py_smb_io_error(spdata);
+	}
+
+	Py_RETURN_NONE;
+}
+
 static PyMethodDef py_smb_methods[] = {
 	{ "loadfile", py_smb_loadfile, METH_VARARGS,
 		"loadfile(path) -> file contents as a string\n\n \
@@ -561,6 +638,12 @@ static PyMethodDef py_smb_methods[] = {
 	{ "close_file", (PyCFunction)py_close_file, METH_VARARGS,
 		"close_file(fnum) -> None\n\n \
 		Close the file based on fnum."},
+	{ "read_file", py_smb_read_file, METH_VARARGS,
+		"read_file(fnum, offset, size) -> string\n\n \
+		Read up to size bytes at offset from an open file."},
+	{ "write_file", py_smb_write_file, METH_VARARGS,
+		"write_file(fnum, data, offset) -> None\n\n \
+		Write string data at offset in an open file."},
 	{ NULL },
 };
 
@@ -685,4 +768,9 @@ void initsmb(void)
 	ADD_FLAGS(FILE_ATTRIBUTE_NONINDEXED);
 	ADD_FLAGS(FILE_ATTRIBUTE_ENCRYPTED);
 	ADD_FLAGS(FILE_ATTRIBUTE_ALL_MASK);
+
+	ADD_FLAGS(NTCREATEX_SHARE_ACCESS_READ);
+	ADD_FLAGS(NTCREATEX_SHARE_ACCESS_WRITE);
+	ADD_FLAGS(NTCREATEX_DISP_OPEN);
+	ADD_FLAGS(NTCREATEX_DISP_OVERWRITE_IF);
 }
@@ -22,6 +22,8 @@ import samba.tests
 import shutil
 import os
 import ldb
+import json
+import uuid
 import drs_base
 
 class SambaToolDrsTests(drs_base.DrsBaseTestCase):
@@ -405,6 +407,54 @@ class SambaToolDrsTests(drs_base.DrsBaseTestCase):
                              attrs=[])
             self.assertRaises(ldb.LdbError, check_dns_account_obj)
 
+    def test_samba_tool_drs_clone_dc_resume(self):
+        """Tests 'samba-tool drs clone-dc-database --resumable' and '--resume'."""
+        server_rootdse = self._get_rootDSE(self.dc1)
+        server_nc_name = server_rootdse["defaultNamingContext"]
+        server_ds_name = server_rootdse["dsServiceName"]
+        server_ldap_service_name = str(server_rootdse["ldapServiceName"][0])
+        server_realm = server_ldap_service_name.split(":")[0]
+        clone_cmd = ("samba-tool drs clone-dc-database %s --server=%s %s --targetdir=%s"
+                     % (server_realm,
+                        self.dc1,
+                        self.cmdline_creds,
+                        self.tempdir))
+        progress_path = os.path.join(self.tempdir, "private", "join_progress.json")
+
+        out = self.check_output(clone_cmd + " --resumable")
+        # the progress is only kept until the clone completes
+        self.assertFalse(os.path.exists(progress_path))
+
+        def attempt_resume():
+            out = self.check_output(clone_cmd + " --resume")
+        self.assertRaises(samba.tests.BlackboxProcessError, attempt_resume)
+
+        # pretend the clone was interrupted while replicating the domain
+        server_samdb = samba.tests.connect_samdb(self.dc1, lp=self.get_loadparm(),
+                                                 credentials=self.get_credentials(),
+                                                 ldap_only=True)
+        progress = {
+            "server": self.dc1,
+            "invocation_id": str(uuid.uuid4()),
+            "source_dsa_invocation_id": server_samdb.get_invocation_id(),
+            "done": [str(server_rootdse["schemaNamingContext"][0]),
+                     str(server_rootdse["configurationNamingContext"][0])],
+            "current": {"step": str(server_nc_name[0]),
+                        "highwatermark": [0, 0, 0]},
+        }
+        f = open(progress_path, 'w')
+        json.dump(progress, f)
+        f.close()
+
+        out = self.check_output(clone_cmd + " --resume")
+        self.assertTrue("Already replicated %s" % server_rootdse["schemaNamingContext"][0] in out)
+        self.assertTrue("Resuming %s" % server_nc_name[0] in out)
+        self.assertFalse(os.path.exists(progress_path))
+
+        ldb_rootdse = self._get_rootDSE("tdb://" + os.path.join(self.tempdir, "private", "sam.ldb"), ldap_only=False)
+        self.assertEqual(ldb_rootdse["defaultNamingContext"], server_nc_name)
+        self.assertEqual(ldb_rootdse["dsServiceName"], server_ds_name)
+
     def test_samba_tool_drs_clone_dc_secrets_without_targetdir(self):
         """Tests 'samba-tool drs clone-dc-database' command without --targetdir."""
         server_rootdse = self._get_rootDSE(self.dc1)
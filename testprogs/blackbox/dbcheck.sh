@@ -17,6 +17,22 @@ dbcheck() {
 	$BINDIR/samba-tool dbcheck --cross-ncs $ARGS
 }
 
+# The same check, split across several worker processes
+dbcheck_jobs() {
+	$BINDIR/samba-tool dbcheck --cross-ncs --jobs=4 $ARGS
+}
+
+# The same check, loading objects in batches
+dbcheck_batch() {
+	$BINDIR/samba-tool dbcheck --cross-ncs --batch-size=100 --profile $ARGS
+}
+
+# Incremental checks: the first checks everything, the second only
+# what changed since
+dbcheck_incremental() {
+	$BINDIR/samba-tool dbcheck --incremental $ARGS
+}
+
 # This list of attributes can be freely extended
 dbcheck_fix_one_way_links() {
 	$BINDIR/samba-tool dbcheck --quiet --fix --yes fix_all_string_dn_component_mismatch --attrs="lastKnownParent defaultObjectCategory fromServer rIDSetReferences" --cross-ncs $ARGS
@@ -56,6 +72,10 @@ dbcheck_fix_one_way_links
 dbcheck_fix_stale_links
 dbcheck_fix_crosspartition_backlinks
 testit "dbcheck" dbcheck
+testit "dbcheck_jobs" dbcheck_jobs
+testit "dbcheck_batch" dbcheck_batch
+testit "dbcheck_incremental" dbcheck_incremental
+testit "dbcheck_incremental_again" dbcheck_incremental
 testit "reindex" reindex
 testit "fixed_attrs" fixed_attrs
 testit "force_modules" force_modules
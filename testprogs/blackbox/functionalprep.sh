@@ -70,6 +70,12 @@ ldapcmp() {
     ldapcmp_ignore "msDS-ClaimPossibleValues" "$RELEASE"  "2012R2_schema"
 }
 
+ldapcmp_jobs() {
+    # the same comparison, split between worker processes and with
+    # objects fetched in smaller batches
+    $PYTHON $BINDIR/samba-tool ldapcmp tdb://$PREFIX_ABS/$RELEASE/private/sam.ldb tdb://$PREFIX_ABS/2012R2_schema/private/sam.ldb --two --jobs=4 --batch-size=100
+}
+
 functional_prep() {
     $BINDIR/samba-tool domain functionalprep -H tdb://$PREFIX_ABS/2012R2_schema/private/sam.ldb --function-level=2012_R2
 }
@@ -101,6 +107,7 @@ testit "functional_prep" functional_prep
 
 # check that the databases are now the same
 testit "check_databases_same" ldapcmp
+testit "check_databases_same_jobs" ldapcmp_jobs
 
 testit $OLD_RELEASE undump_old
 
@@ -68,6 +68,30 @@ tombstones_expunge() {
     fi
 }
 
+tombstones_expunge_batched() {
+    tmpfile=$PREFIX_ABS/$RELEASE/expected-expunge-output-batched.txt.tmp
+    tmpldif1=$PREFIX_ABS/$RELEASE/expected-expunge-output-batched.txt.tmp1
+
+    TZ=UTC $ldbsearch -H tdb://$PREFIX_ABS/${RELEASE}/private/sam.ldb -s base -b '' | grep highestCommittedUSN > $tmpldif1
+
+    $PYTHON $BINDIR/samba-tool domain tombstones expunge -H tdb://$PREFIX_ABS/${RELEASE}/private/sam.ldb --current-time=2016-07-30 --tombstone-lifetime=4 --batch-size=2 --rate-limit=1000 > $tmpfile
+    if [ "$?" != "0" ]; then
+	return 1
+    fi
+    tail -n 1 $tmpfile | diff - $release_dir/expected-expunge-output.txt
+    if [ "$?" != "0" ]; then
+	return 1
+    fi
+
+    tmpldif2=$PREFIX_ABS/$RELEASE/expected-expunge-output-batched.txt.tmp2
+    TZ=UTC $ldbsearch -H tdb://$PREFIX_ABS/${RELEASE}/private/sam.ldb -s base -b '' | grep highestCommittedUSN > $tmpldif2
+
+    diff $tmpldif1 $tmpldif2
+    if [ "$?" != "0" ]; then
+	return 1
+    fi
+}
+
 add_dangling_link() {
     ldif=$release_dir/add-dangling-link.ldif
     TZ=UTC $ldbmodify -H tdb://$PREFIX_ABS/${RELEASE}/private/sam.ldb.d/DC%3DRELEASE-4-5-0-PRE1,DC%3DSAMBA,DC%3DCORP.ldb $ldif
@@ -220,6 +244,18 @@ if [ -d $release_dir ]; then
     testit "check_expected_after_links" check_expected_after_links
     testit "check_expected_after_objects" check_expected_after_objects
     testit "check_expected_unsorted_links" check_expected_unsorted_links
+    testit "$RELEASE batched" undump
+    testit "add_two_more_users batched" add_two_more_users
+    testit "add_four_more_links batched" add_four_more_links
+    testit "add_dangling_link batched" add_dangling_link
+    testit "remove_one_link batched" remove_one_link
+    testit "remove_one_user batched" remove_one_user
+    testit "add_unsorted_links batched" add_unsorted_links
+    testit "tombstones_expunge_batched" tombstones_expunge_batched
+    testit "check_expected_after_deleted_links batched" check_expected_after_deleted_links
+    testit "check_expected_after_links batched" check_expected_after_links
+    testit "check_expected_after_objects batched" check_expected_after_objects
+    testit "check_expected_unsorted_links batched" check_expected_unsorted_links
 else
     subunit_start_test $RELEASE
     subunit_skip_test $RELEASE <<EOF